@@ -1,11 +1,53 @@
 from PyQt5.QtWidgets import QWidget, QPushButton, QMainWindow
 from PyQt5.QtWidgets import QLabel, QLineEdit, QGridLayout, QStyle
-from PyQt5.QtWidgets import QFileDialog, QAction, QMessageBox
+from PyQt5.QtWidgets import QFileDialog, QAction, QMessageBox, QProgressBar
+from PyQt5.QtWidgets import QComboBox, QCheckBox
 from PyQt5.QtGui import QIcon, QDoubleValidator, QIntValidator
-from PyQt5.QtCore import QSettings
+from PyQt5.QtCore import QSettings, QThread, pyqtSignal
 import os.path
+import threading
+import traceback
 import webbrowser
 import CorrFunctions
+import CorrCache
+import CorrProgress
+
+
+class Worker(QThread):
+    '''
+    Runs CorrFunctions.calculate_and_create_figures in the background so the
+    window stays responsive
+
+    Parameters:
+        args: positional arguments of calculate_and_create_figures
+        kwargs: keyword arguments of calculate_and_create_figures
+    '''
+    # Steps done, total steps, step description, seconds remaining or None
+    progress = pyqtSignal(int, int, str, object)
+    # 'complete', 'cancelled' or 'failed' and the error for failed runs
+    done = pyqtSignal(str, str)
+
+    def __init__(self, *args, **kwargs):
+        QThread.__init__(self)
+        self.args = args
+        self.kwargs = kwargs
+        self.cancel_event = threading.Event()
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    def run(self):
+        progress = CorrProgress.Progress(self.progress.emit,
+                                         self.cancel_event.is_set)
+        try:
+            CorrFunctions.calculate_and_create_figures(
+                *self.args, progress=progress, **self.kwargs)
+        except CorrProgress.Cancelled:
+            self.done.emit('cancelled', '')
+        except Exception:
+            self.done.emit('failed', traceback.format_exc())
+        else:
+            self.done.emit('complete', '')
 
 
 class home(QMainWindow):
@@ -28,6 +70,20 @@ class home(QMainWindow):
             self.settings.setValue('Scale Factor', '0.25')
         if not self.settings.value('Offset'):
             self.settings.setValue('Offset', '60')
+        if not self.settings.value('Workers'):
+            self.settings.setValue('Workers', '1')
+        if not self.settings.value('Coarse Method'):
+            self.settings.setValue('Coarse Method', 'bicubic')
+        if not self.settings.value('Precision'):
+            self.settings.setValue('Precision', 'float64')
+        if self.settings.value('Memory Budget') is None:
+            self.settings.setValue('Memory Budget', '')
+        if not self.settings.value('Output Format'):
+            self.settings.setValue('Output Format', 'files')
+        if not self.settings.value('Figures'):
+            self.settings.setValue('Figures', 'scatter')
+        if not self.settings.value('Surrogates'):
+            self.settings.setValue('Surrogates', '0')
         # Menu setup
         menu_bar = self.menuBar()
         help_menu = menu_bar.addMenu('&Help')
@@ -95,9 +151,122 @@ class home(QMainWindow):
         self.offset_edt.setText(self.settings.value('Offset'))
         self.offset_edt.setValidator(QIntValidator(self.offset_edt))
         self.offset = self.offset_edt.text()
-        # Run Button
-        run_btn = QPushButton('Run')
-        run_btn.clicked.connect(self.run)
+        # Workers
+        workers_lbl = QLabel()
+        workers_lbl.setText(
+            "<html><pre>    Workers </pre></html>")
+        wicon_lbl = QLabel()
+        wicon_lbl.setPixmap(pixmap)
+        wicon_lbl.setToolTip(
+            "Number of processes to run in parallel (1 runs in serial)")
+        self.workers_edt = QLineEdit()
+        self.workers_edt.setText(self.settings.value('Workers'))
+        self.workers_edt.setValidator(
+            QIntValidator(1, os.cpu_count() or 1, self.workers_edt))
+        self.workers = self.workers_edt.text()
+        # Coarse-graining method
+        method_lbl = QLabel()
+        method_lbl.setText(
+            "<html><pre>    Coarse-graining </pre></html>")
+        micon_lbl = QLabel()
+        micon_lbl.setPixmap(pixmap)
+        micon_lbl.setToolTip(
+            "bicubic: MATLAB-style resizing\n"
+            "block: mean of each block of pixels (faster)")
+        self.method_cmb = QComboBox()
+        self.method_cmb.addItems(CorrFunctions.COARSE_METHODS)
+        self.method_cmb.setCurrentText(self.settings.value('Coarse Method'))
+        # Precision
+        dtype_lbl = QLabel()
+        dtype_lbl.setText(
+            "<html><pre>    Precision </pre></html>")
+        dicon_lbl = QLabel()
+        dicon_lbl.setPixmap(pixmap)
+        dicon_lbl.setToolTip(
+            "float64: double precision\n"
+            "float32: halves memory use and the size of the saved images")
+        self.dtype_cmb = QComboBox()
+        self.dtype_cmb.addItems(CorrFunctions.DTYPES)
+        self.dtype_cmb.setCurrentText(self.settings.value('Precision'))
+        # Memory budget
+        budget_lbl = QLabel()
+        budget_lbl.setText(
+            "<html><pre>    Memory (MB) </pre></html>")
+        bicon_lbl = QLabel()
+        bicon_lbl.setPixmap(pixmap)
+        bicon_lbl.setToolTip(
+            "Working memory for the correlations of an image, larger\n"
+            "fields of view are processed in tiles (empty for no limit)")
+        self.budget_edt = QLineEdit()
+        self.budget_edt.setText(self.settings.value('Memory Budget'))
+        self.budget_edt.setValidator(QIntValidator(1, 10**6, self.budget_edt))
+        # Output format
+        format_lbl = QLabel()
+        format_lbl.setText(
+            "<html><pre>    Output format </pre></html>")
+        fmicon_lbl = QLabel()
+        fmicon_lbl.setPixmap(pixmap)
+        fmicon_lbl.setToolTip(
+            "files: TIFF and CSV files\n"
+            "store: one compressed results file per image\n"
+            "coarse: TIFFs at coarse-grained size, upsampled when read")
+        self.format_cmb = QComboBox()
+        self.format_cmb.addItems(CorrFunctions.OUTPUT_FORMATS)
+        self.format_cmb.setCurrentText(self.settings.value('Output Format'))
+        # Figures
+        figures_lbl = QLabel()
+        figures_lbl.setText(
+            "<html><pre>    Figures </pre></html>")
+        gicon_lbl = QLabel()
+        gicon_lbl.setPixmap(pixmap)
+        gicon_lbl.setToolTip(
+            "scatter: every pixel for each lag\n"
+            "density: 2D histograms for each lag (faster)\n"
+            "montage: the histograms of all lags in one figure")
+        self.figures_cmb = QComboBox()
+        self.figures_cmb.addItems(CorrFunctions.FIGURE_STYLES)
+        self.figures_cmb.setCurrentText(self.settings.value('Figures'))
+        # Surrogates
+        surrogates_lbl = QLabel()
+        surrogates_lbl.setText(
+            "<html><pre>    Surrogates </pre></html>")
+        sgicon_lbl = QLabel()
+        sgicon_lbl.setPixmap(pixmap)
+        sgicon_lbl.setToolTip(
+            "Number of surrogates to test the correlations against,\n"
+            "saves p-value and threshold maps (0 for no tests).\n"
+            "Surrogates are circular time shifts, which need movies\n"
+            "of at least 3*offset+19 frames")
+        self.surrogates_edt = QLineEdit()
+        self.surrogates_edt.setText(self.settings.value('Surrogates'))
+        self.surrogates_edt.setValidator(
+            QIntValidator(0, 100000, self.surrogates_edt))
+        # Online
+        self.online_chk = QCheckBox('Online')
+        self.online_chk.setToolTip(
+            "Calculate in a single pass over the frames, so memory does not\n"
+            "grow with the number of frames")
+        self.online_chk.setChecked(
+            self.settings.value('Online', False, type=bool))
+        # Cache
+        self.cache_chk = QCheckBox('Cache')
+        self.cache_chk.setToolTip(
+            "Keep coarse-grained images in " + CorrCache.default_cache_path()
+            + "\n(up to " + str(CorrCache.CACHE_SIZE // 1024**3) + " GB) for "
+            "runs with other offsets, and skip outputs\nthat are up to date "
+            "from an earlier run")
+        self.cache_chk.setChecked(
+            self.settings.value('Cache', False, type=bool))
+        # Run and cancel buttons
+        self.run_btn = QPushButton('Run')
+        self.run_btn.clicked.connect(self.run)
+        self.cancel_btn = QPushButton('Cancel')
+        self.cancel_btn.clicked.connect(self.cancel)
+        self.cancel_btn.setEnabled(False)
+        # Progress
+        self.progress_bar = QProgressBar()
+        self.progress_lbl = QLabel()
+        self.worker = None
         # Layout
         self.grid = QGridLayout()
         self.grid.addWidget(folder_lbl, 0, 0)
@@ -114,7 +283,33 @@ class home(QMainWindow):
         self.grid.addWidget(offset_lbl, 3, 0)
         self.grid.addWidget(oicon_lbl, 3, 0)
         self.grid.addWidget(self.offset_edt, 3, 1, 1, 2)
-        self.grid.addWidget(run_btn, 6, 1, 1, 2)
+        self.grid.addWidget(workers_lbl, 4, 0)
+        self.grid.addWidget(wicon_lbl, 4, 0)
+        self.grid.addWidget(self.workers_edt, 4, 1, 1, 2)
+        self.grid.addWidget(method_lbl, 5, 0)
+        self.grid.addWidget(micon_lbl, 5, 0)
+        self.grid.addWidget(self.method_cmb, 5, 1, 1, 2)
+        self.grid.addWidget(dtype_lbl, 6, 0)
+        self.grid.addWidget(dicon_lbl, 6, 0)
+        self.grid.addWidget(self.dtype_cmb, 6, 1, 1, 2)
+        self.grid.addWidget(budget_lbl, 7, 0)
+        self.grid.addWidget(bicon_lbl, 7, 0)
+        self.grid.addWidget(self.budget_edt, 7, 1, 1, 2)
+        self.grid.addWidget(format_lbl, 8, 0)
+        self.grid.addWidget(fmicon_lbl, 8, 0)
+        self.grid.addWidget(self.format_cmb, 8, 1, 1, 2)
+        self.grid.addWidget(figures_lbl, 9, 0)
+        self.grid.addWidget(gicon_lbl, 9, 0)
+        self.grid.addWidget(self.figures_cmb, 9, 1, 1, 2)
+        self.grid.addWidget(surrogates_lbl, 10, 0)
+        self.grid.addWidget(sgicon_lbl, 10, 0)
+        self.grid.addWidget(self.surrogates_edt, 10, 1, 1, 2)
+        self.grid.addWidget(self.online_chk, 11, 1)
+        self.grid.addWidget(self.cache_chk, 11, 2)
+        self.grid.addWidget(self.run_btn, 12, 1)
+        self.grid.addWidget(self.cancel_btn, 12, 2)
+        self.grid.addWidget(self.progress_bar, 13, 0, 1, 3)
+        self.grid.addWidget(self.progress_lbl, 14, 0, 1, 3)
         w = QWidget()
         w.setLayout(self.grid)
         return(w)
@@ -138,22 +333,93 @@ class home(QMainWindow):
     def run(self):
         self.scalefactor = float(self.scalefactor_edt.text())
         self.offset = int(self.offset_edt.text())
+        self.workers = int(self.workers_edt.text())
         self.settings.setValue('Scale Factor', self.scalefactor_edt.text())
         self.settings.setValue('Offset', self.offset_edt.text())
-        if self.scalefactor < 1:
-            CorrFunctions.calculate_and_create_figures(
+        self.settings.setValue('Workers', self.workers_edt.text())
+        self.settings.setValue('Coarse Method',
+                               self.method_cmb.currentText())
+        self.settings.setValue('Online', self.online_chk.isChecked())
+        self.settings.setValue('Precision', self.dtype_cmb.currentText())
+        self.settings.setValue('Memory Budget', self.budget_edt.text())
+        self.settings.setValue('Output Format',
+                               self.format_cmb.currentText())
+        self.settings.setValue('Figures', self.figures_cmb.currentText())
+        self.settings.setValue('Surrogates', self.surrogates_edt.text())
+        self.settings.setValue('Cache', self.cache_chk.isChecked())
+        memory_budget = None
+        cache_path = None
+        if self.cache_chk.isChecked():
+            cache_path = CorrCache.default_cache_path()
+        if self.budget_edt.text():
+            memory_budget = int(self.budget_edt.text())*1024**2
+        if self.scalefactor < 1 and self.worker is None:
+            self.worker = Worker(
                 self.folder,
                 self.actinfolder,
                 float(self.scalefactor),
-                int(self.offset)
+                int(self.offset),
+                workers=int(self.workers),
+                online=self.online_chk.isChecked(),
+                cache_path=cache_path,
+                coarse_method=self.method_cmb.currentText(),
+                dtype=self.dtype_cmb.currentText(),
+                memory_budget=memory_budget,
+                output_format=self.format_cmb.currentText(),
+                figure_style=self.figures_cmb.currentText(),
+                surrogates=int(self.surrogates_edt.text() or 0)
                 )
-            self.msg = QMessageBox()
+            self.worker.progress.connect(self.show_progress)
+            self.worker.done.connect(self.finished)
+            self.run_btn.setEnabled(False)
+            self.cancel_btn.setEnabled(True)
+            self.progress_bar.setValue(0)
+            self.progress_lbl.setText('Starting')
+            self.worker.start()
+
+    def cancel(self):
+        if self.worker is not None:
+            self.worker.cancel()
+            self.cancel_btn.setEnabled(False)
+            self.progress_lbl.setText('Cancelling after the current step')
+
+    def show_progress(self, done, total, message, remaining):
+        self.progress_bar.setMaximum(max(total, 1))
+        self.progress_bar.setValue(done)
+        if remaining is not None:
+            message += ', ' + CorrProgress.format_time(remaining) + ' left'
+        self.progress_lbl.setText(message)
+
+    def finished(self, status, error):
+        self.worker.wait()
+        self.worker = None
+        self.run_btn.setEnabled(True)
+        self.cancel_btn.setEnabled(False)
+        self.msg = QMessageBox()
+        if status == 'complete':
             self.msg.setIcon(QMessageBox.Information)
             self.msg.setText("Calculations Complete")
             self.msg.setWindowTitle("Finished")
-            self.msg.setStandardButtons(QMessageBox.Ok)
-            self.msg.exec_()
-            self.msg.buttonClicked.connect(self.msgbtn)
+        elif status == 'cancelled':
+            self.msg.setIcon(QMessageBox.Information)
+            self.msg.setText("Calculations Cancelled")
+            self.msg.setWindowTitle("Cancelled")
+        else:
+            self.msg.setIcon(QMessageBox.Critical)
+            self.msg.setText("Calculations Failed")
+            self.msg.setDetailedText(error)
+            self.msg.setWindowTitle("Failed")
+        self.progress_lbl.setText(self.msg.text())
+        self.msg.setStandardButtons(QMessageBox.Ok)
+        self.msg.exec_()
+        self.msg.buttonClicked.connect(self.msgbtn)
+
+    def closeEvent(self, event):
+        # Stop the run before the window and its thread are destroyed
+        if self.worker is not None:
+            self.worker.cancel()
+            self.worker.wait()
+        event.accept()
 
     def open_doc(self):
         webbrowser.open(
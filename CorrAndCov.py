@@ -1,11 +1,332 @@
 # Packages
-# PyQt
+# Qt and matplotlib are only imported when they are used, so batch runs start
+# quickly and do not need a display
+import os
 import sys
-from PyQt5.QtWidgets import QApplication
-import CC_App
+import csv
+import json
+import argparse
+import traceback
+import multiprocessing
 
-if __name__ == "__main__":
+# Columns of a manifest row that override the command line options
+MANIFEST_FIELDS = {'actin_folder': str, 'scalefactor': float, 'offset': int,
+                   'output': str, 'coarse_method': str}
+
+
+def run_gui():
+    '''
+    Open the main window
+    '''
+    from PyQt5.QtWidgets import QApplication
+    import CC_App
     app = QApplication(sys.argv)
     window = CC_App.home()
     window.show()
-    app.exec()
+    return app.exec()
+
+
+def read_manifest(manifest_path):
+    '''
+    Read a list of datasets to process. A .json manifest is a list of objects,
+    any other file is read as CSV with a header row. Each dataset has a
+    data_path and optionally actin_folder, scalefactor, offset, output and
+    coarse_method.
+    Relative paths are relative to the folder of the manifest.
+
+    Parameters:
+        manifest_path (str): location of manifest
+
+    Returns:
+        datasets (list of dict): data_path and options of each dataset
+    '''
+    with open(manifest_path, newline='') as f:
+        if manifest_path.lower().endswith('.json'):
+            rows = json.load(f)
+        else:
+            rows = list(csv.DictReader(f))
+    folder = os.path.dirname(os.path.abspath(manifest_path))
+    datasets = []
+    for row in rows:
+        if not row.get('data_path'):
+            raise ValueError('every dataset in '+manifest_path
+                             + ' needs a data_path')
+        dataset = {'data_path': os.path.join(folder, row['data_path'])}
+        for field, kind in MANIFEST_FIELDS.items():
+            # Empty CSV cells keep the command line option
+            if row.get(field) not in (None, ''):
+                dataset[field] = kind(row[field])
+        if 'output' in dataset:
+            dataset['output'] = os.path.join(folder, dataset['output'])
+        datasets.append(dataset)
+    return datasets
+
+
+def comma_separated(kind):
+    '''
+    Parameters:
+        kind (type): type of each value, e.g. float
+
+    Returns:
+        parse (callable): argparse type reading one value or several
+        separated by commas into a list
+    '''
+    def parse(text):
+        try:
+            return [kind(value) for value in text.split(',')]
+        except ValueError:
+            raise argparse.ArgumentTypeError(
+                'expected {} values separated by commas, got {!r}'.format(
+                    kind.__name__, text))
+    return parse
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Calculate the coefficient of variation and the time '
+        'correlation of every channel pair. Without arguments the graphical '
+        'interface is opened.')
+    parser.add_argument('data_path', nargs='*',
+                        help='folders holding one folder per channel')
+    parser.add_argument('--manifest',
+                        help='CSV or JSON list of datasets with a data_path '
+                        'and optionally actin_folder, scalefactor, offset, '
+                        'output and coarse_method')
+    parser.add_argument('--actin-folder', default='actin',
+                        help='name of the folder containing actin images')
+    parser.add_argument('--scalefactor', type=comma_separated(float),
+                        default=[0.25],
+                        help='scale factor to downscale images by, several '
+                        'values separated by commas (e.g. 0.5,0.25) run a '
+                        'sweep over every combination with the offsets')
+    parser.add_argument('--offset', type=comma_separated(int), default=[60],
+                        help='number of time lags, several values separated '
+                        'by commas run a sweep')
+    parser.add_argument('--coarse-method', default='bicubic',
+                        choices=['bicubic', 'block'],
+                        help='coarse-grain with MATLAB-style bicubic '
+                        'resizing or by averaging blocks of pixels')
+    parser.add_argument('--dtype', default='float64',
+                        choices=['float64', 'float32'],
+                        help='floating point type of the calculations and '
+                        'saved images, float32 halves memory use')
+    parser.add_argument('--memory-budget', type=float,
+                        help='megabytes of working memory for the '
+                        'correlations of an image, larger fields of view '
+                        'are processed in tiles')
+    parser.add_argument('--figures', default='scatter',
+                        choices=['scatter', 'density', 'montage'],
+                        help='plot every pixel, 2D histograms of each lag, '
+                        'or the histograms of all lags in one montage per '
+                        'channel pair')
+    parser.add_argument('--output-format', default='files',
+                        choices=['files', 'store', 'coarse'],
+                        help='save TIFF and CSV files, the results of each '
+                        'image in one compressed results_<image>.npz, or '
+                        'TIFFs at coarse-grained size that are upsampled '
+                        'when read')
+    parser.add_argument('--window', type=int,
+                        help='frames in each sliding time window, saves the '
+                        'CoV and correlations of every window instead of '
+                        'the whole movie')
+    parser.add_argument('--stride', type=int,
+                        help='frames between the starts of consecutive '
+                        'windows, by default the window length')
+    parser.add_argument('--surrogates', type=int, default=0,
+                        help='number of surrogates to test the correlations '
+                        'against, saves p-value and threshold maps of each '
+                        'channel pair')
+    parser.add_argument('--surrogate-method', default='shift',
+                        choices=['shift', 'phase'],
+                        help='circular time shifts, which need movies of at '
+                        'least 3*offset+19 frames, or phase-randomised '
+                        'copies of the second channel')
+    parser.add_argument('--output-buffer', type=float, default=256,
+                        help='megabytes of results that can wait to be '
+                        'written while the next results are calculated, 0 '
+                        'writes each result before continuing')
+    parser.add_argument('--output',
+                        help='folder to save the corr_<image> folders in, by '
+                        'default the folder above data_path')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of processes')
+    parser.add_argument('--stream', action='store_true',
+                        help='read images a few frames at a time')
+    parser.add_argument('--online', action='store_true',
+                        help='calculate the statistics in a single pass over '
+                        'the frames')
+    parser.add_argument('--cache', action='store_true',
+                        help='cache coarse-grained images in '
+                        '~/.cache/CorrAndCov')
+    parser.add_argument('--cache-dir', metavar='DIR',
+                        help='cache coarse-grained images in DIR')
+    parser.add_argument('--queue', action='store_true',
+                        help='run through a resumable queue of work units in '
+                        'CorrAndCov_queue in the output folder')
+    parser.add_argument('--queue-dir', metavar='DIR',
+                        help='run through a resumable queue of work units in '
+                        'DIR; several runs, also on other machines, can '
+                        'share a queue')
+    parser.add_argument('--profile', action='store_true',
+                        help='save the time and bytes read and written of '
+                        'each stage')
+    parser.add_argument('--profile-memory', action='store_true',
+                        help='also save the peak memory of each stage with '
+                        'tracemalloc, which slows the run down')
+    parser.add_argument('--watch', action='store_true',
+                        help='keep running and process each new or changed '
+                        'image once it is in every channel folder')
+    parser.add_argument('--interval', type=float, default=10,
+                        help='seconds between scans of the data folders in '
+                        'watch mode')
+    parser.add_argument('--settle-time', type=float, default=30,
+                        help='seconds an image must be unchanged before it '
+                        'is processed in watch mode')
+    return parser.parse_args(argv)
+
+
+def single_or_list(values):
+    '''
+    Returns:
+        value: the only item of values, or values if there are several
+    '''
+    if len(values) == 1:
+        return values[0]
+    return values
+
+
+def datasets_to_run(args):
+    '''
+    Parameters:
+        args (argparse.Namespace): command line options
+
+    Returns:
+        datasets (list of dict): data_path and options of each dataset
+    '''
+    # A single value keeps the output layout of a single run
+    defaults = {'actin_folder': args.actin_folder,
+                'scalefactor': single_or_list(args.scalefactor),
+                'offset': single_or_list(args.offset),
+                'output': args.output, 'coarse_method': args.coarse_method}
+    datasets = [{'data_path': path} for path in args.data_path]
+    if args.manifest:
+        datasets += read_manifest(args.manifest)
+    for dataset in datasets:
+        for field, value in defaults.items():
+            dataset.setdefault(field, value)
+        dataset['data_path'] = os.path.normpath(dataset['data_path'])
+    return datasets
+
+
+def run_batch(argv=None):
+    '''
+    Process every dataset given on the command line without the interface.
+    A dataset that fails is reported and the others are still processed.
+
+    Parameters:
+        argv (list of str): command line arguments, None for sys.argv
+
+    Returns:
+        status (int): 0 if every dataset was processed, 1 otherwise
+    '''
+    args = parse_args(argv)
+    datasets = datasets_to_run(args)
+    if not datasets:
+        print('No datasets given, see --help')
+        return 1
+    # Figures are only saved
+    os.environ.setdefault('MPLBACKEND', 'Agg')
+    import CorrFunctions
+    import CorrCache
+    import CorrProfile
+    cache_path = args.cache_dir
+    if args.cache and cache_path is None:
+        cache_path = CorrCache.default_cache_path()
+    # An empty queue path keeps the queue in the output folder
+    queue_path = args.queue_dir
+    if args.queue and queue_path is None:
+        queue_path = ''
+    memory_budget = None
+    if args.memory_budget is not None:
+        memory_budget = int(args.memory_budget*1024**2)
+    output_buffer = int(args.output_buffer*1024**2)
+    options = {'stream': args.stream, 'workers': args.workers,
+               'online': args.online, 'cache_path': cache_path,
+               'dtype': args.dtype, 'memory_budget': memory_budget,
+               'output_buffer': output_buffer,
+               'output_format': args.output_format,
+               'figure_style': args.figures, 'window': args.window,
+               'stride': args.stride, 'surrogates': args.surrogates,
+               'surrogate_method': args.surrogate_method,
+               'queue_path': queue_path}
+    if queue_path is not None and args.watch:
+        print('--queue cannot be used with --watch')
+        return 1
+    if queue_path and len(datasets) > 1:
+        print('--queue-dir needs a single dataset, use --queue to keep a '
+              'queue in the output folder of each dataset')
+        return 1
+    if args.watch:
+        return run_watch(datasets, args, options)
+    failed = []
+    for dataset in datasets:
+        print('Processing '+dataset['data_path'])
+        profiler = None
+        if args.profile or args.profile_memory:
+            profiler = CorrProfile.Profiler(trace_memory=args.profile_memory)
+        try:
+            CorrFunctions.calculate_and_create_figures(
+                dataset['data_path'], dataset['actin_folder'],
+                dataset['scalefactor'], dataset['offset'],
+                profiler=profiler, output_path=dataset['output'],
+                coarse_method=dataset['coarse_method'], **options)
+        except Exception:
+            traceback.print_exc()
+            failed.append(dataset['data_path'])
+    if failed:
+        print('Failed: '+', '.join(failed))
+        return 1
+    return 0
+
+
+def run_watch(datasets, args, options):
+    '''
+    Watch the datasets and process new images as they are acquired, until
+    interrupted with Ctrl+C
+
+    Parameters:
+        datasets (list of dict): data_path and options of each dataset
+        args (argparse.Namespace): command line options
+        options (dict): passed on to calculate_and_create_figures
+
+    Returns:
+        status (int): 0
+    '''
+    import CorrWatch
+    watchers = [CorrWatch.Watcher(
+        dataset['data_path'], dataset['actin_folder'],
+        dataset['scalefactor'], dataset['offset'],
+        settle_time=args.settle_time, output_path=dataset['output'],
+        coarse_method=dataset['coarse_method'], **options)
+        for dataset in datasets]
+    print('Watching '+', '.join(dataset['data_path']
+                                for dataset in datasets))
+    try:
+        CorrWatch.watch(watchers, args.interval)
+    except KeyboardInterrupt:
+        print('Stopped watching')
+    return 0
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    if not argv:
+        return run_gui()
+    return run_batch(argv)
+
+
+if __name__ == "__main__":
+    # Needed for the process pool in the bundled executable
+    multiprocessing.freeze_support()
+    sys.exit(main())
@@ -0,0 +1,204 @@
+import os
+import json
+import hashlib
+import numpy as np
+
+# Largest total size of the cached arrays in bytes, least recently used
+# arrays are removed beyond it
+CACHE_SIZE = 4 * 1024**3
+# File in each corr_<image> folder recording what its outputs were made from
+MANIFEST_NAME = 'CorrAndCov.json'
+
+
+def default_cache_path():
+    '''
+    Returns:
+        cache_path (str): folder for cached arrays in the user's home
+    '''
+    return os.path.join(os.path.expanduser('~'), '.cache', 'CorrAndCov')
+
+
+def file_signature(path):
+    '''
+    Identify the current contents of a file without reading it
+
+    Parameters:
+        path (str): location of file
+
+    Returns:
+        signature (list): absolute path, modification time and size
+    '''
+    stat = os.stat(path)
+    return [os.path.abspath(path), stat.st_mtime_ns, stat.st_size]
+
+
+def hash_key(*args):
+    '''
+    Returns:
+        key (str): hash of the JSON representation of args
+    '''
+    text = json.dumps(args, sort_keys=True)
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def image_key(image_path, scalefactor, coarse_method='bicubic',
+              dtype='float64'):
+    '''
+    Key of a coarse-grained image: changes when the file is modified or the
+    scale factor, coarse-graining method or dtype changes
+
+    Parameters:
+        image_path (str): location of image
+        scalefactor (float): scale factor the image is downscaled by
+        coarse_method (str): method the image is coarse-grained with
+        dtype (str): name of the dtype of the coarse-grained image
+
+    Returns:
+        key (str): cache key
+    '''
+    return hash_key(file_signature(image_path), scalefactor, coarse_method,
+                    dtype)
+
+
+def load(cache_path, key):
+    '''
+    Read an array from the cache
+
+    Parameters:
+        cache_path (str): cache folder
+        key (str): cache key
+
+    Returns:
+        array (numpy array): cached array or None if it is not in the cache
+    '''
+    array_path = os.path.join(cache_path, key+'.npy')
+    try:
+        array = np.load(array_path)
+    except (IOError, ValueError):
+        return None
+    try:
+        # Mark as recently used for eviction
+        os.utime(array_path)
+    except OSError:
+        pass
+    return array
+
+
+def store(cache_path, key, array, max_bytes=CACHE_SIZE):
+    '''
+    Write an array to the cache and evict old arrays beyond max_bytes
+
+    Parameters:
+        cache_path (str): cache folder
+        key (str): cache key
+        array (numpy array): array to cache
+        max_bytes (int): largest total size of the cache
+    '''
+    if not os.path.exists(cache_path):
+        os.makedirs(cache_path, exist_ok=True)
+    array_path = os.path.join(cache_path, key+'.npy')
+    temp_path = array_path+'.'+str(os.getpid())+'.tmp'
+    with open(temp_path, 'wb') as f:
+        np.save(f, array)
+    # Readers never see a partly written file
+    os.replace(temp_path, array_path)
+    evict(cache_path, max_bytes)
+
+
+def evict(cache_path, max_bytes):
+    '''
+    Remove least recently used arrays until the cache fits in max_bytes
+
+    Parameters:
+        cache_path (str): cache folder
+        max_bytes (int): largest total size of the cache
+    '''
+    entries = []
+    for name in os.listdir(cache_path):
+        if name.endswith('.npy'):
+            try:
+                stat = os.stat(os.path.join(cache_path, name))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+    total = sum(size for mtime, size, name in entries)
+    for mtime, size, name in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(os.path.join(cache_path, name))
+        except OSError:
+            # Already removed by another process
+            pass
+        total -= size
+
+
+def read_manifest(results_path):
+    '''
+    Parameters:
+        results_path (str): corr_<image> folder
+
+    Returns:
+        manifest (dict): signature and files of each output in results_path
+    '''
+    try:
+        with open(os.path.join(results_path, MANIFEST_NAME)) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def write_manifest(results_path, manifest):
+    '''
+    Parameters:
+        results_path (str): corr_<image> folder
+        manifest (dict): signature and files of each output in results_path
+    '''
+    manifest_path = os.path.join(results_path, MANIFEST_NAME)
+    with open(manifest_path+'.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(manifest_path+'.tmp', manifest_path)
+
+
+def output_signature(image_paths, **params):
+    '''
+    Signature of an output made from image_paths with params
+
+    Parameters:
+        image_paths (list of str): images the output depends on
+        params: parameters the output depends on
+
+    Returns:
+        signature (str): hash of the image signatures and params
+    '''
+    return hash_key([file_signature(path) for path in image_paths], params)
+
+
+def is_up_to_date(results_path, manifest, name, signature):
+    '''
+    Parameters:
+        results_path (str): corr_<image> folder
+        manifest (dict): manifest of results_path
+        name (str): output name
+        signature (str): output_signature of the output to make
+
+    Returns:
+        up_to_date (bool): True if the output was made with the same signature
+        and all its files still exist
+    '''
+    entry = manifest.get(name)
+    if entry is None or entry['signature'] != signature:
+        return False
+    return all(os.path.exists(os.path.join(results_path, f))
+               for f in entry['files'])
+
+
+def record_output(manifest, name, signature, files):
+    '''
+    Parameters:
+        manifest (dict): manifest to update
+        name (str): output name
+        signature (str): output_signature of the output
+        files (list of str): names of the files written for the output
+    '''
+    manifest[name] = {'signature': signature, 'files': files}
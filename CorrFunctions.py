@@ -1,9 +1,33 @@
 
 import os
+import sys
 import numpy as np
-import matplotlib.pyplot as plt
 import tifffile as tif
-from matlab_imresize.imresize import imresize
+import CorrCache
+import CorrProfile
+import CorrProgress
+import CorrStore
+from matlab_imresize.imresize import imresize, cachedResampleMatrix, cubic
+
+# Ways of coarse-graining images: MATLAB-style bicubic resizing, or the mean
+# of each block of pixels
+COARSE_METHODS = ('bicubic', 'block')
+# Floating point types the analysis can run in. float32 halves the memory use
+# and the size of the saved TIFFs; sums that lose precision in float32 are
+# still accumulated in float64, and correlations and CoV maps stay within
+# FLOAT32_TOLERANCE of a float64 run.
+DTYPES = ('float64', 'float32')
+FLOAT32_TOLERANCE = 1e-4
+# Figures of actin CoV against correlation: a scatter plot of every pixel,
+# or 2D histograms of each lag or of all lags in one montage
+FIGURE_STYLES = ('scatter', 'density', 'montage')
+# Axis ranges of the figures and number of histogram bins (CoV, correlation)
+DENSITY_RANGE = ((0, 1.5), (-1, 1))
+DENSITY_BINS = (150, 200)
+# Ways of saving results: TIFF and CSV files, TIFFs at coarse-grained size
+# upsampled when read (see CorrStore.CoarseTiff), or one compressed results
+# store per image (see CorrStore)
+OUTPUT_FORMATS = ('files', 'store', 'coarse')
 
 
 def load_image(image_path):
@@ -20,56 +44,370 @@ def load_image(image_path):
     return image
 
 
-def coarse_grain_and_normalise(image_path, scalefactor):
+def count_frames(image_path):
+    '''
+    Number of time points in a 2D+t image, read from the file header
+
+    Parameters:
+        image_path (str): location of image to open
+
+    Returns:
+        n_frames (int): length of the time dimension
+    '''
+    with tif.TiffFile(image_path) as tiff:
+        shape = tiff.series[0].shape
+    if len(shape) < 3:
+        return 1
+    return shape[0]
+
+
+def iter_frames(image_path, chunk_size=16):
+    '''
+    Read a 2D+t image a few frames at a time. Uncompressed stacks are
+    memory-mapped, anything else is decoded page by page, so the whole stack
+    is never held in memory.
+
+    Parameters:
+        image_path (str): location of image to open
+        chunk_size (int): number of frames to read at once
+
+    Returns:
+        frames (array): generator of blocks with dimensions [t,x,y]
+    '''
+    try:
+        image = tif.memmap(image_path, mode='r')
+    except ValueError:
+        # Compressed or non-contiguous data can not be memory-mapped
+        image = None
+    if image is not None:
+        if image.ndim == 2:
+            image = image[np.newaxis, ...]
+        for start in range(0, image.shape[0], chunk_size):
+            yield np.array(image[start:start+chunk_size])
+        del image
+        return
+    with tif.TiffFile(image_path) as tiff:
+        pages = tiff.pages
+        for start in range(0, len(pages), chunk_size):
+            stop = min(start+chunk_size, len(pages))
+            yield np.stack([pages[i].asarray() for i in range(start, stop)])
+
+
+def float_dtype(array):
+    '''
+    Returns:
+        dtype (numpy dtype): dtype of array if it is float32, otherwise
+        float64
+    '''
+    if array.dtype == np.float32:
+        return np.dtype(np.float32)
+    return np.dtype(np.float64)
+
+
+def block_edges(in_length, out_length):
+    '''
+    Split in_length pixels into out_length blocks of as equal size as possible
+
+    Parameters:
+        in_length (int): number of pixels
+        out_length (int): number of blocks, at most in_length
+
+    Returns:
+        edges (numpy array): out_length+1 increasing indices from 0 to
+        in_length, block j is edges[j]:edges[j+1]
+    '''
+    return np.arange(out_length+1)*in_length//out_length
+
+
+def block_mean(image, scalefactor, dtype=np.float64, output_shape=None):
+    '''
+    Coarse-grain every frame of an image by averaging blocks of pixels. Blocks
+    are 1/scalefactor pixels wide when that is an integer that divides the
+    image size, otherwise their widths are rounded down or up so they cover
+    the image. The output has the same size as imresize.
+
+    Parameters:
+        image (array): image with dimensions [t,x,y]
+        scalefactor (float): scale factor to downsize image by
+        dtype (numpy dtype): type of the output, the sums are float64
+        output_shape (tuple of int): size (x, y) of the output, instead of
+            scalefactor times the image size
+
+    Returns:
+        image_rescaled (array): mean of each block [t,x,y]
+    '''
+    image = np.asarray(image)
+    n_t, n_x, n_y = image.shape
+    if output_shape is None:
+        out_x = int(np.ceil(scalefactor * n_x))
+        out_y = int(np.ceil(scalefactor * n_y))
+    else:
+        out_x, out_y = output_shape
+    if n_x % out_x == 0 and n_y % out_y == 0:
+        # Equal blocks: reshape so each position within a block is a strided
+        # view, and add the views up over all frames at once
+        block_x = n_x//out_x
+        block_y = n_y//out_y
+        rows = image.reshape(n_t*n_x, out_y, block_y)
+        sums = rows[:, :, 0].astype(np.float64)
+        for j in range(1, block_y):
+            sums += rows[:, :, j]
+        sums = sums.reshape(n_t, out_x, block_x, out_y)
+        image_rescaled = sums[:, :, 0, :].copy()
+        for i in range(1, block_x):
+            image_rescaled += sums[:, :, i, :]
+        image_rescaled /= block_x*block_y
+        return image_rescaled.astype(dtype, copy=False)
+    # Box sums over unequal blocks
+    edges_x = block_edges(n_x, out_x)
+    edges_y = block_edges(n_y, out_y)
+    sums = np.add.reduceat(image, edges_x[:-1], axis=1, dtype=np.float64)
+    sums = np.add.reduceat(sums, edges_y[:-1], axis=2)
+    sums /= np.outer(np.diff(edges_x), np.diff(edges_y))
+    return sums.astype(dtype, copy=False)
+
+
+def block_upsample(image, scalefactor, stack=False):
+    '''
+    Upsample an image coarse-grained with block_mean by repeating each pixel
+    over its block. The output has the same size as imresize.
+
+    Parameters:
+        image (array): image with dimensions [x,y], or [t,x,y] if stack
+        scalefactor (float): scale factor the image was downsized by
+        stack (bool): upsample every frame of a stack
+
+    Returns:
+        image_large (array): upsampled image
+    '''
+    axes = (1, 2) if stack else (0, 1)
+    for axis in axes:
+        length = image.shape[axis]
+        edges = block_edges(int(np.ceil((1/scalefactor) * length)), length)
+        image = np.repeat(image, np.diff(edges), axis=axis)
+    return image
+
+
+def upsample(image, scalefactor, coarse_method='bicubic', stack=False):
+    '''
+    Rescale a coarse-grained result to the original image size
+
+    Parameters:
+        image (array): image with dimensions [x,y], or [t,x,y] if stack
+        scalefactor (float): scale factor the image was downsized by
+        coarse_method (str): method the image was coarse-grained with, see
+            COARSE_METHODS
+        stack (bool): upsample every frame of a stack
+
+    Returns:
+        image_large (array): upsampled image, float32 if image is
+    '''
+    if coarse_method == 'block':
+        return block_upsample(image, scalefactor, stack=stack)
+    return imresize(image, scalar_scale=1/scalefactor, stack=stack,
+                    mode='matrix', dtype=float_dtype(image))
+
+
+def upsample_matrix(length, scalefactor, coarse_method='bicubic'):
+    '''
+    Matrix that upsamples one axis of a coarse-grained result as upsample
+    does
+
+    Parameters:
+        length (int): number of coarse pixels along the axis
+        scalefactor (float): scale factor the image was downsized by
+        coarse_method (str): method the image was coarse-grained with
+
+    Returns:
+        matrix (numpy array): weight of each coarse pixel in each upsampled
+        pixel [upsampled,coarse]
+    '''
+    out_length = int(np.ceil((1/scalefactor) * length))
+    if coarse_method == 'block':
+        matrix = np.zeros((out_length, length))
+        matrix[np.arange(out_length), np.repeat(
+            np.arange(length), np.diff(block_edges(out_length, length)))] = 1
+        return matrix
+    return cachedResampleMatrix(length, out_length, 1/scalefactor, cubic,
+                                4.0)
+
+
+def upsample_region(image, scalefactor, coarse_method='bicubic', region=None):
+    '''
+    Upsample only a region of a coarse-grained result: only the coarse pixels
+    that contribute to the region are used, so the cost grows with the size
+    of the region rather than of the whole image. Gives the same values as
+    the same region of upsample.
+
+    Parameters:
+        image (array): image with dimensions [x,y], or [...,x,y] to upsample
+            every frame
+        scalefactor (float): scale factor the image was downsized by
+        coarse_method (str): method the image was coarse-grained with
+        region (tuple of slices): rows and columns of the upsampled image,
+            None for all of it
+
+    Returns:
+        image_large (array): upsampled region, float32 if image is
+    '''
+    if region is None:
+        region = (slice(None), slice(None))
+    matrices = []
+    spans = []
+    for length, rows in zip(image.shape[-2:], region):
+        matrix = upsample_matrix(length, scalefactor, coarse_method)[rows]
+        used = np.flatnonzero(np.any(matrix, axis=0))
+        span = slice(used[0], used[-1] + 1) if len(used) else slice(0, 0)
+        matrices.append(matrix[:, span])
+        spans.append(span)
+    dtype = float_dtype(image)
+    part = np.asarray(image[(Ellipsis,) + tuple(spans)], dtype=dtype)
+    return np.matmul(np.matmul(matrices[0].astype(dtype), part),
+                     matrices[1].T.astype(dtype))
+
+
+def coarse_grain_stack(image, scalefactor, coarse_method='bicubic',
+                       dtype=np.float64):
+    '''
+    Rescale every frame of an image and normalise each frame by its mean
+
+    Parameters:
+        image (array): image with dimensions [t,x,y]
+        scalefactor (float): scale factor to downsize image by
+        coarse_method (str): 'bicubic' for MATLAB-style resizing or 'block'
+            for the mean of blocks of pixels, which is much faster
+        dtype (numpy dtype): float64 or float32
+
+    Returns:
+        image_normalised (array): image rescaled and normalised by mean
+    '''
+    if coarse_method == 'block':
+        image_rescaled = block_mean(image, scalefactor, dtype)
+    elif coarse_method == 'bicubic':
+        # Use Matlab-esque rescaling on all frames at once
+        image_rescaled = imresize(image, scalar_scale=scalefactor,
+                                  stack=True, mode='matrix', dtype=dtype)
+    else:
+        raise ValueError('coarse_method should be one of '
+                         + ', '.join(COARSE_METHODS))
+    return normalise_frames(image_rescaled, dtype)
+
+
+def normalise_frames(image_rescaled, dtype=np.float64):
+    '''
+    Divide each frame of a coarse-grained image by its mean
+
+    Parameters:
+        image_rescaled (array): image with dimensions [t,x,y]
+        dtype (numpy dtype): float64 or float32
+
+    Returns:
+        image_normalised (array): image normalised by mean
+    '''
+    frame_mean = np.mean(image_rescaled, axis=(1, 2), keepdims=True,
+                         dtype=np.float64)
+    image_normalised = (image_rescaled.astype(dtype, copy=False)
+                        / frame_mean.astype(dtype))
+    return image_normalised
+
+
+def coarse_grain_and_normalise(image_path, scalefactor, stream=False,
+                               chunk_size=16, cache_path=None, profiler=None,
+                               coarse_method='bicubic', dtype=np.float64):
     '''
     Load image, rescale and normalise.
 
     Parameters:
         image_path (str): location of image to open
         scalefactor (float, tuple of floats): scale factor to downsize image by
+        stream (bool): read and coarse-grain chunk_size frames at a time so
+            that memory use depends only on the coarse-grained size
+        chunk_size (int): number of frames per chunk when streaming
+        cache_path (str): folder to reuse coarse-grained images from, None to
+            always read the image
+        profiler (CorrProfile.Profiler): records the read and resize stages
+        coarse_method (str): see coarse_grain_stack
+        dtype (numpy dtype): float64 or float32
 
     Returns:
         image_normalised (array): image rescaled and normalised by mean
     '''
+    if cache_path is not None:
+        key = CorrCache.image_key(image_path, scalefactor, coarse_method,
+                                  np.dtype(dtype).name)
+        with CorrProfile.stage(profiler, 'read_cache'):
+            image_normalised = CorrCache.load(cache_path, key)
+        if image_normalised is not None:
+            return image_normalised
     # Make this float only and force not scaling of time dimension?
     if (type(scalefactor) is float and scalefactor < 1):
-        image = load_image(image_path)
-        image_normalised = np.zeros((np.ceil(
-            [image.shape[0],
-             image.shape[1]*scalefactor,
-             image.shape[2]*scalefactor])).astype(int))
-        for i in range(image.shape[0]):
-            # Use Matlab-esque rescaling
-            image_rescaled = imresize(image[i, ...], scalar_scale=scalefactor)
-            image_normalised[i, ...] = image_rescaled / np.mean(image_rescaled)
+        if stream:
+            image_normalised = None
+            start = 0
+            with CorrProfile.stage(profiler, 'read_and_resize'):
+                CorrProfile.add_bytes_read(profiler, [image_path])
+                for frames in iter_frames(image_path, chunk_size):
+                    block = coarse_grain_stack(frames, scalefactor,
+                                               coarse_method, dtype)
+                    if image_normalised is None:
+                        image_normalised = np.empty(
+                            (count_frames(image_path),) + block.shape[1:],
+                            dtype=dtype)
+                    image_normalised[start:start+block.shape[0], ...] = block
+                    start += block.shape[0]
+        else:
+            with CorrProfile.stage(profiler, 'read'):
+                CorrProfile.add_bytes_read(profiler, [image_path])
+                image = load_image(image_path)
+            with CorrProfile.stage(profiler, 'resize'):
+                image_normalised = coarse_grain_stack(image, scalefactor,
+                                                      coarse_method, dtype)
     else:
         print('scalefactor should be less than 1')
+    if cache_path is not None:
+        with CorrProfile.stage(profiler, 'write_cache'):
+            CorrCache.store(cache_path, key, image_normalised)
     return image_normalised
 
 
-def get_names(data_path):
+def get_names(data_path, images=None):
     '''
     Get names of folders and images in data_path
 
     Parameters:
         data_path (str): path to folder where data is stored
+        images (list of str): filenames of the images to process, None for
+            every image
 
     Returns:
         folders (list of str): list of folders in data_path
-        imlist (list of str): list of filenames in first folder
+        imlist (list of str): list of filenames in first folder, or images
     '''
     folders = os.listdir(data_path)
+    if images is not None:
+        return folders, list(images)
     imlist = os.listdir(os.path.join(data_path, folders[0]))
     return folders, imlist
 
 
-def create_image_dictionary(data_path, scalefactor):
+def create_image_dictionary(data_path, scalefactor, stream=False,
+                            cache_path=None, profiler=None, progress=None,
+                            coarse_method='bicubic', dtype=np.float64,
+                            images=None):
     '''
     Creates a dictionary containing all the normalised images and their names
 
     Parameters:
         data_path (str): path to folder where data is stored
         scalefactor (float): scale factor to downscale image by
+        stream (bool): coarse-grain images frame by frame while reading
+        cache_path (str): folder to reuse coarse-grained images from
+        profiler (CorrProfile.Profiler): records loading of each image
+        progress (CorrProgress.Progress): counts each image and channel
+            loaded
+        coarse_method (str): see coarse_grain_stack
+        dtype (numpy dtype): float64 or float32
+        images (list of str): filenames of the images to load, None for all
 
     Returns:
         image_dict (dict): names and normalised images e.g.
@@ -77,35 +415,67 @@ def create_image_dictionary(data_path, scalefactor):
         of the actin channel of image 3011_SLB3_12sec.tif
     '''
     image_dict = {}
-    [folders, imlist] = get_names(data_path)
+    [folders, imlist] = get_names(data_path, images)
     for im in imlist:
         im_noext = os.path.splitext(im)[0]
         image_dict[im_noext] = dict.fromkeys(folders)
         for folder in folders:
-            image_dict[im_noext][folder] = coarse_grain_and_normalise(
-                    os.path.join(data_path, folder, im), scalefactor)
+            with CorrProfile.stage(profiler, 'load', image=im_noext,
+                                   channel=folder):
+                image_dict[im_noext][folder] = coarse_grain_and_normalise(
+                        os.path.join(data_path, folder, im), scalefactor,
+                        stream=stream, cache_path=cache_path,
+                        profiler=profiler, coarse_method=coarse_method,
+                        dtype=dtype)
+            CorrProgress.step(progress, 'Loaded '+im_noext+' '+folder)
     return image_dict
 
 
-def cross_correlation(image1, image2, scalefactor, offset):
+def next_fast_len(target):
     '''
-    Auto- and cross-correlation
+    Smallest length >= target that factorises into 2, 3 and 5, so that the
+    FFT along the time axis stays fast
 
     Parameters:
-        image1, image2 (numpy arrays): images to compare
-        offset (int): shift in pixels relative to the reference image
-        scalefactor (float): scale factor to upscale image by
+        target (int): minimum length
 
     Returns:
-        corr (list of floats): list of corrolation values for each offset value
+        length (int): 5-smooth length not smaller than target
+    '''
+    best = 2 ** int(np.ceil(np.log2(max(target, 1))))
+    p5 = 1
+    while p5 < best:
+        p35 = p5
+        while p35 < best:
+            length = p35
+            while length < target:
+                length *= 2
+            best = min(best, length)
+            p35 *= 3
+        p5 *= 5
+    return best
+
+
+def cross_correlation_direct(image1, image2, offset):
+    '''
+    Reference per-lag estimator: shifts image2 by every lag in turn and
+    recomputes means, stds and products over the overlapping frames
+
+    Parameters:
+        image1, image2 (numpy arrays): images to compare [t,x,y]
+        offset (int): number of time lags to calculate
+
+    Returns:
+        corr (numpy array): correlation values [lag,x,y]
     '''
-    if offset > image1.shape[0]:
-        offset = image1.shape[0]-1
-    corr = np.zeros([offset, image1.shape[1], image1.shape[2]])
+    corr = np.zeros([offset, image1.shape[1], image1.shape[2]],
+                    dtype=float_dtype(image1))
     for i in range(0, offset, 1):
         tshift = np.roll(image2, i, axis=0)
-        t = image1[i:, :, :] - np.mean(image1[i:, :, :], axis=0)
-        tshift = tshift[i:, :, :] - np.mean(tshift[i:, :, :], axis=0)
+        t = image1[i:, :, :] - np.mean(image1[i:, :, :], axis=0,
+                                       dtype=np.float64)
+        tshift = tshift[i:, :, :] - np.mean(tshift[i:, :, :], axis=0,
+                                            dtype=np.float64)
         total_of_multiple = np.sum(np.multiply(t, tshift), axis=0)
         multipe_of_stds = (np.std(t, axis=0, ddof=1)
                            * np.std(tshift, axis=0, ddof=1))
@@ -114,6 +484,279 @@ def cross_correlation(image1, image2, scalefactor, offset):
     return corr
 
 
+def lagged_statistics(image, offset, nfft):
+    '''
+    Terms of the all-lags estimator that depend on one channel only: its
+    spectrum, and the sums and variances of the overlapping frames at every
+    lag, both as the first (frames [i:]) and second (frames [:t-i]) image of
+    a pair. They are shared by every pair the channel is part of.
+
+    Parameters:
+        image (numpy array): image with dimensions [t,x,y]
+        offset (int): number of time lags to calculate
+        nfft (int): length of the zero-padded FFT along time
+
+    Returns:
+        stats (dict): spectrum [f,x,y] (complex64 for float32 images), and
+        lead_sum, lead_var, lag_sum and lag_var [lag,x,y] (always float64)
+        and the dtype of the image
+    '''
+    n_t = image.shape[0]
+    dtype = float_dtype(image)
+    # Centre on the whole-movie mean to limit cancellation in the sums
+    x = image - np.mean(image, axis=0, dtype=np.float64).astype(dtype)
+    lags = np.arange(offset)
+    n = (n_t - lags).reshape(-1, 1, 1)
+    zero = np.zeros((1,) + x.shape[1:])
+    # Running sums over many frames are accumulated in float64
+    cum_x = np.concatenate((zero, np.cumsum(x, axis=0, dtype=np.float64)))
+    cum_xx = np.concatenate((zero, np.cumsum(x*x, axis=0,
+                                             dtype=np.float64)))
+    lead_sum = cum_x[-1] - cum_x[lags]
+    lead_sum_sq = cum_xx[-1] - cum_xx[lags]
+    lag_sum = cum_x[n_t - lags]
+    lag_sum_sq = cum_xx[n_t - lags]
+    stats = {
+        'dtype': dtype,
+        'spectrum': np.fft.rfft(x, nfft, axis=0).astype(
+            np.result_type(dtype, np.complex64), copy=False),
+        'lead_sum': lead_sum,
+        'lead_var': np.maximum(lead_sum_sq - lead_sum*lead_sum/n, 0),
+        'lag_sum': lag_sum,
+        'lag_var': np.maximum(lag_sum_sq - lag_sum*lag_sum/n, 0)}
+    return stats
+
+
+def correlation_from_statistics(stats1, stats2, n_t, offset, nfft):
+    '''
+    Combine the lagged statistics of two channels into their correlation
+
+    Parameters:
+        stats1, stats2 (dict): lagged_statistics of the first and second image
+        n_t (int): number of time points
+        offset (int): number of time lags to calculate
+        nfft (int): length of the zero-padded FFT along time
+
+    Returns:
+        corr (numpy array): correlation values [lag,x,y]
+    '''
+    lags = np.arange(offset)
+    n = (n_t - lags).reshape(-1, 1, 1)
+    sum_xy = np.fft.irfft(stats1['spectrum'] * np.conj(stats2['spectrum']),
+                          nfft, axis=0)[:offset]
+    covariance = sum_xy - stats1['lead_sum']*stats2['lag_sum']/n
+    # Same as (covariance/(n-1))/(std_x*std_y) with ddof=1
+    corr = covariance/np.sqrt(stats1['lead_var']*stats2['lag_var'])
+    corr = corr.astype(stats1['dtype'], copy=False)
+    # A single overlapping frame has no sample std, as in the direct path
+    corr[n_t - lags < 2] = np.nan
+    return corr
+
+
+def cross_correlation_fft(image1, image2, offset):
+    '''
+    All-lags estimator: lagged cross-products for every lag come from one
+    zero-padded FFT along time, and the per-lag sums and sums of squares of
+    the overlapping frames come from cumulative sums. Gives the same values
+    as cross_correlation_direct in O(T log T) per pixel.
+
+    Parameters:
+        image1, image2 (numpy arrays): images to compare [t,x,y]
+        offset (int): number of time lags to calculate
+
+    Returns:
+        corr (numpy array): correlation values [lag,x,y]
+    '''
+    n_t = image1.shape[0]
+    # Padding to t+offset-1 stops the circular FFT wrapping the used lags
+    nfft = next_fast_len(n_t + offset - 1)
+    stats1 = lagged_statistics(image1, offset, nfft)
+    if image2 is image1:
+        stats2 = stats1
+    else:
+        stats2 = lagged_statistics(image2, offset, nfft)
+    return correlation_from_statistics(stats1, stats2, n_t, offset, nfft)
+
+
+def lags_to_calculate(offset, n_t):
+    '''
+    Number of lags calculated for an offset, the same in every path: an
+    offset larger than the number of frames is cut to n_t-1
+
+    Parameters:
+        offset (int): number of time lags asked for
+        n_t (int): number of time points
+
+    Returns:
+        offset (int): number of time lags calculated
+    '''
+    if offset > n_t:
+        return n_t-1
+    return offset
+
+
+def correlation_bytes_per_pixel(n_t, offset, n_images, method='fft',
+                                itemsize=8):
+    '''
+    Estimate of the peak memory needed per pixel to correlate n_images
+    channels, including the correlations of the pixel but not the images
+
+    Parameters:
+        n_t (int): number of time points
+        offset (int): number of time lags to calculate
+        n_images (int): number of channels correlated together
+        method (str): 'fft' or 'direct'
+        itemsize (int): bytes per value, 4 for float32 images
+
+    Returns:
+        size (int): bytes per pixel
+    '''
+    output = n_images*n_images*offset*itemsize
+    if method == 'direct':
+        # Shifted copy, two centred arrays and their product for each lag
+        return output + 4*8*n_t + 2*8*offset
+    nfft = next_fast_len(n_t + offset - 1)
+    n_freq = nfft//2 + 1
+    # Spectrum and float64 lagged sums and variances kept for every channel
+    kept = n_images*(2*itemsize*n_freq + 4*8*offset)
+    # Centred image, squares, cumulative sums and FFT buffers of one channel
+    statistics = 2*itemsize*n_t + 4*8*(n_t+1) + 8*nfft + 16*n_freq
+    # Spectrum product, inverse FFT and lagged terms of one pair
+    pair = 2*itemsize*n_freq + 8*nfft + 4*8*offset
+    return output + kept + max(statistics, pair)
+
+
+def spatial_tiles(shape, pixels):
+    '''
+    Split a field of view into tiles of at most pixels pixels: blocks of whole
+    rows, or pieces of a row if a row has more than pixels pixels
+
+    Parameters:
+        shape (tuple of int): size of the field of view (x, y)
+        pixels (int): largest number of pixels in a tile
+
+    Returns:
+        tiles (generator): (slice of x, slice of y) of each tile
+    '''
+    n_x, n_y = shape
+    pixels = max(int(pixels), 1)
+    if pixels >= n_y:
+        rows = pixels//n_y
+        for start in range(0, n_x, rows):
+            yield slice(start, start+rows), slice(0, n_y)
+    else:
+        for x in range(n_x):
+            for start in range(0, n_y, pixels):
+                yield slice(x, x+1), slice(start, start+pixels)
+
+
+def cross_correlation(image1, image2, scalefactor, offset, method='fft',
+                      memory_budget=None, out=None):
+    '''
+    Auto- and cross-correlation
+
+    Parameters:
+        image1, image2 (numpy arrays): images to compare
+        offset (int): shift in pixels relative to the reference image
+        scalefactor (float): scale factor to upscale image by
+        method (str): 'fft' to compute all lags at once or 'direct' to loop
+            over each lag
+        memory_budget (int): bytes of working memory to use. The field of
+            view is then processed in spatial tiles, each written straight
+            into the output, so the temporaries never exceed the budget.
+            None processes the whole field at once.
+        out (numpy array): array to write the correlations into, e.g. a
+            np.memmap so they are not held in memory [lag,x,y]
+
+    Returns:
+        corr (list of floats): list of corrolation values for each offset value
+    '''
+    offset = lags_to_calculate(offset, image1.shape[0])
+    if memory_budget is not None or out is not None:
+        if out is None:
+            out = np.zeros((offset,) + image1.shape[1:],
+                           dtype=float_dtype(image1))
+        pixels = image1.shape[1]*image1.shape[2]
+        if memory_budget is not None:
+            pixels = memory_budget // correlation_bytes_per_pixel(
+                image1.shape[0], offset, 1 if image2 is image1 else 2,
+                method, float_dtype(image1).itemsize)
+        for tile in spatial_tiles(image1.shape[1:], pixels):
+            tile1 = image1[(slice(None),) + tile]
+            # Keep autocorrelations recognisable, so statistics are shared
+            tile2 = tile1 if image2 is image1 else image2[
+                (slice(None),) + tile]
+            out[(slice(None),) + tile] = cross_correlation(
+                tile1, tile2, scalefactor, offset, method)
+        return out
+    if method == 'fft':
+        corr = cross_correlation_fft(image1, image2, offset)
+    elif method == 'direct':
+        corr = cross_correlation_direct(image1, image2, offset)
+    else:
+        raise ValueError('method should be fft or direct')
+    return corr
+
+
+def pairwise_correlation(images, scalefactor, offset, method='fft',
+                         memory_budget=None, out=None):
+    '''
+    Auto- and cross-correlation of every pair of channels of one image. The
+    lagged statistics of each channel are computed once and shared by all
+    the pairs it is part of.
+
+    Parameters:
+        images (list of numpy arrays): every channel of an image [t,x,y]
+        scalefactor (float): scale factor to upscale image by
+        offset (int): shift in pixels relative to the reference image
+        method (str): 'fft' to compute all lags at once or 'direct' to loop
+            over each lag
+        memory_budget (int): bytes of working memory to use, see
+            cross_correlation
+        out (numpy array): array to write the correlations into, e.g. a
+            np.memmap [channel,channel,lag,x,y]
+
+    Returns:
+        corr (numpy array): correlation values [channel,channel,lag,x,y],
+        corr[a, b] is cross_correlation(images[a], images[b], ...)
+    '''
+    n_t = images[0].shape[0]
+    offset = lags_to_calculate(offset, n_t)
+    if memory_budget is not None:
+        if out is None:
+            out = np.zeros((len(images), len(images), offset)
+                           + images[0].shape[1:],
+                           dtype=float_dtype(images[0]))
+        pixels = memory_budget // correlation_bytes_per_pixel(
+            n_t, offset, len(images), method,
+            float_dtype(images[0]).itemsize)
+        for tile in spatial_tiles(images[0].shape[1:], pixels):
+            out[(Ellipsis,) + tile] = pairwise_correlation(
+                [image[(slice(None),) + tile] for image in images],
+                scalefactor, offset, method)
+        return out
+    if out is None:
+        corr = np.zeros((len(images), len(images), offset)
+                        + images[0].shape[1:], dtype=float_dtype(images[0]))
+    else:
+        corr = out
+    if method == 'fft':
+        nfft = next_fast_len(n_t + offset - 1)
+        stats = [lagged_statistics(image, offset, nfft) for image in images]
+        for a in range(len(images)):
+            for b in range(len(images)):
+                corr[a, b] = correlation_from_statistics(
+                    stats[a], stats[b], n_t, offset, nfft)
+    elif method == 'direct':
+        for a in range(len(images)):
+            for b in range(len(images)):
+                corr[a, b] = cross_correlation_direct(
+                    images[a], images[b], offset)
+    else:
+        raise ValueError('method should be fft or direct')
+    return corr
+
+
 def coefficient_of_variation(image, scalefactor):
     '''
     Calculate coefficient of variation
@@ -126,13 +769,13 @@ def coefficient_of_variation(image, scalefactor):
         CoV_map (numpy array): Calculated CoV (2D)
     '''
     # Calculate coefficinet of variation
-    mean_t_image = np.mean(image, axis=0)
-    std_t_image = np.std(image, axis=0, ddof=1)
+    mean_t_image = np.mean(image, axis=0, dtype=np.float64)
+    std_t_image = np.std(image, axis=0, ddof=1, dtype=np.float64)
     CoV_map = std_t_image/np.mean(mean_t_image)
-    return CoV_map
+    return CoV_map.astype(float_dtype(image), copy=False)
 
 
-def create_scatter_figure(CoV_actin, corr, title, save_location):
+def create_scatter_figure(CoV_actin, corr, title, save_location, csv=True):
     '''
     Plot actin coefficient of variation against cross-correlation values and
     save figure
@@ -142,93 +785,458 @@ def create_scatter_figure(CoV_actin, corr, title, save_location):
         corr (numpy array): Cross-correlation values from another channel
         title (string): Title of figure
         save_location (string): Path to location to save data
+        csv (bool): also save the plotted values as data_<title>.csv
 
     Returns:
         Saves .png file in save_location
     '''
-    fig = plt.figure()
-    plt.scatter(CoV_actin[corr < 0], corr[corr < 0],
-                marker='o', facecolors='none', edgecolors='blue')
-    plt.scatter(CoV_actin[corr >= 0], corr[corr >= 0],
-                marker='o', facecolors='none', edgecolors='red')
-    plt.title(title)
-    plt.xlabel('Actin Coeff of Variation')
-    plt.ylabel('Cross correlation value')
-    plt.xlim((0, 1.5))
-    plt.ylim((-1, 1))
-    # plt.show()
+    # The figure is not registered with pyplot, so figures can be saved from
+    # the writing threads (see CorrWriter)
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    fig = Figure()
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
+    ax.scatter(CoV_actin[corr < 0], corr[corr < 0],
+               marker='o', facecolors='none', edgecolors='blue')
+    ax.scatter(CoV_actin[corr >= 0], corr[corr >= 0],
+               marker='o', facecolors='none', edgecolors='red')
+    ax.set_title(title)
+    ax.set_xlabel('Actin Coeff of Variation')
+    ax.set_ylabel('Cross correlation value')
+    ax.set_xlim((0, 1.5))
+    ax.set_ylim((-1, 1))
     fig.savefig(os.path.join(save_location, title+'.png'))
+    if csv:
+        save_figure_data(CoV_actin, corr, title, save_location)
+
+
+def save_figure_data(CoV_actin, corr, title, save_location):
+    '''
+    Save the values plotted in a figure as data_<title>.csv
+
+    Parameters:
+        CoV_actin (numpy array): coefficient of variation for actin channel
+        corr (numpy array): Cross-correlation values from another channel
+        title (string): Title of figure
+        save_location (string): Path to location to save data
+    '''
     np.savetxt(os.path.join(save_location, 'data_'+title+'.csv'),
                np.vstack((np.ravel(CoV_actin), np.ravel(corr))).T,
                delimiter=',',
                header='Actin Coeff of Variation,Cross correlation value')
-    plt.close()
 
 
-def calculate_and_create_figures(data_path, actin_folder, scalefactor, offset):
+def density_histograms(CoV_actin, corr, bins=DENSITY_BINS):
+    '''
+    Count the pixels of every lag in bins of actin coefficient of variation
+    against correlation, over the axis ranges of the scatter figures. Values
+    outside the ranges are not counted. The correlation bins are split at 0,
+    so the lower half of the bins holds the negative correlations.
+
+    Parameters:
+        CoV_actin (numpy array): coefficient of variation for actin channel
+        corr (numpy array): correlations from another channel [lag,x,y]
+        bins (tuple of ints): number of CoV and (even) correlation bins
+
+    Returns:
+        counts (numpy array): [lag, correlation bin, CoV bin]
+    '''
+    (x_min, x_max), (y_min, y_max) = DENSITY_RANGE
+    n_x, n_y = bins
+    lags = corr.shape[0]
+    x = np.ravel(CoV_actin).astype(np.float64)
+    y = corr.reshape(lags, -1)
+    # NaNs fail both comparisons
+    valid = ((x >= x_min) & (x <= x_max)) & ((y >= y_min) & (y <= y_max))
+    # The upper edges belong to the last bins, as in np.histogram2d
+    x_bin = np.minimum(((x - x_min)*(n_x/(x_max - x_min))).astype(np.intp),
+                       n_x - 1)
+    lag, pixel = np.nonzero(valid)
+    y_bin = np.minimum(((y[lag, pixel] - y_min)*(n_y/(y_max - y_min)))
+                       .astype(np.intp), n_y - 1)
+    counts = np.bincount((lag*n_y + y_bin)*n_x + x_bin[pixel],
+                         minlength=lags*n_y*n_x)
+    return counts.reshape(lags, n_y, n_x)
+
+
+def density_images(counts):
+    '''
+    Colour histograms from density_histograms like the scatter figures:
+    negative correlations blue and positive correlations red, on white. The
+    colour is scaled by the logarithm of the counts relative to the largest
+    count of each lag.
+
+    Parameters:
+        counts (numpy array): [lag, correlation bin, CoV bin]
+
+    Returns:
+        images (numpy array): [lag, correlation bin, CoV bin, RGB]
+    '''
+    peak = np.log1p(counts.max(axis=(1, 2), keepdims=True))
+    level = np.log1p(counts)/np.maximum(peak, 1)
+    colour = np.zeros((counts.shape[1], 1, 3))
+    colour[:counts.shape[1]//2, :, 2] = 1
+    colour[counts.shape[1]//2:, :, 0] = 1
+    return 1 - level[..., np.newaxis]*(1 - colour)
+
+
+def create_density_figures(CoV_actin, corr, title, save_location,
+                           montage=False):
+    '''
+    Plot actin coefficient of variation against cross-correlation values of
+    every lag as 2D histograms, which is much faster than a scatter figure of
+    every pixel. One figure is drawn once and reused for all lags: only the
+    histogram and the title are drawn again for each lag.
+
+    Parameters:
+        CoV_actin (numpy array): coefficient of variation for actin channel
+        corr (numpy array): correlations from another channel [lag,x,y]
+        title (string): Title of figures, the lag is appended
+        save_location (string): Path to location to save data
+        montage (bool): save all lags in one <title>_montage.png instead of
+            a <title>_<lag>.png for each lag
+
+    Returns:
+        files (list of str): names of the .png files saved in save_location
+    '''
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.image import imsave
+    images = density_images(density_histograms(CoV_actin, corr))
+    extent = DENSITY_RANGE[0] + DENSITY_RANGE[1]
+    fig = Figure()
+    canvas = FigureCanvasAgg(fig)
+    if montage:
+        columns = int(np.ceil(np.sqrt(len(images))))
+        rows = int(np.ceil(len(images)/columns))
+        fig.set_size_inches(2*columns + 1, 2*rows + 1)
+        for co, rgb in enumerate(images):
+            ax = fig.add_subplot(rows, columns, co + 1)
+            ax.imshow(rgb, origin='lower', extent=extent, aspect='auto',
+                      interpolation='nearest')
+            ax.set_title('Lag '+str(co), fontsize='small')
+            ax.tick_params(labelsize='x-small')
+            ax.label_outer()
+        fig.subplots_adjust(hspace=0.3, wspace=0.1)
+        fig.suptitle(title)
+        fig.text(0.5, 0.01, 'Actin Coeff of Variation', ha='center')
+        fig.text(0.01, 0.5, 'Cross correlation value', va='center',
+                 rotation='vertical')
+        fig.savefig(os.path.join(save_location, title+'_montage.png'))
+        return [title+'_montage.png']
+    ax = fig.add_subplot()
+    image = ax.imshow(images[0], origin='lower', extent=extent,
+                      aspect='auto', interpolation='nearest')
+    ax.set_xlabel('Actin Coeff of Variation')
+    ax.set_ylabel('Cross correlation value')
+    heading = ax.set_title(title+'_0')
+    # Draw the axes and labels once, without the parts that change
+    image.set_visible(False)
+    heading.set_visible(False)
+    canvas.draw()
+    background = canvas.copy_from_bbox(fig.bbox)
+    image.set_visible(True)
+    heading.set_visible(True)
+    files = []
+    for co, rgb in enumerate(images):
+        canvas.restore_region(background)
+        image.set_data(rgb)
+        heading.set_text(title+'_'+str(co))
+        ax.draw_artist(image)
+        ax.draw_artist(heading)
+        # The histogram covers the inner half of the axes lines
+        for spine in ax.spines.values():
+            ax.draw_artist(spine)
+        imsave(os.path.join(save_location, title+'_'+str(co)+'.png'),
+               np.asarray(canvas.buffer_rgba()))
+        files.append(title+'_'+str(co)+'.png')
+    return files
+
+
+def save_coefficient_of_variation(cov, scalefactor, results_path, im, ch,
+                                  profiler=None, coarse_method='bicubic',
+                                  output_format='files'):
+    '''
+    Save the coefficient of variation of one channel rescaled to the original
+    image size, or at coarse-grained size with output_format 'coarse'
+
+    Parameters:
+        cov (numpy array): coefficient of variation at coarse-grained size
+        scalefactor (float): scale factor the image was downscaled by
+        results_path (str): folder to save results in
+        im (str): image name
+        ch (str): channel name
+        profiler (CorrProfile.Profiler): records the upsample and write stages
+        coarse_method (str): method the image was coarse-grained with
+        output_format (str): 'files' or 'coarse'
+
+    Returns:
+        files (list of str): names of the files saved in results_path
+    '''
+    filename = 'cov_'+im+'_'+ch+'.tif'
+    if output_format == 'coarse':
+        return CorrStore.write_coarse_tiff(
+            os.path.join(results_path, filename), cov, scalefactor,
+            coarse_method, profiler=profiler)
+    with CorrProfile.stage(profiler, 'upsample'):
+        cov_large = upsample(cov, scalefactor, coarse_method)
+    with CorrProfile.stage(profiler, 'write_tiff'):
+        tif.imwrite(os.path.join(results_path, filename), cov_large)
+        CorrProfile.add_bytes_written(
+            profiler, [os.path.join(results_path, filename)])
+    return [filename]
+
+
+def save_windows(array, scalefactor, results_path, filename, profiler=None,
+                 coarse_method='bicubic'):
+    '''
+    Save the CoV maps or correlations of every sliding window rescaled to the
+    original image size
+
+    Parameters:
+        array (numpy array): results at coarse-grained size [window,x,y] or
+            [window,lag,x,y]
+        scalefactor (float): scale factor the image was downscaled by
+        results_path (str): folder to save results in
+        filename (str): name of the .tif file
+        profiler (CorrProfile.Profiler): records the upsample and write stages
+        coarse_method (str): method the image was coarse-grained with
+
+    Returns:
+        files (list of str): names of the files saved in results_path
+    '''
+    with CorrProfile.stage(profiler, 'upsample'):
+        large = upsample(array.reshape((-1,) + array.shape[-2:]),
+                         scalefactor, coarse_method, stack=True)
+        large = large.reshape(array.shape[:-2] + large.shape[-2:])
+    with CorrProfile.stage(profiler, 'write_tiff'):
+        # One page per frame, also for 3 or 4 windows or lags, which tifffile
+        # would otherwise save as the planes of an RGB image
+        tif.imwrite(os.path.join(results_path, filename), large,
+                    photometric='minisblack')
+        CorrProfile.add_bytes_written(
+            profiler, [os.path.join(results_path, filename)])
+    return [filename]
+
+
+def save_significance(pvalue, threshold, scalefactor, results_path, im, pair,
+                      profiler=None, coarse_method='bicubic', used=None):
+    '''
+    Save the p-values of the correlations of a channel pair and its threshold
+    maps rescaled to the original image size, as pvalue_<image>_<pair>.tif
+    and threshold_<image>_<pair>.tif, both [lag,x,y]
+
+    Parameters:
+        pvalue (numpy array): p-values at coarse-grained size [lag,x,y]
+        threshold (numpy array): correlation magnitude with a p-value of
+            CorrSignificance.SIGNIFICANCE_LEVEL at each lag [lag,x,y]
+        scalefactor (float): scale factor the image was downscaled by
+        results_path (str): folder to save results in
+        im (str): image name
+        pair (tuple of str): channel names
+        profiler (CorrProfile.Profiler): records the upsample and write stages
+        coarse_method (str): method the image was coarse-grained with
+        used (dict): surrogate method and number of surrogates the tests
+            used, saved in the image description of both TIFFs
+
+    Returns:
+        files (list of str): names of the files saved in results_path
+    '''
+    metadata = {'CorrAndCov': used} if used else {}
+    files = ['pvalue_'+im+'_'+pair[0]+pair[1]+'.tif',
+             'threshold_'+im+'_'+pair[0]+pair[1]+'.tif']
+    with CorrProfile.stage(profiler, 'upsample'):
+        # Resizing can overshoot the range of p-values
+        pvalue = np.clip(upsample(pvalue, scalefactor, coarse_method,
+                                  stack=True), 0, 1)
+        threshold = upsample(threshold, scalefactor, coarse_method,
+                             stack=True)
+    with CorrProfile.stage(profiler, 'write_tiff'):
+        tif.imwrite(os.path.join(results_path, files[0]), pvalue,
+                    metadata=metadata)
+        tif.imwrite(os.path.join(results_path, files[1]), threshold,
+                    metadata=metadata)
+        CorrProfile.add_bytes_written(
+            profiler, [os.path.join(results_path, f) for f in files])
+    return files
+
+
+def save_cross_correlation(corr, cov_act, scalefactor, results_path, im,
+                           pair, profiler=None, coarse_method='bicubic',
+                           output_format='files', figure_style='scatter'):
+    '''
+    Save the correlation of a channel pair rescaled to the original image size
+    and plot it against the actin coefficient of variation
+
+    Parameters:
+        corr (numpy array): correlation of the pair at coarse-grained size
+        cov_act (numpy array): coefficient of variation for actin channel
+        scalefactor (float): scale factor the images were downscaled by
+        results_path (str): folder to save results in
+        im (str): image name
+        pair (tuple of str): channel names of the correlated images
+        profiler (CorrProfile.Profiler): records the upsample, write and
+            figure stages
+        coarse_method (str): method the images were coarse-grained with
+        output_format (str): 'files', 'coarse' to save the correlations at
+            coarse-grained size (see CorrStore.CoarseTiff), or 'store' to
+            save only the figures, as the correlations are saved in the
+            results store
+        figure_style (str): 'scatter', 'density' or 'montage', see
+            calculate_and_create_figures
+
+    Returns:
+        files (list of str): names of the .tif, .png and .csv files saved in
+        results_path
+    '''
+    files = []
+    if output_format == 'coarse':
+        files = CorrStore.write_coarse_tiff(
+            os.path.join(results_path, 'corr_'+im+'_'+pair[0]+pair[1]+'.tif'),
+            corr, scalefactor, coarse_method, profiler=profiler)
+    elif output_format == 'files':
+        # Rescale corr to original image size
+        with CorrProfile.stage(profiler, 'upsample'):
+            corr_large = upsample(corr, scalefactor, coarse_method,
+                                  stack=True)
+        filename = 'corr_'+im+'_'+pair[0]+pair[1]+'.tif'
+        with CorrProfile.stage(profiler, 'write_tiff'):
+            tif.imwrite(os.path.join(results_path, filename), corr_large)
+            CorrProfile.add_bytes_written(
+                profiler, [os.path.join(results_path, filename)])
+        files = [filename]
+    if pair[0] != pair[1]:
+        figures = []
+        csv = output_format != 'store'
+        with CorrProfile.stage(profiler, 'figures'):
+            if figure_style != 'scatter':
+                figures += create_density_figures(
+                    cov_act, corr, 'CoVA_CC_'+im+'_'+pair[0]+pair[1],
+                    results_path, montage=figure_style == 'montage')
+            for co in range(corr.shape[0]):
+                title = 'CoVA_CC_'+im+'_'+pair[0]+pair[1]+'_'+str(co)
+                if figure_style == 'scatter':
+                    create_scatter_figure(cov_act, corr[co, ...], title,
+                                          results_path, csv=csv)
+                    figures.append(title+'.png')
+                elif csv:
+                    save_figure_data(cov_act, corr[co, ...], title,
+                                     results_path)
+                if csv:
+                    figures.append('data_'+title+'.csv')
+            CorrProfile.add_bytes_written(
+                profiler, [os.path.join(results_path, f) for f in figures])
+        files += figures
+    return files
+
+
+def store_parameters(data_path, image, actin_folder, scalefactor, offset,
+                     coarse_method, dtype):
+    '''
+    Returns:
+        params (dict): run parameters saved in a results store
+    '''
+    return {'data_path': os.path.abspath(data_path), 'image': image,
+            'actin_folder': actin_folder, 'scalefactor': scalefactor,
+            'offset': offset, 'coarse_method': coarse_method,
+            'dtype': np.dtype(dtype).name}
+
+
+def channel_pairs(channels):
+    '''
+    Channel combinations to correlate, including auto-correlations
+
+    Parameters:
+        channels (list of str): channel names
+
+    Returns:
+        pairs (set of tuples): each pair sorted in reverse order
+    '''
+    combinations = [tuple(sorted((f, s), reverse=True))
+                    for f in channels
+                    for s in channels]
+    return set(combinations)
+
+
+def pyramid_levels(image, scalefactors, coarse_method='bicubic'):
+    '''
+    Coarse-grain an image at several scale factors, without normalising. A
+    block-mean level is averaged from the coarsest level already made whose
+    blocks tile it exactly, which gives the same result as averaging the raw
+    image at a fraction of the cost. Bicubic levels are always resized from
+    the raw image, as resizing twice would change the result.
+
+    Parameters:
+        image (array): raw image with dimensions [t,x,y]
+        scalefactors (list of float): scale factors to downsize image by
+        coarse_method (str): see coarse_grain_stack
+
+    Returns:
+        levels (dict): coarse-grained image of each scale factor [t,x,y]
+    '''
+    levels = {}
+    for scalefactor in sorted(set(scalefactors), reverse=True):
+        if coarse_method == 'bicubic':
+            levels[scalefactor] = imresize(image, scalar_scale=scalefactor,
+                                           stack=True, mode='matrix')
+            continue
+        shape = tuple(int(np.ceil(scalefactor * n)) for n in image.shape[1:])
+        # Levels made of equal blocks of the raw image that divide into
+        # equal blocks of this level
+        finer = [level for level in levels.values()
+                 if all(n % m == 0 and m % o == 0 for n, m, o in zip(
+                     image.shape[1:], level.shape[1:], shape))]
+        if finer:
+            source = min(finer, key=lambda level: level[0].size)
+            levels[scalefactor] = block_mean(source, None,
+                                             output_shape=shape)
+        else:
+            levels[scalefactor] = block_mean(image, scalefactor)
+    return levels
+
+
+def calculate_and_create_figures(data_path, actin_folder, scalefactor, offset,
+                                 profiler=None, progress=None, **options):
     '''
     Read in data, calculate auto- and cross-correlation and coefficient of
-    variance, output images and figures of results.
+    variance, output images and figures of results. The run is made of the
+    units of CorrRun.plan_units, run in this process, in a pool of processes
+    or through a queue.
 
     Parameters:
         data_path (str): path to folder where data is stored
         actin_folder (str): name of folder containing actin images
-        scalefactor (float): scale factor to downscale image by
-        offset (int): shift in pixels relative to the reference image
+        scalefactor (float or list of floats): scale factor to downscale
+            image by
+        offset (int or list of ints): shift in pixels relative to the
+            reference image
+        profiler (CorrProfile.Profiler): records time, CPU time, bytes read
+            and written and peak memory of each stage, image and channel
+            pair. The report is saved as CorrAndCov_profile.json and .csv in
+            the output folder.
+        progress (CorrProgress.Progress): reports each step and the time
+            remaining, and stops the run with CorrProgress.Cancelled between
+            steps when it is cancelled. Outputs already saved are kept.
+        options: other parameters of CorrRun.Options, e.g. output_path,
+            workers or surrogates
 
     Returns:
-        Saves .png files in folder above data folder
+        Saves .png files in output_path
     '''
-    try:
-        # run steps
-        image_dict = create_image_dictionary(data_path, scalefactor)
-        for im in image_dict.keys():
-            results_path = os.path.join(os.path.dirname(data_path), 'corr_'+im)
-            if not os.path.exists(results_path):
-                os.makedirs(results_path)
-            for ch in image_dict[im].keys():
-                cov = coefficient_of_variation(image_dict[im][ch], scalefactor)
-                tif.imsave(os.path.join(
-                    results_path, 'cov_'+im+'_'+ch+'.tif'),
-                           imresize(cov, scalar_scale=1/scalefactor))
-                if ch == actin_folder:
-                    cov_act = cov
-            combinations = [tuple(sorted((f, s), reverse=True))
-                            for f in image_dict[im].keys()
-                            for s in image_dict[im].keys()]
-            for c in set(combinations):
-                corr = cross_correlation(
-                    image_dict[im][c[0]],
-                    image_dict[im][c[1]],
-                    scalefactor,
-                    offset)
-                # Rescale corr to original image size
-                corr_large = np.zeros([corr.shape[0],
-                                      int(corr.shape[1]/scalefactor),
-                                      int(corr.shape[2]/scalefactor)])
-                for i in range(corr.shape[0]):
-                    corr_large[i, ...] = imresize(corr[i, ...],
-                                                  scalar_scale=1/scalefactor)
-                tif.imsave(os.path.join(results_path, 'corr_'
-                           + im+'_'+c[0]+c[1]+'.tif'), corr_large
-                           )
-                for co in range(corr.shape[0]):
-                    if c[0] != c[1]:
-                        title = 'CoVA_CC_'+im+'_'+c[0]+c[1]+'_'+str(co)
-                        create_scatter_figure(
-                            cov_act, corr[co, ...], title, results_path)
-    finally:
-        print('Complete')
-
-
-def main():
-    data_path = '/home/laura/WMS_Files/ProjectSupport/DK_Corr/' \
-                '3011_ATP_Example/data files'
-    scalefactor = 0.25
-    offset = 10
-    actin_folder = 'actin'
-    calculate_and_create_figures(data_path, actin_folder, scalefactor, offset)
+    import CorrRun
+    CorrRun.run(CorrRun.Options(data_path, actin_folder, scalefactor, offset,
+                                **options), profiler, progress)
+
+
+
+def main(argv=None):
+    '''
+    Run from the command line, see python CorrAndCov.py --help
+    '''
+    import CorrAndCov
+    return CorrAndCov.run_batch(argv)
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
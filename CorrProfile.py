@@ -0,0 +1,186 @@
+import os
+import csv
+import json
+import time
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+
+# Returned by stage when profiling is disabled, so it costs next to nothing
+NULL_STAGE = nullcontext()
+
+
+class Profiler:
+    '''
+    Records wall time, CPU time, bytes read and written and peak memory of each
+    stage of an analysis. Stages can be nested and labelled, e.g. with the
+    image, channel or channel pair they work on; nested stages inherit the
+    labels of the stages around them.
+
+    Parameters:
+        callback (callable): called with each record as it is completed
+        trace_memory (bool): measure peak memory with tracemalloc, which slows
+            down memory allocation several times over, so it is off by
+            default. Peak memory is per stage from Python 3.9, before that it
+            is the peak since profiling started.
+        thread (bool): record the CPU time of the calling thread only, for
+            stages run in a background thread while other threads calculate.
+            By default the CPU time of the whole process is recorded.
+    '''
+
+    def __init__(self, callback=None, trace_memory=False, thread=False):
+        self.callback = callback
+        self.trace_memory = trace_memory
+        self.cpu_clock = time.thread_time if thread else time.process_time
+        self.records = []
+        self.active = []
+        self.started_tracing = False
+
+    @contextmanager
+    def stage(self, name, **labels):
+        '''
+        Context manager recording one stage
+
+        Parameters:
+            name (str): stage name
+            labels: image, channel, pair etc. the stage works on
+        '''
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.started_tracing = True
+        inherited = {}
+        if self.active:
+            parent = self.active[-1]
+            inherited = {key: parent[key] for key in parent['labels']}
+        inherited.update(labels)
+        record = dict(inherited)
+        record.update({'stage': name, 'labels': list(inherited),
+                       'bytes_read': 0, 'bytes_written': 0,
+                       'peak_memory': None})
+        if self.active:
+            record['parent'] = parent['stage']
+        self.update_peaks()
+        self.active.append(record)
+        start_wall = time.perf_counter()
+        start_cpu = self.cpu_clock()
+        try:
+            yield record
+        finally:
+            record['wall_time'] = time.perf_counter() - start_wall
+            record['cpu_time'] = self.cpu_clock() - start_cpu
+            self.update_peaks()
+            self.active.pop()
+            if not self.active and self.started_tracing:
+                tracemalloc.stop()
+                self.started_tracing = False
+            del record['labels']
+            self.add(record)
+
+    def update_peaks(self):
+        '''
+        Fold the tracemalloc peak into every active stage and start measuring
+        a new peak
+        '''
+        if not (self.trace_memory and tracemalloc.is_tracing()):
+            return
+        peak = tracemalloc.get_traced_memory()[1]
+        for record in self.active:
+            record['peak_memory'] = max(record['peak_memory'] or 0, peak)
+        if hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+
+    def add(self, record):
+        '''
+        Add a completed record, e.g. one returned by a worker process
+
+        Parameters:
+            record (dict): stage record
+        '''
+        self.records.append(record)
+        if self.callback is not None:
+            self.callback(record)
+
+    def write(self, path):
+        '''
+        Save the records as path.json and path.csv
+
+        Parameters:
+            path (str): location of the report without extension
+        '''
+        with open(path+'.json', 'w') as f:
+            json.dump(self.records, f, indent=1)
+        fields = []
+        for record in self.records:
+            fields += [key for key in record if key not in fields]
+        with open(path+'.csv', 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=fields)
+            writer.writeheader()
+            writer.writerows(self.records)
+
+
+def stage(profiler, name, **labels):
+    '''
+    Profile a stage if profiler is not None
+
+    Parameters:
+        profiler (Profiler): profiler or None to skip profiling
+        name (str): stage name
+        labels: image, channel, pair etc. the stage works on
+
+    Returns:
+        context manager recording the stage
+    '''
+    if profiler is None:
+        return NULL_STAGE
+    return profiler.stage(name, **labels)
+
+
+def add_bytes_read(profiler, paths):
+    '''
+    Add the size of files read to the current stage of profiler and the
+    stages around it
+
+    Parameters:
+        profiler (Profiler): profiler or None to skip profiling
+        paths (list of str): locations of files read
+    '''
+    if profiler is not None:
+        size = sum(os.path.getsize(path) for path in paths)
+        for record in profiler.active:
+            record['bytes_read'] += size
+
+
+def add_bytes_written(profiler, paths):
+    '''
+    Add the size of files written to the current stage of profiler and the
+    stages around it
+
+    Parameters:
+        profiler (Profiler): profiler or None to skip profiling
+        paths (list of str): locations of files written
+    '''
+    if profiler is not None:
+        size = sum(os.path.getsize(path) for path in paths)
+        for record in profiler.active:
+            record['bytes_written'] += size
+
+
+def call_with_profiler(function, trace_memory, *args):
+    '''
+    Process pool entry point: call function(*args, profiler=...) with a new
+    Profiler unless trace_memory is None, so its records can be returned to
+    the main process
+
+    Parameters:
+        function (callable): function taking a profiler keyword argument
+        trace_memory (bool): trace_memory of the Profiler, None to skip
+            profiling
+
+    Returns:
+        output: return value of function
+        records (list of dict): stage records, empty without profiling
+    '''
+    if trace_memory is None:
+        return function(*args, profiler=None), []
+    profiler = Profiler(trace_memory=trace_memory)
+    output = function(*args, profiler=profiler)
+    return output, profiler.records
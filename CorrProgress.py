@@ -0,0 +1,119 @@
+import time
+
+
+class Cancelled(Exception):
+    '''
+    Raised between steps of a run that has been cancelled
+    '''
+
+
+class Progress:
+    '''
+    Counts the steps of an analysis (coarse-graining of each channel, each CoV
+    map, the correlations of each image and the outputs of each channel pair),
+    estimates the time remaining and checks for cancellation between steps.
+
+    Parameters:
+        callback (callable): called after each step with the number of steps
+            done, the total number of steps, a description of the step and
+            the estimated seconds remaining (None before the first step)
+        cancel (callable): returns True when the run should stop, e.g. the
+            is_set method of a threading.Event
+    '''
+
+    def __init__(self, callback=None, cancel=None):
+        self.callback = callback
+        self.cancel = cancel
+        self.total = 0
+        self.done = 0
+        self.start_time = None
+
+    def start(self, total):
+        '''
+        Start counting
+
+        Parameters:
+            total (int): number of steps in the run
+        '''
+        self.total = total
+        self.done = 0
+        self.start_time = time.perf_counter()
+        self.report('Starting')
+
+    def remaining(self):
+        '''
+        Returns:
+            seconds (float): estimated time remaining, assuming the remaining
+            steps take as long on average as the steps done so far, None
+            before the first step
+        '''
+        if not self.done:
+            return None
+        elapsed = time.perf_counter() - self.start_time
+        return elapsed/self.done*max(self.total - self.done, 0)
+
+    def report(self, message):
+        if self.callback is not None:
+            self.callback(self.done, self.total, message, self.remaining())
+
+    def check(self):
+        '''
+        Raise Cancelled if the run has been cancelled
+        '''
+        if self.cancel is not None and self.cancel():
+            raise Cancelled()
+
+    def step(self, message):
+        '''
+        Count a completed step, then check for cancellation
+
+        Parameters:
+            message (str): description of the step, e.g. image and channel
+        '''
+        self.done += 1
+        self.report(message)
+        self.check()
+
+
+def start(progress, total):
+    '''
+    Start progress if it is not None
+
+    Parameters:
+        progress (Progress): progress or None to skip reporting
+        total (int): number of steps in the run
+    '''
+    if progress is not None:
+        progress.start(total)
+
+
+def check(progress):
+    '''
+    Raise Cancelled if progress is not None and the run has been cancelled
+    '''
+    if progress is not None:
+        progress.check()
+
+
+def step(progress, message):
+    '''
+    Count a completed step of progress if it is not None
+
+    Parameters:
+        progress (Progress): progress or None to skip reporting
+        message (str): description of the step
+    '''
+    if progress is not None:
+        progress.step(message)
+
+
+def format_time(seconds):
+    '''
+    Returns:
+        text (str): seconds as h:mm:ss, or an empty string if unknown
+    '''
+    if seconds is None:
+        return ''
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    return '{}:{:02d}:{:02d}'.format(hours, minutes, seconds)
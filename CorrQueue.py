@@ -0,0 +1,349 @@
+import os
+import json
+import time
+import uuid
+import socket
+import threading
+import traceback
+import CorrProgress
+
+# Folder of the queue in the output folder
+QUEUE_NAME = 'CorrAndCov_queue'
+# Seconds without a heartbeat after which a claimed unit is taken over, as its
+# worker is assumed to have crashed
+STALE_TIME = 600
+# Seconds between checks for claimable units while waiting for other workers
+POLL_INTERVAL = 5
+# Times a failed unit is tried again before it is given up
+RETRIES = 2
+
+
+def is_running(pid):
+    '''
+    Returns:
+        running (bool): False if no process of this machine has id pid. Always
+        True where this cannot be checked without signalling the process.
+    '''
+    if os.name != 'posix':
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class QueueError(Exception):
+    '''
+    Raised at the end of a run when units of the queue failed
+    '''
+
+
+class Queue:
+    '''
+    A queue of work units kept as files in a folder, shared by any number of
+    worker processes on any number of machines with the folder on a shared
+    filesystem. A worker claims a unit by creating its claim file with
+    O_CREAT | O_EXCL, which only one worker can do, and completes it by
+    writing its done file. While a unit runs its claim is touched every
+    stale_time/4 seconds; a claim that has not been touched for stale_time
+    seconds, or whose process on the same machine has stopped, is taken over
+    by another worker. A unit that raises is tried again, up to retries
+    times, then given up along with the units that depend on it. A run
+    restarted on the same folder only runs the units that are not done.
+
+    Parameters:
+        path (str): folder of the queue
+        units (list of dicts): units to run, in the order they are claimed,
+            each with an 'id' (a valid filename) and the ids of the units it
+            runs 'after'. Only used if the queue does not exist yet.
+        params (dict): parameters the units were made with. Workers with
+            other parameters are refused.
+        retries (int): times a failed unit is tried again
+        stale_time (float): seconds without a heartbeat after which a claim is
+            taken over
+
+    Attributes:
+        units (list of dicts): units of the queue
+        params (dict): parameters of the queue
+    '''
+
+    def __init__(self, path, units=None, params=None, retries=RETRIES,
+                 stale_time=STALE_TIME):
+        self.path = path
+        self.retries = retries
+        self.stale_time = stale_time
+        for folder in ('claims', 'done', 'failed', 'arrays'):
+            os.makedirs(os.path.join(path, folder), exist_ok=True)
+        ledger = os.path.join(path, 'units.json')
+        if units is not None and not os.path.exists(ledger):
+            # Workers starting together write the same ledger
+            tmp = ledger+'.'+uuid.uuid4().hex
+            with open(tmp, 'w') as f:
+                json.dump({'params': params, 'units': units}, f, indent=1)
+            os.replace(tmp, ledger)
+        with open(ledger) as f:
+            contents = json.load(f)
+        if params is not None and contents['params'] != json.loads(
+                json.dumps(params)):
+            raise ValueError('the queue in '+path+' was made with other '
+                             'parameters, remove it or use another folder')
+        self.units = contents['units']
+        self.params = contents['params']
+        self.token = None
+
+    def marker(self, folder, unit_id):
+        return os.path.join(self.path, folder, unit_id)
+
+    def is_done(self, unit_id):
+        return os.path.exists(self.marker('done', unit_id))
+
+    def attempts(self, unit_id, failed=None):
+        '''
+        Returns:
+            attempts (int): number of times the unit failed
+        '''
+        if failed is None:
+            failed = os.listdir(os.path.join(self.path, 'failed'))
+        return sum(1 for name in failed
+                   if name.rsplit('.', 1)[0] == unit_id)
+
+    def states(self):
+        '''
+        Returns:
+            states (dict): 'done', 'given up', 'blocked' (after a unit that was
+            given up), 'claimed' or 'pending' for the id of each unit
+        '''
+        done = set(os.listdir(os.path.join(self.path, 'done')))
+        claimed = set(os.listdir(os.path.join(self.path, 'claims')))
+        failed = os.listdir(os.path.join(self.path, 'failed'))
+        states = {}
+        for unit in self.units:
+            unit_id = unit['id']
+            if unit_id in done:
+                states[unit_id] = 'done'
+            elif self.attempts(unit_id, failed) > self.retries:
+                states[unit_id] = 'given up'
+            elif any(states.get(after) in ('given up', 'blocked')
+                     for after in unit['after']):
+                states[unit_id] = 'blocked'
+            elif unit_id in claimed:
+                states[unit_id] = 'claimed'
+            else:
+                states[unit_id] = 'pending'
+        return states
+
+    def claim(self, unit_id):
+        '''
+        Returns:
+            claimed (bool): True if this worker now holds the unit
+        '''
+        path = self.marker('claims', unit_id)
+        token = uuid.uuid4().hex
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            if not self.release_stale(path):
+                return False
+            try:
+                fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                return False
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'token': token, 'host': socket.gethostname(),
+                       'pid': os.getpid(), 'time': time.time()}, f)
+        # Done by another worker between listing and claiming
+        if self.is_done(unit_id):
+            os.remove(path)
+            return False
+        self.token = token
+        return True
+
+    def is_stale(self, path):
+        '''
+        Returns:
+            stale (bool): True if the claim in path has not been touched for
+            stale_time seconds, or was made by a process of this machine that
+            has stopped
+        '''
+        try:
+            if time.time() - os.path.getmtime(path) >= self.stale_time:
+                return True
+            with open(path) as f:
+                claim = json.load(f)
+        except (IOError, ValueError):
+            # Missing, or still being written
+            return False
+        return (claim['host'] == socket.gethostname()
+                and not is_running(claim['pid']))
+
+    def release_stale(self, path):
+        '''
+        Remove a stale claim
+
+        Returns:
+            released (bool): True if the claim was removed
+        '''
+        if not self.is_stale(path):
+            return False
+        # Only one worker can move the claim away
+        moved = path+'.'+uuid.uuid4().hex
+        try:
+            os.rename(path, moved)
+        except FileNotFoundError:
+            return False
+        if not self.is_stale(moved):
+            # A fresh claim made since the check, put it back
+            try:
+                os.link(moved, path)
+            except FileExistsError:
+                pass
+            os.remove(moved)
+            return False
+        os.remove(moved)
+        return True
+
+    def owns(self, unit_id):
+        try:
+            with open(self.marker('claims', unit_id)) as f:
+                return json.load(f)['token'] == self.token
+        except (IOError, ValueError):
+            return False
+
+    def release(self, unit_id):
+        if self.owns(unit_id):
+            os.remove(self.marker('claims', unit_id))
+        self.token = None
+
+    def heartbeat(self, unit_id, finished):
+        '''
+        Touch the claim of a running unit until finished is set
+        '''
+        while not finished.wait(self.stale_time/4):
+            if self.owns(unit_id):
+                os.utime(self.marker('claims', unit_id))
+
+    def complete(self, unit_id, result):
+        '''
+        Record a unit as done with its result, which must be JSON
+        serialisable
+        '''
+        path = self.marker('done', unit_id)
+        with open(path+'.'+self.token, 'w') as f:
+            json.dump({'result': result, 'host': socket.gethostname(),
+                       'pid': os.getpid(), 'time': time.time()}, f)
+        os.replace(path+'.'+self.token, path)
+        self.release(unit_id)
+
+    def fail(self, unit_id, error):
+        '''
+        Record a failed attempt of a unit with its traceback
+        '''
+        path = self.marker('failed', unit_id)+'.'+self.token
+        with open(path, 'w') as f:
+            f.write(socket.gethostname()+' '+str(os.getpid())+'\n'+error)
+        self.release(unit_id)
+
+    def result(self, unit_id):
+        '''
+        Returns:
+            result: the result the unit was completed with
+        '''
+        with open(self.marker('done', unit_id)) as f:
+            return json.load(f)['result']
+
+    def next_unit(self):
+        '''
+        Claim the first pending unit whose units to run after are done
+
+        Returns:
+            unit (dict): the claimed unit, None if no unit can be claimed now
+        '''
+        states = self.states()
+        for unit in self.units:
+            if states[unit['id']] != 'pending' and not (
+                    states[unit['id']] == 'claimed' and self.is_stale(
+                        self.marker('claims', unit['id']))):
+                continue
+            if all(states[after] == 'done' for after in unit['after']) and (
+                    self.claim(unit['id'])):
+                return unit
+        return None
+
+    def work(self, execute, progress=None, poll_interval=POLL_INTERVAL,
+             stop=None):
+        '''
+        Run units until every unit is done or given up, waiting for units
+        claimed by other workers
+
+        Parameters:
+            execute (callable): runs a unit, called as execute(unit), and
+                returns its result
+            progress (CorrProgress.Progress): counts each unit run by this
+                worker, and stops it between units when cancelled
+            poll_interval (float): seconds between checks for claimable units
+            stop (callable): returns True to stop after the current unit
+
+        Returns:
+            counts (dict): number of units done and failed by this worker
+        '''
+        counts = {'done': 0, 'failed': 0}
+        CorrProgress.start(progress, sum(
+            1 for state in self.states().values()
+            if state in ('pending', 'claimed')))
+        while stop is None or not stop():
+            CorrProgress.check(progress)
+            unit = self.next_unit()
+            if unit is None:
+                if all(state in ('done', 'given up', 'blocked')
+                       for state in self.states().values()):
+                    break
+                time.sleep(poll_interval)
+                continue
+            finished = threading.Event()
+            beat = threading.Thread(target=self.heartbeat,
+                                    args=(unit['id'], finished), daemon=True)
+            beat.start()
+            try:
+                result = execute(unit)
+            except Exception:
+                self.fail(unit['id'], traceback.format_exc())
+                counts['failed'] += 1
+                CorrProgress.step(progress, 'Failed '+unit['id'])
+                continue
+            finally:
+                finished.set()
+                beat.join()
+            self.complete(unit['id'], result)
+            counts['done'] += 1
+            CorrProgress.step(progress, 'Finished '+unit['id'])
+        return counts
+
+    def check(self):
+        '''
+        Raises:
+            QueueError: if units were given up, with their last error
+        '''
+        states = self.states()
+        given_up = [unit_id for unit_id, state in states.items()
+                    if state == 'given up']
+        if not given_up:
+            return
+        errors = []
+        failed = sorted(os.listdir(os.path.join(self.path, 'failed')),
+                        key=lambda name: os.path.getmtime(
+                            os.path.join(self.path, 'failed', name)))
+        for unit_id in given_up:
+            last = [name for name in failed
+                    if name.rsplit('.', 1)[0] == unit_id][-1]
+            with open(os.path.join(self.path, 'failed', last)) as f:
+                lines = f.read().strip().splitlines()
+            errors.append(unit_id+': '+lines[-1])
+        blocked = sum(1 for state in states.values() if state == 'blocked')
+        raise QueueError(
+            str(len(given_up))+' units failed '+str(self.retries + 1)
+            + ' times and '+str(blocked)+' units depending on them were not '
+            'run. Remove '+os.path.join(self.path, 'failed')+' to try them '
+            'again.\n'+'\n'.join(errors))
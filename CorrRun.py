@@ -0,0 +1,1181 @@
+import os
+import shutil
+import tempfile
+import uuid
+from concurrent.futures import Future
+import numpy as np
+import CorrCache
+import CorrFunctions
+import CorrProfile
+import CorrProgress
+import CorrStore
+import CorrWriter
+
+
+class Options:
+    '''
+    Parameters of a run of the analysis, checked when they are made
+
+    Parameters:
+        data_path (str): path to folder where data is stored
+        actin_folder (str): name of folder containing actin images
+        scalefactor (float or list of floats): scale factor to downscale
+            image by
+        offset (int or list of ints): shift in pixels relative to the
+            reference image. If scalefactor or offset is a list, every
+            combination is calculated with run_sweep and saved in its own
+            scale<scalefactor>_offset<offset> folder. Sweeps run in this
+            process, and cannot stream or use cache_path.
+        output_path (str): folder to save the corr_<image> folders in, None
+            for the folder above the data folder
+        images (list of str): filenames of the images to process, None for
+            every image in the first channel folder
+        stream (bool): coarse-grain images frame by frame while reading, for
+            stacks that do not fit in memory
+        workers (int): number of processes to run the units of the images
+            on (see plan_units), 1 runs everything in this process. Sweeps
+            and sliding windows always run in this process; a message says
+            so.
+        online (bool): accumulate CoV and correlations frame by frame while
+            reading, so memory does not grow with the number of frames.
+            Cannot be used in sweeps or sliding windows.
+        cache_path (str): folder to keep coarse-grained images in between
+            runs. Outputs already saved with the same parameters are then
+            not saved again. None reads and saves everything.
+        coarse_method (str): 'bicubic' to coarse-grain with MATLAB-style
+            resizing, or 'block' to average blocks of pixels and upsample
+            results by repeating each coarse pixel over its block
+        dtype (numpy dtype or str): float64, or float32 to halve memory use
+            and the size of the saved TIFFs. Correlations and CoV maps of a
+            float32 run differ from float64 by at most about
+            CorrFunctions.FLOAT32_TOLERANCE.
+        memory_budget (int): bytes of working memory for the correlations of
+            an image (per process). The field of view is then correlated in
+            spatial tiles that fit the budget. Not used by online runs, whose
+            memory is already independent of the number of frames.
+        output_buffer (int): bytes of results that can wait to be written
+            while the next results are calculated (see CorrWriter). 0 writes
+            each output before continuing. Outputs that fail are reported
+            together with CorrWriter.WriteError at the end of the run. Runs
+            with more than one worker write in the worker processes instead.
+        output_format (str): 'files' saves upsampled CoV and correlation
+            TIFFs and a CSV of the values of each figure. 'store' saves the
+            CoV maps, correlations at coarse-grained size and the parameters
+            of each image in one compressed results_<image>.npz instead (see
+            CorrStore.ResultsStore to read it). 'coarse' saves the CoV and
+            correlation TIFFs at coarse-grained size with the scale factor
+            and coarse_method, a 1/scalefactor**2 of the size, to be
+            upsampled only where they are read (see CorrStore.CoarseTiff),
+            and the CSV files. Figures are saved in every format.
+        figure_style (str): 'scatter' plots every pixel for each lag,
+            'density' plots 2D histograms of CoV against correlation for each
+            lag, which is much faster for large images and many lags, and
+            'montage' plots the histograms of all lags of a channel pair in
+            one figure.
+        window (int): frames in each sliding time window. The CoV and
+            correlations of each window are then saved instead of those of
+            the whole movie (see run_windows), in this process. Cannot be
+            used with memory_budget, or an output_format or figure_style
+            other than the defaults.
+        stride (int): frames between the starts of consecutive windows, None
+            for windows that do not overlap
+        surrogates (int): number of surrogates to test the correlations of
+            each pair of different channels against. The p-values of every
+            pixel and lag are saved as pvalue_<image>_<pair>.tif, and the
+            correlation needed for a p-value of 0.05 as
+            threshold_<image>_<pair>.tif (see CorrSignificance). 0 for no
+            significance tests. Cannot be used in online runs, sweeps or
+            sliding windows.
+        surrogate_method (str): 'shift' for circular time shifts of the
+            second channel, which need movies of at least 3*offset+19
+            frames, or 'phase' for phase-randomised copies of it
+        queue_path (str): folder of a CorrQueue to run the work through, ''
+            for CorrAndCov_queue in output_path. Runs started with the same
+            parameters and queue_path, on this or other machines sharing the
+            folder, share the work; a run restarted after a crash only runs
+            what is not done, and units that fail are tried again (see
+            run_from_queue). Cannot be used in sweeps or sliding windows.
+            None runs without a queue.
+
+    Attributes:
+        the parameters, with output_path and queue_path filled in and dtype
+        a numpy dtype, and
+        sweep (bool): whether scalefactor or offset is a list
+        channels (list of str): channel folders in data_path
+    '''
+
+    def __init__(self, data_path, actin_folder, scalefactor, offset,
+                 output_path=None, images=None, stream=False, workers=1,
+                 online=False, cache_path=None, coarse_method='bicubic',
+                 dtype=np.float64, memory_budget=None,
+                 output_buffer=CorrWriter.BUFFER_BYTES, output_format='files',
+                 figure_style='scatter', window=None, stride=None,
+                 surrogates=0, surrogate_method='shift', queue_path=None):
+        if output_path is None:
+            output_path = os.path.dirname(data_path)
+        dtype = np.dtype(dtype)
+        if dtype.name not in CorrFunctions.DTYPES:
+            raise ValueError('dtype should be one of '
+                             + ', '.join(CorrFunctions.DTYPES))
+        if figure_style not in CorrFunctions.FIGURE_STYLES:
+            raise ValueError('figure_style should be one of '
+                             + ', '.join(CorrFunctions.FIGURE_STYLES))
+        if output_format not in CorrFunctions.OUTPUT_FORMATS:
+            raise ValueError('output_format should be one of '
+                             + ', '.join(CorrFunctions.OUTPUT_FORMATS))
+        sweep = (isinstance(scalefactor, (list, tuple))
+                 or isinstance(offset, (list, tuple)))
+        if window is not None and sweep:
+            raise ValueError('sliding windows are not supported in sweeps')
+        if window is not None and (output_format != 'files'
+                                   or figure_style != 'scatter'
+                                   or memory_budget is not None):
+            raise ValueError('sliding windows are only saved as TIFF files, '
+                             'without figures or a memory budget')
+        if sweep and (stream or cache_path is not None):
+            raise ValueError('streaming and caching are not supported in '
+                             'sweeps')
+        if online and (sweep or window is not None):
+            raise ValueError('online runs are not supported in sweeps or '
+                             'sliding windows')
+        if surrogates and (online or window is not None or sweep):
+            raise ValueError('surrogates are not supported in online runs, '
+                             'sweeps or sliding windows')
+        if queue_path is not None and (window is not None or sweep):
+            raise ValueError('queues are not supported in sweeps or sliding '
+                             'windows')
+        if workers > 1 and (sweep or window is not None):
+            print('Sweeps and sliding windows run in this process, workers '
+                  'is not used')
+        if queue_path == '':
+            import CorrQueue
+            queue_path = os.path.join(output_path, CorrQueue.QUEUE_NAME)
+        self.data_path = data_path
+        self.actin_folder = actin_folder
+        self.scalefactor = scalefactor
+        self.offset = offset
+        self.output_path = output_path
+        self.images = images
+        self.stream = stream
+        self.workers = workers
+        self.online = online
+        self.cache_path = cache_path
+        self.coarse_method = coarse_method
+        self.dtype = dtype
+        self.memory_budget = memory_budget
+        self.output_buffer = output_buffer
+        self.output_format = output_format
+        self.figure_style = figure_style
+        self.window = window
+        self.stride = stride
+        self.surrogates = surrogates
+        self.surrogate_method = surrogate_method
+        self.queue_path = queue_path
+        self.sweep = sweep
+        self.channels = CorrFunctions.get_names(data_path)[0]
+
+    def params(self):
+        '''
+        Returns:
+            params (dict): the parameters the results depend on, for the
+            params of a CorrQueue. Stream, cache_path and memory_budget can
+            differ between the runs sharing a queue.
+        '''
+        images = self.images
+        if images is not None:
+            images = sorted(images)
+        return {'data_path': os.path.abspath(self.data_path),
+                'output_path': os.path.abspath(self.output_path),
+                'actin_folder': self.actin_folder,
+                'scalefactor': self.scalefactor, 'offset': self.offset,
+                'online': self.online, 'coarse_method': self.coarse_method,
+                'dtype': self.dtype.name,
+                'output_format': self.output_format,
+                'figure_style': self.figure_style,
+                'surrogates': self.surrogates,
+                'surrogate_method': self.surrogate_method,
+                'channels': sorted(self.channels), 'images': images}
+
+
+class Arrays:
+    '''
+    Coarse-grained images, CoV maps and correlations passed from the units
+    that make them to the units that use them, either kept in memory or
+    saved as .npy files, memory-mapped when loaded, to share them with other
+    processes and machines. Memory-mapped files are read from the page cache
+    without copying, and /dev/shm is often too small for shared memory.
+
+    Parameters:
+        folder (str): folder to save the arrays in, None to keep them in
+            memory
+    '''
+
+    def __init__(self, folder=None):
+        self.folder = folder
+        self.arrays = {}
+        if folder is not None:
+            os.makedirs(folder, exist_ok=True)
+
+    def path(self, name):
+        return os.path.join(self.folder, name+'.npy')
+
+    def __contains__(self, name):
+        if self.folder is None:
+            return name in self.arrays
+        return os.path.exists(self.path(name))
+
+    def save(self, name, array):
+        if self.folder is None:
+            self.arrays[name] = array
+        else:
+            np.save(self.path(name), array)
+
+    def empty(self, name, shape, dtype):
+        '''
+        Returns:
+            array (numpy array): new array to fill, memory-mapped to its file
+            when saved in a folder
+        '''
+        if self.folder is None:
+            self.arrays[name] = np.empty(shape, dtype=dtype)
+            return self.arrays[name]
+        return np.lib.format.open_memmap(self.path(name), mode='w+',
+                                         dtype=dtype, shape=shape)
+
+    def load(self, name):
+        if self.folder is None:
+            return self.arrays[name]
+        return np.load(self.path(name), mmap_mode='r')
+
+
+def results_folder(output_path, im):
+    '''
+    Create, if needed, the folder results for an image are saved in
+
+    Parameters:
+        output_path (str): folder to save results in, by default the folder
+            above the data folder
+        im (str): image name without extension
+
+    Returns:
+        results_path (str): corr_<image> folder in output_path
+    '''
+    results_path = os.path.join(output_path, 'corr_'+im)
+    if not os.path.exists(results_path):
+        os.makedirs(results_path)
+    return results_path
+
+
+def output_signatures(options, image):
+    '''
+    Signatures of the outputs of one image, to tell whether outputs saved by an
+    earlier run are up to date (see CorrCache)
+
+    Parameters:
+        options (Options): parameters of the run
+        image (str): image filename
+
+    Returns:
+        signatures (dict): signature of the CoV output of each channel, named
+        cov_<image>_<channel>, and of the correlation outputs of each pair,
+        named corr_<image>_<pair>. With the store format, the signature of
+        the results store, named results_<image>, and of the figures of each
+        pair of different channels, named corr_<image>_<pair>. With
+        surrogates, the signature of the significance outputs of each pair of
+        different channels, named pvalue_<image>_<pair>.
+    '''
+    im = os.path.splitext(image)[0]
+    channels = options.channels
+    common = {'scalefactor': options.scalefactor,
+              'coarse_method': options.coarse_method,
+              'dtype': options.dtype.name}
+    signatures = {}
+    pairs = CorrFunctions.channel_pairs(channels)
+    # Only added when not the default, so caches of earlier runs stay valid
+    params = {}
+    if options.figure_style != 'scatter':
+        params['figure_style'] = options.figure_style
+    if options.output_format == 'store':
+        signatures['results_'+im] = CorrCache.output_signature(
+            [os.path.join(options.data_path, ch, image) for ch in channels],
+            offset=options.offset, actin_folder=options.actin_folder,
+            **common)
+        pairs = [c for c in pairs if c[0] != c[1]]
+        params['output_format'] = options.output_format
+    else:
+        cov_params = {}
+        if options.output_format == 'coarse':
+            params['output_format'] = options.output_format
+            cov_params['output_format'] = options.output_format
+        for ch in channels:
+            signatures['cov_'+im+'_'+ch] = CorrCache.output_signature(
+                [os.path.join(options.data_path, ch, image)], **common,
+                **cov_params)
+    for c in pairs:
+        # Figures of cross-correlations also show the actin CoV
+        signatures['corr_'+im+'_'+c[0]+c[1]] = CorrCache.output_signature(
+            [os.path.join(options.data_path, ch, image)
+             for ch in (c[0], c[1], options.actin_folder) if ch in channels],
+            offset=options.offset, **common, **params)
+    if options.surrogates:
+        for c in CorrFunctions.channel_pairs(channels):
+            if c[0] == c[1]:
+                continue
+            signatures['pvalue_'+im+'_'+c[0]+c[1]] = (
+                CorrCache.output_signature(
+                    [os.path.join(options.data_path, ch, image) for ch in c],
+                    offset=options.offset, surrogates=options.surrogates,
+                    surrogate_method=options.surrogate_method,
+                    threshold='lag', **common))
+    return signatures
+
+
+def outputs_to_make(options, image):
+    '''
+    Outputs of one image that need to be saved. With a cache, outputs that are
+    up to date from an earlier run with the same parameters are skipped.
+
+    Returns:
+        signatures (dict): signature of each output (see output_signatures)
+        todo (set of str): names of the outputs to save
+    '''
+    im = os.path.splitext(image)[0]
+    signatures = output_signatures(options, image)
+    manifest = {}
+    results_path = results_folder(options.output_path, im)
+    if options.cache_path is not None:
+        manifest = CorrCache.read_manifest(results_path)
+    todo = {name for name, signature in signatures.items()
+            if not CorrCache.is_up_to_date(results_path, manifest, name,
+                                           signature)}
+    return signatures, todo
+
+
+def record_outputs(results_path, manifest, signatures, saved,
+                   profiler=None):
+    '''
+    Record the outputs of an image in its manifest once they are written,
+    and save the manifest. Outputs that failed are not recorded, so they are
+    made again by the next run.
+
+    Parameters:
+        results_path (str): folder the outputs are saved in
+        manifest (dict): manifest of results_path
+        signatures (dict): signature of each output
+        saved (dict): CorrWriter job of each output
+        profiler (CorrProfile.Profiler): records the write_manifest stage
+    '''
+    with CorrProfile.stage(profiler, 'write_manifest'):
+        for name, job in saved.items():
+            if job.exception() is None:
+                CorrCache.record_output(manifest, name, signatures[name],
+                                        job.result())
+        CorrCache.write_manifest(results_path, manifest)
+
+
+def finished_jobs(files):
+    '''
+    Returns:
+        jobs (dict): a finished CorrWriter-like job of each output in files,
+        names of the files saved for each output by another process
+    '''
+    jobs = {}
+    for name, saved in files.items():
+        jobs[name] = Future()
+        jobs[name].set_result(saved)
+    return jobs
+
+
+def plan_units(options, per_pair=False):
+    '''
+    Split a run into units of work, run by run_unit in this process, in a
+    pool of processes or through a queue. Each image has a unit loading each
+    channel (or one streaming every channel of an online run), the CoV of
+    each channel, the correlations, significance tests and figures of its
+    channel pairs, its results store and its cache manifest. Images and
+    outputs up to date in a cache are left out.
+
+    Parameters:
+        options (Options): parameters of the run
+        per_pair (bool): make a correlation unit for each channel pair,
+            to spread them over more workers, rather than one for every
+            pair of an image, whose channels are then transformed once
+
+    Returns:
+        units (list of dicts): id, stage, image, channel or pairs, names of
+        the 'outputs' to make, ids of the units to run 'after' and number of
+        progress 'steps', in an order they can run in
+    '''
+    imlist = CorrFunctions.get_names(options.data_path, options.images)[1]
+    channels = options.channels
+    units = []
+    for image in imlist:
+        im = os.path.splitext(image)[0]
+        signatures, todo = outputs_to_make(options, image)
+        if not todo:
+            continue
+        image_units = []
+        if options.online:
+            image_units.append({'id': 'stream.'+im, 'stage': 'stream',
+                                'image': image, 'outputs': [], 'after': [],
+                                'steps': 1})
+            loaded = {ch: 'stream.'+im for ch in channels}
+        else:
+            for ch in channels:
+                image_units.append({'id': 'load.'+im+'.'+ch, 'stage': 'load',
+                                    'image': image, 'channel': ch,
+                                    'outputs': [], 'after': [], 'steps': 1})
+            loaded = {ch: 'load.'+im+'.'+ch for ch in channels}
+        for ch in channels:
+            image_units.append({
+                'id': 'cov.'+im+'.'+ch, 'stage': 'cov', 'image': image,
+                'channel': ch, 'outputs': sorted({'cov_'+im+'_'+ch} & todo),
+                'after': [loaded[ch]], 'steps': 1})
+        store = 'results_'+im in todo
+        pairs = [list(c) for c in sorted(CorrFunctions.channel_pairs(channels))
+                 if store or {'corr_'+im+'_'+c[0]+c[1],
+                              'pvalue_'+im+'_'+c[0]+c[1]} & todo]
+        groups = [[c] for c in pairs] if per_pair else [pairs]
+        for group in groups:
+            if not group:
+                continue
+            unit_id = 'correlation.'+im
+            if per_pair:
+                unit_id += '.'+group[0][0]+'-'+group[0][1]
+            steps = len(group)
+            if not options.online:
+                steps += 1
+            if options.surrogates:
+                steps += sum(1 for c in group if c[0] != c[1])
+            image_units.append({
+                'id': unit_id, 'stage': 'correlation', 'image': image,
+                'pairs': group,
+                'outputs': sorted(todo & {prefix+im+'_'+c[0]+c[1]
+                                          for prefix in ('corr_', 'pvalue_')
+                                          for c in group}),
+                'store': store,
+                'after': sorted({loaded[ch] for c in group for ch in c} | {
+                    'cov.'+im+'.'+ch for ch in channels
+                    if ch == options.actin_folder}),
+                'steps': steps})
+        if store:
+            image_units.append({
+                'id': 'store.'+im, 'stage': 'store', 'image': image,
+                'outputs': ['results_'+im],
+                'after': [unit['id'] for unit in image_units
+                          if unit['stage'] in ('cov', 'correlation')],
+                'steps': 0})
+        if options.cache_path is not None:
+            image_units.append({
+                'id': 'manifest.'+im, 'stage': 'manifest', 'image': image,
+                'signatures': signatures, 'outputs': [],
+                'after': [unit['id'] for unit in image_units], 'steps': 0})
+        units += image_units
+    return units
+
+
+def correlate(pairs, options, arrays, im, profiler=None):
+    '''
+    Correlations of the channel pairs of an image, from the coarse-grained
+    images in arrays. A single pair is correlated on its own, and several
+    pairs with pairwise_correlation, which transforms each channel once.
+
+    Returns:
+        images (dict): coarse-grained image of each channel of pairs
+        corrs (dict): correlation of each pair [lag,x,y]
+    '''
+    channels = sorted({ch for c in pairs for ch in c})
+    images = {ch: arrays.load('image_'+ch+'_'+im) for ch in channels}
+    with CorrProfile.stage(profiler, 'correlation', image=im):
+        if len(pairs) == 1:
+            c = pairs[0]
+            return images, {c: CorrFunctions.cross_correlation(
+                images[c[0]], images[c[1]], options.scalefactor,
+                options.offset, memory_budget=options.memory_budget)}
+        out = None
+        if options.memory_budget is not None:
+            # Written tile by tile, into its file when arrays are shared
+            first = images[channels[0]]
+            out = arrays.empty(
+                'correlations_'+im, (len(channels), len(channels),
+                                     CorrFunctions.lags_to_calculate(
+                                         options.offset, first.shape[0]))
+                + first.shape[1:], CorrFunctions.float_dtype(first))
+        corr = CorrFunctions.pairwise_correlation(
+            [images[ch] for ch in channels], options.scalefactor,
+            options.offset, memory_budget=options.memory_budget, out=out)
+    return images, {c: corr[channels.index(c[0]), channels.index(c[1])]
+                    for c in pairs}
+
+
+def calculate_significance(pairs, options, images, corrs, outputs, writer,
+                      results_path, im, progress=None, profiler=None):
+    '''
+    Test the correlations of every pair of different channels against
+    surrogates and save their p-values (see CorrSignificance)
+
+    Parameters:
+        pairs (list of tuples): channel pairs of the unit
+        images (dict): coarse-grained image of each channel
+        corrs (dict): correlation of each pair
+        outputs (list of str): names of the outputs to save
+
+    Returns:
+        jobs (dict): CorrWriter job of each p-value output
+    '''
+    import CorrSignificance
+    jobs = {}
+    stats = {}
+    for c in pairs:
+        if c[0] == c[1]:
+            continue
+        name = 'pvalue_'+im+'_'+c[0]+c[1]
+        if name in outputs:
+            with CorrProfile.stage(profiler, 'surrogate_statistics',
+                                   image=im):
+                for ch in c:
+                    if ch not in stats:
+                        stats[ch] = CorrSignificance.circular_statistics(
+                            images[ch])
+            with CorrProfile.stage(profiler, 'significance', image=im,
+                                   pair=c[0]+c[1]):
+                pvalue, threshold, used = CorrSignificance.significance(
+                    stats[c[0]], stats[c[1]], corrs[c], options.surrogates,
+                    options.surrogate_method,
+                    memory_budget=options.memory_budget)
+            jobs[name] = writer.submit(
+                CorrFunctions.save_significance, pvalue, threshold,
+                options.scalefactor, results_path, im, c,
+                coarse_method=options.coarse_method, used=used,
+                labels={'image': im, 'pair': c[0]+c[1]},
+                stage='save_significance')
+        CorrProgress.step(progress, 'Significance of '+im+' '+c[0]+'-'
+                          + c[1])
+    return jobs
+
+
+def run_unit(unit, options, arrays, writer, results=None, progress=None,
+             profiler=None):
+    '''
+    Run a unit of plan_units. Every way of running (run_in_serial,
+    run_in_pool and run_from_queue) runs the same units, so they support the
+    same options and save the same outputs.
+
+    Parameters:
+        unit (dict): unit to run
+        options (Options): parameters of the run
+        arrays (Arrays): arrays saved by the units run before, and for the
+            units run after
+        writer (CorrWriter.Writer): writes the outputs
+        results (dict): CorrWriter jobs of the outputs of each unit in
+            unit['after'], used by manifest units
+        progress (CorrProgress.Progress): counts the unit['steps'] steps of
+            the unit
+        profiler (CorrProfile.Profiler): records each stage
+
+    Returns:
+        jobs (dict): CorrWriter job of each output of the unit
+    '''
+    image = unit['image']
+    im = os.path.splitext(image)[0]
+    scalefactor = options.scalefactor
+    coarse_method = options.coarse_method
+    results_path = results_folder(options.output_path, im)
+    jobs = {}
+    if unit['stage'] == 'load':
+        ch = unit['channel']
+        with CorrProfile.stage(profiler, 'load', image=im, channel=ch):
+            arrays.save('image_'+ch+'_'+im,
+                        CorrFunctions.coarse_grain_and_normalise(
+                            os.path.join(options.data_path, ch, image),
+                            scalefactor, stream=options.stream,
+                            cache_path=options.cache_path, profiler=profiler,
+                            coarse_method=coarse_method,
+                            dtype=options.dtype))
+        CorrProgress.step(progress, 'Loaded '+im+' '+ch)
+    elif unit['stage'] == 'stream':
+        import CorrStreaming
+        image_paths = {ch: os.path.join(options.data_path, ch, image)
+                       for ch in options.channels}
+        with CorrProfile.stage(profiler, 'stream_image', image=im):
+            CorrProfile.add_bytes_read(profiler, image_paths.values())
+            covs, corrs = CorrStreaming.stream_image(
+                image_paths, scalefactor, options.offset,
+                coarse_method=coarse_method, dtype=options.dtype)
+        for ch, cov in covs.items():
+            arrays.save('cov_'+ch+'_'+im, cov)
+        for c, corr in corrs.items():
+            arrays.save('corr_'+c[0]+c[1]+'_'+im, corr)
+        CorrProgress.step(progress, 'Read '+im)
+    elif unit['stage'] == 'cov':
+        ch = unit['channel']
+        with CorrProfile.stage(profiler, 'cov', image=im, channel=ch):
+            if options.online:
+                cov = arrays.load('cov_'+ch+'_'+im)
+            else:
+                cov = CorrFunctions.coefficient_of_variation(
+                    arrays.load('image_'+ch+'_'+im), scalefactor)
+                arrays.save('cov_'+ch+'_'+im, cov)
+        for name in unit['outputs']:
+            jobs[name] = writer.submit(
+                CorrFunctions.save_coefficient_of_variation, cov, scalefactor,
+                results_path, im, ch, coarse_method=coarse_method,
+                output_format=options.output_format,
+                labels={'image': im, 'channel': ch}, stage='save_cov')
+        CorrProgress.step(progress, 'CoV of '+im+' '+ch)
+    elif unit['stage'] == 'correlation':
+        pairs = [tuple(c) for c in unit['pairs']]
+        if options.online:
+            corrs = {c: arrays.load('corr_'+c[0]+c[1]+'_'+im) for c in pairs}
+        else:
+            images, corrs = correlate(pairs, options, arrays, im, profiler)
+            CorrProgress.step(progress, 'Correlations of '+im)
+        if options.surrogates:
+            jobs.update(calculate_significance(
+                pairs, options, images, corrs, unit['outputs'], writer,
+                results_path, im, progress, profiler))
+        cov_act = None
+        if 'cov_'+options.actin_folder+'_'+im in arrays:
+            cov_act = arrays.load('cov_'+options.actin_folder+'_'+im)
+        for c in pairs:
+            name = 'corr_'+im+'_'+c[0]+c[1]
+            if name in unit['outputs']:
+                jobs[name] = writer.submit(
+                    CorrFunctions.save_cross_correlation, corrs[c], cov_act,
+                    scalefactor, results_path, im, c,
+                    coarse_method=coarse_method,
+                    output_format=options.output_format,
+                    figure_style=options.figure_style,
+                    labels={'image': im, 'pair': c[0]+c[1]},
+                    stage='save_correlation')
+            CorrProgress.step(progress, 'Saved '+im+' '+c[0]+'-'+c[1])
+        if unit['store'] and not options.online:
+            for c in pairs:
+                arrays.save('corr_'+c[0]+c[1]+'_'+im, corrs[c])
+    elif unit['stage'] == 'store':
+        channels = options.channels
+        jobs['results_'+im] = writer.submit(
+            CorrStore.write,
+            os.path.join(results_path, CorrStore.store_name(im)),
+            {ch: arrays.load('cov_'+ch+'_'+im) for ch in channels},
+            {c: arrays.load('corr_'+c[0]+c[1]+'_'+im)
+             for c in sorted(CorrFunctions.channel_pairs(channels))},
+            CorrFunctions.store_parameters(
+                options.data_path, image, options.actin_folder, scalefactor,
+                options.offset, coarse_method, options.dtype),
+            labels={'image': im}, stage='write_store')
+    elif unit['stage'] == 'manifest':
+        saved = {}
+        for after in unit['after']:
+            saved.update(results[after])
+        writer.submit(record_outputs, results_path,
+                      CorrCache.read_manifest(results_path),
+                      unit['signatures'], saved, labels={'image': im})
+    return jobs
+
+
+def run_with_files(unit, options, arrays, files, progress=None,
+                   profiler=None):
+    '''
+    run_unit for units run apart from the rest of the run, in a worker
+    process or from a queue: the outputs are written before returning, and
+    the outputs of the units in unit['after'] are passed and returned as the
+    names of their files, which can be pickled or saved
+
+    Parameters:
+        files (dict): names of the files saved for each output of each unit
+            in unit['after']
+
+    Returns:
+        files (dict): names of the files saved for each output of the unit
+
+    Raises:
+        CorrWriter.WriteError: if an output could not be written
+    '''
+    with CorrWriter.Writer(0, profiler=profiler) as writer:
+        jobs = run_unit(unit, options, arrays, writer,
+                        {after: finished_jobs(files[after])
+                         for after in unit['after']}, progress, profiler)
+    return {name: job.result() for name, job in jobs.items()}
+
+
+def run_in_worker(unit, options, shared_path, files, profiler=None):
+    '''
+    Process pool entry point of run_in_pool: run_with_files with the arrays
+    in shared_path
+
+    Returns:
+        files (dict): names of the files saved for each output of the unit
+        steps (list of str): descriptions of the progress steps of the unit,
+        to count in the main process
+    '''
+    steps = []
+    progress = CorrProgress.Progress(
+        lambda done, total, message, remaining: steps.append(message))
+    progress.start(unit['steps'])
+    files = run_with_files(unit, options, Arrays(shared_path), files,
+                           progress, profiler)
+    # Without the 'Starting' report of start
+    return files, steps[1:]
+
+
+def count_steps(folders, imlist, online=False, surrogates=0):
+    '''
+    Number of progress steps of a run without a cache: loading and CoV of
+    every channel, the correlations of every image and the outputs of every
+    channel pair. Online runs load all channels of an image in one step.
+
+    Parameters:
+        folders (list of str): channel folders
+        imlist (list of str): image names
+        online (bool): count the steps of an online run
+        surrogates (int): count the significance of every pair of different
+            channels too if not 0
+
+    Returns:
+        steps (int): number of steps, the sum of the steps of plan_units
+    '''
+    pairs = len(CorrFunctions.channel_pairs(folders))
+    if online:
+        return len(imlist)*(1 + len(folders) + pairs)
+    if surrogates:
+        pairs += pairs - len(folders)
+    return len(imlist)*(2*len(folders) + 1 + pairs)
+
+
+def init_worker():
+    '''
+    Process pool initializer: figures are only saved, so use a non-GUI
+    matplotlib backend in the workers
+    '''
+    import matplotlib
+    matplotlib.use('Agg')
+
+
+def submit(pool, profiler, function, *args):
+    '''
+    Submit function(*args) to pool, profiled in the worker if profiler is not
+    None
+
+    Returns:
+        job (concurrent.futures.Future): pass to collect for the result
+    '''
+    trace_memory = None if profiler is None else profiler.trace_memory
+    return pool.submit(CorrProfile.call_with_profiler, function,
+                       trace_memory, *args)
+
+
+def collect(job, profiler, progress=None, message=''):
+    '''
+    Wait for a job from submit and add the records of its stages to profiler.
+    Cancellation is checked while waiting.
+
+    Parameters:
+        progress (CorrProgress.Progress): counts the job as a step when done
+        message (str): description of the step
+
+    Returns:
+        output: return value of the submitted function
+    '''
+    from concurrent.futures import wait
+    while not wait([job], timeout=0.2).done:
+        CorrProgress.check(progress)
+    output, records = job.result()
+    for record in records:
+        profiler.add(record)
+    CorrProgress.step(progress, message)
+    return output
+
+
+def run_in_serial(options, writer, profiler=None, progress=None):
+    '''
+    Run the units of plan_units one after another in this process, keeping
+    the arrays of one image at a time in memory
+
+    Parameters:
+        options (Options): parameters of the run
+        writer (CorrWriter.Writer): writes the outputs
+        profiler (CorrProfile.Profiler): records each stage
+        progress (CorrProgress.Progress): counts each step
+
+    Returns:
+        Saves results in options.output_path
+    '''
+    units = plan_units(options)
+    CorrProgress.start(progress, sum(unit['steps'] for unit in units))
+    results = {}
+    image = None
+    for unit in units:
+        if unit['image'] != image:
+            image = unit['image']
+            arrays = Arrays()
+        results[unit['id']] = run_unit(unit, options, arrays, writer,
+                                       results, progress, profiler)
+
+
+def run_in_pool(options, profiler=None, progress=None):
+    '''
+    Run the units of plan_units on a pool of options.workers processes,
+    each as soon as the units it runs after are done. Arrays are passed
+    between the workers as memory-mapped files in a temporary folder, and
+    each worker writes the outputs of its units.
+
+    Parameters:
+        options (Options): parameters of the run
+        profiler (CorrProfile.Profiler): collects the stages recorded by the
+            workers
+        progress (CorrProgress.Progress): counts the steps of each unit as it
+            completes. Units not yet started are cancelled when the run is
+            cancelled.
+
+    Returns:
+        Saves results in the same files as a serial run
+    '''
+    from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+    units = plan_units(options)
+    CorrProgress.start(progress, sum(unit['steps'] for unit in units))
+    shared_path = tempfile.mkdtemp(prefix='CorrAndCov_')
+    files = {}
+    running = {}
+    try:
+        with ProcessPoolExecutor(max_workers=options.workers,
+                                 initializer=init_worker) as pool:
+            while units or running:
+                ready = [unit for unit in units
+                         if all(after in files for after in unit['after'])]
+                for unit in ready:
+                    units.remove(unit)
+                    running[submit(pool, profiler, run_in_worker, unit,
+                                   options, shared_path,
+                                   {after: files[after]
+                                    for after in unit['after']})] = unit
+                done = wait(list(running), timeout=0.2,
+                            return_when=FIRST_COMPLETED).done
+                CorrProgress.check(progress)
+                for job in done:
+                    unit = running.pop(job)
+                    (files[unit['id']], steps), records = job.result()
+                    for record in records:
+                        profiler.add(record)
+                    for message in steps:
+                        CorrProgress.step(progress, message)
+    except CorrProgress.Cancelled:
+        # Only the units already running are waited for
+        for job in running:
+            job.cancel()
+        raise
+    finally:
+        shutil.rmtree(shared_path, ignore_errors=True)
+
+
+def work_queue(queue_path, options, stop_path, progress=None, profiler=None):
+    '''
+    Run units of the queue in queue_path until it is finished, or until
+    stop_path exists. Arrays are kept in the arrays folder of the queue, so
+    they can be read by workers on other machines.
+
+    Returns:
+        counts (dict): number of units done and failed by this worker
+    '''
+    import CorrQueue
+    queue = CorrQueue.Queue(queue_path)
+    arrays = Arrays(os.path.join(queue_path, 'arrays'))
+    return queue.work(
+        lambda unit: run_with_files(
+            unit, options, arrays,
+            {after: queue.result(after) for after in unit['after']},
+            profiler=profiler),
+        progress=progress, stop=lambda: os.path.exists(stop_path))
+
+
+def run_from_queue(options, profiler=None, progress=None):
+    '''
+    Run the units of plan_units, with a unit for each channel pair, through
+    a CorrQueue in options.queue_path. Any number of runs with the same
+    parameters and queue_path, on any machines sharing the folder, work
+    through the same units; a run that is restarted only runs the units
+    that are not done yet. Units that fail are tried again (see
+    CorrQueue.Queue).
+
+    Parameters:
+        options (Options): parameters of the run, with options.workers
+            worker processes on this machine
+        profiler (CorrProfile.Profiler): records each stage
+        progress (CorrProgress.Progress): counts each unit, or each worker
+            process when there are several
+
+    Returns:
+        Saves results in the same files as a serial run
+
+    Raises:
+        CorrQueue.QueueError: if units failed too many times
+    '''
+    from concurrent.futures import ProcessPoolExecutor
+    import CorrQueue
+    queue_path = options.queue_path
+    units = None
+    if not os.path.exists(os.path.join(queue_path, 'units.json')):
+        units = plan_units(options, per_pair=True)
+    queue = CorrQueue.Queue(queue_path, units, options.params())
+    # Stops the workers of this run only, e.g. when it is cancelled
+    stop_path = os.path.join(queue_path, 'stop_'+uuid.uuid4().hex)
+    try:
+        if options.workers > 1:
+            with ProcessPoolExecutor(max_workers=options.workers,
+                                     initializer=init_worker) as pool:
+                CorrProgress.start(progress, options.workers)
+                jobs = [submit(pool, profiler, work_queue, queue_path,
+                               options, stop_path)
+                        for worker in range(options.workers)]
+                try:
+                    for job in jobs:
+                        collect(job, profiler, progress, 'Worker finished')
+                except CorrProgress.Cancelled:
+                    # The workers stop after their current unit
+                    open(stop_path, 'w').close()
+                    raise
+        else:
+            work_queue(queue_path, options, stop_path, progress, profiler)
+    finally:
+        if os.path.exists(stop_path):
+            os.remove(stop_path)
+    queue.check()
+    if all(state == 'done' for state in queue.states().values()):
+        # Intermediate arrays are not needed by any unit any more
+        shutil.rmtree(os.path.join(queue_path, 'arrays'), ignore_errors=True)
+
+
+def run_windows(options, writer, profiler=None, progress=None):
+    '''
+    Run over sliding time windows: the CoV and correlations of each window
+    are calculated from running sums over the whole movie (see CorrWindows),
+    and saved for each image as cov_<image>_<channel>_windows.tif
+    [window,x,y] and corr_<image>_<pair>_windows.tif [window,lag,x,y]. The
+    offset is cut to the window as in CorrFunctions.lags_to_calculate.
+
+    Parameters:
+        options (Options): parameters of the run
+        writer (CorrWriter.Writer): writes the outputs
+        profiler (CorrProfile.Profiler): records each stage
+        progress (CorrProgress.Progress): counts each step
+
+    Returns:
+        Saves results in options.output_path
+    '''
+    import CorrWindows
+    folders = options.channels
+    imlist = CorrFunctions.get_names(options.data_path, options.images)[1]
+    scalefactor = options.scalefactor
+    window = options.window
+    stride = options.stride or window
+    pairs = sorted(CorrFunctions.channel_pairs(folders))
+    CorrProgress.start(progress, len(imlist)*(2*len(folders) + len(pairs)))
+    for image in imlist:
+        im = os.path.splitext(image)[0]
+        results_path = results_folder(options.output_path, im)
+        stats = {}
+        for ch in folders:
+            with CorrProfile.stage(profiler, 'load', image=im, channel=ch):
+                stats[ch] = CorrWindows.window_statistics(
+                    CorrFunctions.coarse_grain_and_normalise(
+                        os.path.join(options.data_path, ch, image),
+                        scalefactor, stream=options.stream,
+                        cache_path=options.cache_path, profiler=profiler,
+                        coarse_method=options.coarse_method,
+                        dtype=options.dtype))
+            CorrProgress.step(progress, 'Loaded '+im+' '+ch)
+        for ch in folders:
+            with CorrProfile.stage(profiler, 'cov', image=im, channel=ch):
+                writer.submit(
+                    CorrFunctions.save_windows,
+                    CorrWindows.sliding_cov(stats[ch], window, stride),
+                    scalefactor, results_path,
+                    'cov_'+im+'_'+ch+'_windows.tif',
+                    coarse_method=options.coarse_method,
+                    labels={'image': im, 'channel': ch}, stage='save_cov')
+            CorrProgress.step(progress, 'CoV of '+im+' '+ch)
+        for c in pairs:
+            with CorrProfile.stage(profiler, 'correlation', image=im,
+                                   pair=c[0]+c[1]):
+                writer.submit(
+                    CorrFunctions.save_windows,
+                    CorrWindows.sliding_correlation(
+                        stats[c[0]], stats[c[1]], options.offset, window,
+                        stride),
+                    scalefactor, results_path,
+                    'corr_'+im+'_'+c[0]+c[1]+'_windows.tif',
+                    coarse_method=options.coarse_method,
+                    labels={'image': im, 'pair': c[0]+c[1]},
+                    stage='save_correlation')
+            CorrProgress.step(progress, 'Correlations of '+im+' '
+                              + c[0]+'-'+c[1])
+        del stats
+
+
+def as_list(value):
+    '''
+    Returns:
+        values (list): value if it is a list or tuple, otherwise [value]
+    '''
+    if isinstance(value, (list, tuple)):
+        return list(value)
+    return [value]
+
+
+def sweep_folder(output_path, scalefactor, offset):
+    '''
+    Create, if needed, the folder the results of one combination of a sweep
+    are saved in
+
+    Parameters:
+        output_path (str): folder to save results in
+        scalefactor (float): scale factor of the combination
+        offset (int): number of time lags of the combination
+
+    Returns:
+        sweep_path (str): scale<scalefactor>_offset<offset> folder in
+        output_path, holding a corr_<image> folder for each image
+    '''
+    sweep_path = os.path.join(
+        output_path, 'scale'+str(scalefactor)+'_offset'+str(offset))
+    if not os.path.exists(sweep_path):
+        os.makedirs(sweep_path, exist_ok=True)
+    return sweep_path
+
+
+def run_sweep(options, writer, profiler=None, progress=None):
+    '''
+    Run every combination of the scale factors and offsets of options. Each
+    image is read once and coarse-grained to every scale factor (see
+    CorrFunctions.pyramid_levels). The correlations of each scale factor are
+    calculated once for the largest offset; smaller offsets use their first
+    lags.
+
+    Parameters:
+        options (Options): parameters of the run
+        writer (CorrWriter.Writer): writes the outputs
+        profiler (CorrProfile.Profiler): records each stage
+        progress (CorrProgress.Progress): counts each step
+
+    Returns:
+        Saves the results of each combination in its sweep_folder
+    '''
+    folders = options.channels
+    imlist = CorrFunctions.get_names(options.data_path, options.images)[1]
+    scalefactors = sorted(set(as_list(options.scalefactor)), reverse=True)
+    offsets = sorted(set(as_list(options.offset)))
+    coarse_method = options.coarse_method
+    output_format = options.output_format
+    pairs = CorrFunctions.channel_pairs(folders)
+    # Offsets CoV TIFFs or results stores are saved for
+    file_offsets = offsets if output_format != 'store' else []
+    store_offsets = offsets if output_format == 'store' else []
+    CorrProgress.start(progress, len(imlist)*(len(folders) + len(scalefactors)
+                       * (len(folders) + 1 + len(pairs)*len(offsets))))
+    for image in imlist:
+        im = os.path.splitext(image)[0]
+        levels = {}
+        for ch in folders:
+            image_path = os.path.join(options.data_path, ch, image)
+            with CorrProfile.stage(profiler, 'load', image=im, channel=ch):
+                CorrProfile.add_bytes_read(profiler, [image_path])
+                levels[ch] = CorrFunctions.pyramid_levels(
+                    CorrFunctions.load_image(image_path), scalefactors,
+                    coarse_method)
+            CorrProgress.step(progress, 'Loaded '+im+' '+ch)
+        for scalefactor in scalefactors:
+            images = {ch: CorrFunctions.normalise_frames(
+                levels[ch].pop(scalefactor), options.dtype) for ch in folders}
+            results_paths = {offset: results_folder(
+                sweep_folder(options.output_path, scalefactor, offset), im)
+                for offset in offsets}
+            covs = {}
+            for ch in folders:
+                with CorrProfile.stage(profiler, 'cov', image=im, channel=ch,
+                                       scalefactor=scalefactor):
+                    covs[ch] = CorrFunctions.coefficient_of_variation(
+                        images[ch], scalefactor)
+                    for offset in file_offsets:
+                        writer.submit(
+                            CorrFunctions.save_coefficient_of_variation,
+                            covs[ch], scalefactor, results_paths[offset], im,
+                            ch, coarse_method=coarse_method,
+                            output_format=output_format,
+                            labels={'image': im, 'channel': ch,
+                                    'scalefactor': scalefactor,
+                                    'offset': offset},
+                            stage='save_cov')
+                CorrProgress.step(progress, 'CoV of '+im+' '+ch+' at '
+                                  + str(scalefactor))
+            with CorrProfile.stage(profiler, 'correlation', image=im,
+                                   scalefactor=scalefactor):
+                corr = CorrFunctions.pairwise_correlation(
+                    [images[ch] for ch in folders], scalefactor, max(offsets),
+                    memory_budget=options.memory_budget)
+            CorrProgress.step(progress, 'Correlations of '+im+' at '
+                              + str(scalefactor))
+            for c in pairs:
+                for offset in offsets:
+                    writer.submit(
+                        CorrFunctions.save_cross_correlation,
+                        corr[folders.index(c[0]), folders.index(c[1]),
+                             :offset],
+                        covs.get(options.actin_folder), scalefactor,
+                        results_paths[offset], im, c,
+                        coarse_method=coarse_method,
+                        output_format=output_format,
+                        figure_style=options.figure_style,
+                        labels={'image': im, 'pair': c[0]+c[1],
+                                'scalefactor': scalefactor, 'offset': offset},
+                        stage='save_correlation')
+                    CorrProgress.step(progress, 'Saved '+im+' '+c[0]+'-'
+                                      + c[1]+' at '+str(scalefactor)+', '
+                                      + str(offset))
+            for offset in store_offsets:
+                writer.submit(
+                    CorrStore.write, os.path.join(results_paths[offset],
+                                                  CorrStore.store_name(im)),
+                    covs, {c: corr[folders.index(c[0]), folders.index(c[1]),
+                                   :offset] for c in sorted(pairs)},
+                    CorrFunctions.store_parameters(
+                        options.data_path, image, options.actin_folder,
+                        scalefactor, offset, coarse_method, options.dtype),
+                    labels={'image': im, 'scalefactor': scalefactor,
+                            'offset': offset}, stage='write_store')
+            del images, corr
+
+
+def run(options, profiler=None, progress=None):
+    '''
+    Read in data, calculate auto- and cross-correlation and coefficient of
+    variance, output images and figures of results: over sliding windows,
+    as a sweep, through a queue, on a pool of processes or in this process.
+
+    Parameters:
+        options (Options): parameters of the run
+        profiler (CorrProfile.Profiler): records time, CPU time, bytes read
+            and written and peak memory of each stage, image and channel
+            pair. The report is saved as CorrAndCov_profile.json and .csv in
+            options.output_path.
+        progress (CorrProgress.Progress): reports each step and the time
+            remaining, and stops the run with CorrProgress.Cancelled between
+            steps when it is cancelled. Outputs already saved are kept.
+
+    Returns:
+        Saves results in options.output_path
+    '''
+    with CorrProfile.stage(profiler, 'run'), CorrWriter.Writer(
+            options.output_buffer, profiler=profiler) as writer:
+        if options.window is not None:
+            run_windows(options, writer, profiler, progress)
+        elif options.sweep:
+            run_sweep(options, writer, profiler, progress)
+        elif options.queue_path is not None:
+            run_from_queue(options, profiler, progress)
+        elif options.workers > 1:
+            run_in_pool(options, profiler, progress)
+        else:
+            run_in_serial(options, writer, profiler, progress)
+    if profiler is not None:
+        profiler.write(os.path.join(options.output_path, 'CorrAndCov_profile'))
+    print('Complete')
@@ -0,0 +1,369 @@
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import CorrFunctions
+
+# 'shift' shifts the second image circularly in time, 'phase' randomises the
+# phases of its spectrum at every pixel
+SURROGATE_METHODS = ('shift', 'phase')
+# p-value of the threshold maps
+SIGNIFICANCE_LEVEL = 0.05
+# Fewest surrogates whose smallest p-value, 1/(surrogates+1), is below
+# SIGNIFICANCE_LEVEL. Movies with fewer circular shifts far enough from the
+# lags tested need phase-randomised surrogates.
+MIN_SURROGATES = 20
+# Default bytes of working memory of each thread
+CHUNK_BYTES = 64*1024**2
+
+
+def circular_statistics(image):
+    '''
+    Terms of the surrogate correlations that depend on one channel only: the
+    spectrum of the whole movie, centred on its mean over time, and its sum
+    of squares. They are shared by every surrogate and every pair the channel
+    is part of.
+
+    Parameters:
+        image (numpy array): image with dimensions [t,x,y]
+
+    Returns:
+        stats (dict): image [t,pixel] (not copied), its mean over time
+        [pixel], spectrum [f,pixel], power [pixel], and the shape and float
+        type of image
+    '''
+    pixels = image.reshape(image.shape[0], -1)
+    mean = np.mean(pixels, axis=0, dtype=np.float64)
+    x = pixels - mean
+    return {'image': pixels, 'mean': mean,
+            'spectrum': np.fft.rfft(x, axis=0),
+            'power': np.einsum('ij,ij->j', x, x), 'shape': image.shape,
+            'dtype': CorrFunctions.float_dtype(image)}
+
+
+def surrogate_shifts(n_t, offset, surrogates, rng):
+    '''
+    Circular shifts of the second image used as surrogates. Shifts closer
+    than offset frames to the lags that are tested, in either direction, are
+    left out so the surrogates do not contain the coupling being tested.
+
+    Parameters:
+        n_t (int): number of frames
+        offset (int): number of time lags tested
+        surrogates (int): number of surrogates wanted
+        rng (numpy.random.Generator): picks the shifts
+
+    Returns:
+        shifts (numpy array): at most surrogates distinct shifts in frames,
+        none for movies of less than 3*offset frames
+    '''
+    allowed = np.arange(2*offset, n_t - offset + 1)
+    if surrogates >= len(allowed):
+        return allowed
+    return np.sort(rng.choice(allowed, surrogates, replace=False))
+
+
+def surrogate_phases(n_t, surrogates, rng):
+    '''
+    Random phases of the phase-randomised surrogates, the same for every
+    pixel. The mean and Nyquist frequency keep their phase, so the
+    surrogates are real with the power spectrum of the original image.
+
+    Returns:
+        phases (numpy array): [surrogate,f]
+    '''
+    phases = rng.uniform(0, 2*np.pi, (surrogates, n_t//2 + 1))
+    phases[:, 0] = 0
+    if n_t % 2 == 0:
+        phases[:, -1] = 0
+    return phases
+
+
+def lagged_null(x, y, terms):
+    '''
+    Correlations of surrogates of the second image at every lag, over the
+    same frames as the correlation tested: lag i pairs frames i to n_t-1 of
+    the first image with frames 0 to n_t-1-i of each surrogate. The sums of
+    the first image over its frames come from running sums. Every surrogate
+    has the sum and sum of squares of the second image over all frames, and
+    the frame that leaves the overlap at each lag is taken off them.
+
+    Parameters:
+        x, y (numpy arrays): images centred on their means [t,pixel]
+        terms (iterator): for every lag, the sums over the overlapping frames
+            of the products of x with each surrogate, and frame n_t-lag of
+            each surrogate (None at lag 0), both [surrogate,pixel] and
+            overwritten
+
+    Yields:
+        null (numpy array): correlations of each lag [surrogate,pixel]
+    '''
+    n_t = x.shape[0]
+    zero = np.zeros((1, x.shape[1]))
+    sum_x = np.concatenate((zero, np.cumsum(x, axis=0)))
+    sum_xx = np.concatenate((zero, np.cumsum(x*x, axis=0)))
+    lagged = lagged_sq = None
+    for i, (sum_xy, dropped) in enumerate(terms):
+        if lagged is None:
+            lagged = np.empty_like(sum_xy)
+            lagged[:] = np.sum(y, axis=0)
+            lagged_sq = np.empty_like(sum_xy)
+            lagged_sq[:] = np.einsum('ij,ij->j', y, y)
+            temp = np.empty_like(sum_xy)
+        if dropped is not None:
+            lagged -= dropped
+            dropped *= dropped
+            lagged_sq -= dropped
+        n = n_t - i
+        if n < 2:
+            yield np.full(sum_xy.shape, np.nan)
+            continue
+        lead = sum_x[n_t] - sum_x[i]
+        lead_var = sum_xx[n_t] - sum_xx[i] - lead**2/n
+        # Covariance
+        np.multiply(lagged, lead/n, out=temp)
+        sum_xy -= temp
+        # Product of the variances
+        np.multiply(lagged, lagged, out=temp)
+        temp *= -1/n
+        temp += lagged_sq
+        temp *= lead_var
+        np.maximum(temp, 0, out=temp)
+        np.sqrt(temp, out=temp)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            sum_xy /= temp
+        yield sum_xy
+
+
+def shift_null(x, y, product, shifts, offset):
+    '''
+    Correlations of the second image shifted circularly by every shift, at
+    every lag (see lagged_null). The sums of products over all frames come
+    from a single inverse FFT of the cross-spectrum, and the frames before
+    lag i are taken off with a running sum, updated once per lag.
+
+    Parameters:
+        x, y (numpy arrays): images centred on their means [t,pixel]
+        product (numpy array): cross-spectrum of x and y [f,pixel]
+        shifts (numpy array): circular shifts in frames
+        offset (int): number of lags
+
+    Yields:
+        null (numpy array): correlations of each lag [surrogate,pixel]
+    '''
+    def terms():
+        n_t = x.shape[0]
+        # Sum over all frames of x[t]*y[t-d], with t-d wrapped around
+        circular = np.fft.irfft(product, n_t, axis=0)
+        # y[t-d] of every d at frame 0, twice so that y[t-d] at frame t is
+        # the n_t frames starting at frame n_t-t
+        y_reversed = np.roll(y[::-1], 1, axis=0)
+        y_reversed = np.concatenate((y_reversed, y_reversed))
+        # Sum over the frames before lag i of x[t]*y[t-d]
+        before = np.zeros_like(circular)
+        temp = np.empty_like(circular)
+        for i in range(offset):
+            if i > 0:
+                start = n_t - i + 1
+                np.multiply(y_reversed[start:start + n_t], x[i-1], out=temp)
+                before += temp
+            d = (i + shifts) % n_t
+            sum_xy = circular[d]
+            sum_xy -= before[d]
+            # Frame n_t-i of the shifted image
+            yield sum_xy, y[(n_t - i - shifts) % n_t] if i > 0 else None
+    return lagged_null(x, y, terms())
+
+
+def phase_null(x, y, spectrum1, spectrum2, phases, offset):
+    '''
+    Correlations of the phase-randomised surrogates of the second image at
+    every lag (see lagged_null). Each surrogate is a weighted sum over
+    frequencies of the spectrum of the second image turned by its phases,
+    so its sums of products with the first image at every lag, and its
+    frames that leave the overlap, are weighted sums over frequencies of
+    terms shared by all surrogates: one matrix product each for all
+    surrogates, lags and pixels.
+
+    Parameters:
+        x, y (numpy arrays): images centred on their means [t,pixel]
+        spectrum1, spectrum2 (numpy arrays): spectra of x and y [f,pixel]
+        phases (numpy array): see surrogate_phases
+        offset (int): number of lags
+
+    Yields:
+        null (numpy array): correlations of each lag [surrogate,pixel]
+    '''
+    n_t, n_f = x.shape[0], phases.shape[1]
+    # Weights of the one-sided spectrum in the inverse FFT
+    weights = np.full(n_f, 2/n_t)
+    weights[0] = 1/n_t
+    if n_t % 2 == 0:
+        weights[-1] = 1/n_t
+    # The real part of a frequency term z turned by a phase is
+    # cos(phase)*z.real - sin(phase)*z.imag
+    turn = np.concatenate((np.cos(phases)*weights, -np.sin(phases)*weights),
+                          axis=1)
+    # exp(2i*pi*f*t/n_t) of frames 0 to offset-1 [f,t,1]
+    waves = np.exp(2j*np.pi*np.outer(np.arange(n_f), np.arange(offset))
+                   / n_t)[:, :, None]
+    # Frame n_t-i of a surrogate is a weighted sum over frequencies of the
+    # spectrum of y times exp(-2i*pi*f*i/n_t), and its sum of products with
+    # frames i to n_t-1 of x the same times the sums of
+    # x[t]*exp(2i*pi*f*t/n_t) over those frames [f,lag,pixel]
+    y_lags = spectrum2[:, None]*np.conj(waves)
+    x_sums = np.empty_like(y_lags)
+    x_sums[:, 0] = np.conj(spectrum1)
+    np.cumsum(x[:offset-1]*waves[:, :-1], axis=1, out=x_sums[:, 1:])
+    x_sums[:, 1:] = x_sums[:, :1] - x_sums[:, 1:]
+    terms = np.empty((2*n_f,) + y_lags.shape[1:])
+
+    def weighted_sum(z):
+        # Real and imaginary parts [2f,lag*pixel] to [surrogate,lag,pixel]
+        terms[:n_f] = z.real
+        terms[n_f:] = z.imag
+        return np.dot(turn, terms.reshape(2*n_f, -1)).reshape(
+            (len(phases),) + z.shape[1:])
+
+    frames = weighted_sum(y_lags)
+    y_lags *= x_sums
+    del x_sums
+    sum_xy = weighted_sum(y_lags)
+    del y_lags, terms
+    return lagged_null(x, y, ((sum_xy[:, i].copy(),
+                               frames[:, i].copy() if i > 0 else None)
+                              for i in range(offset)))
+
+
+def upper_quantile(null, q):
+    '''
+    Quantile of every row, interpolated linearly as numpy.quantile does, by
+    partitioning the rows instead of sorting them
+
+    Parameters:
+        null (numpy array): [pixel,surrogate], partitioned in place
+        q (float): quantile
+
+    Returns:
+        quantile (numpy array): [pixel]
+    '''
+    position = q*(null.shape[1] - 1)
+    k = int(position)
+    null.partition(k, axis=1)
+    if k + 1 == null.shape[1]:
+        return null[:, k]
+    # The next value is the smallest of those above
+    return null[:, k] + (position - k)*(np.min(null[:, k+1:], axis=1)
+                                        - null[:, k])
+
+
+def surrogate_bytes_per_pixel(n_t, offset, surrogates, method='shift'):
+    '''
+    Estimate of the working memory per pixel of significance
+
+    Returns:
+        size (int): bytes per pixel
+    '''
+    # Centred images and running sums of the first, p-values and thresholds,
+    # and the sums, variances, correlations and their magnitudes of the
+    # surrogates at one lag
+    size = 8*4*n_t + 16*offset + 8*7*surrogates
+    if method == 'shift':
+        # Cross-spectrum, its inverse FFT, the sums before the lag, two
+        # periods of the second image and the products of one frame
+        return size + 16*(n_t//2 + 1) + 8*5*n_t
+    # Terms of every lag and frequency as complex numbers and as their real
+    # and imaginary parts, and the sums of products and frames of every lag
+    return size + 16*3*offset*(n_t//2 + 1) + 8*2*offset*surrogates
+
+
+def significance(stats1, stats2, corr, surrogates=1000, method='shift',
+                 seed=0, memory_budget=None, workers=1):
+    '''
+    p-value of the correlation of every pixel and lag against the
+    correlations of surrogates of the second image, which keep its
+    autocorrelation but not its coupling with the first. Each lag has a null
+    distribution of its own: every surrogate is correlated at each lag over
+    the same n_t-lag overlapping frames as the correlation tested.
+    The spectra of both images are shared by all surrogates; pixels are
+    processed in chunks that fit memory_budget, in workers threads.
+
+    Parameters:
+        stats1, stats2 (dict): circular_statistics of the images compared
+        corr (numpy array): correlations of the images [lag,x,y]
+        surrogates (int): number of surrogates. Circular shifts give at most
+            n_t - 3*offset + 1 distinct surrogates, and raise a ValueError
+            when that is fewer than MIN_SURROGATES (or surrogates).
+        method (str): 'shift' or 'phase'
+        seed (int): seed of the random shifts or phases, so runs are
+            repeatable
+        memory_budget (int): bytes of working memory for all threads, None
+            for CHUNK_BYTES per thread
+        workers (int): number of threads
+
+    Returns:
+        pvalue (numpy array): fraction of surrogates at least as strongly
+        correlated as each pixel and lag, either sign [lag,x,y]
+        threshold (numpy array): magnitude of correlation with a p-value of
+        SIGNIFICANCE_LEVEL at each lag [lag,x,y]
+        used (dict): 'method' and number of distinct 'surrogates' tested
+        against
+    '''
+    if method not in SURROGATE_METHODS:
+        raise ValueError('method should be one of '
+                         + ', '.join(SURROGATE_METHODS))
+    n_t = stats1['shape'][0]
+    offset = corr.shape[0]
+    rng = np.random.default_rng(seed)
+    if method == 'shift':
+        draws = surrogate_shifts(n_t, offset, surrogates, rng)
+        if len(draws) < min(surrogates, MIN_SURROGATES):
+            raise ValueError(
+                'Only {} circular shifts of {} frames are {} frames from the '
+                'lags tested, at least {} frames are needed; use '
+                'phase-randomised surrogates or fewer lags'.format(
+                    len(draws), n_t, offset,
+                    3*offset - 1 + min(surrogates, MIN_SURROGATES)))
+        if len(draws) < surrogates:
+            print('Only {} distinct circular shifts of {} frames, using {} '
+                  'surrogates'.format(len(draws), n_t, len(draws)))
+    else:
+        draws = surrogate_phases(n_t, surrogates, rng)
+    observed = np.abs(corr.reshape(offset, -1))
+    pvalue = np.empty(observed.shape, dtype=stats1['dtype'])
+    threshold = np.empty(observed.shape, dtype=stats1['dtype'])
+    n_pixels = observed.shape[1]
+    if memory_budget is None:
+        memory_budget = CHUNK_BYTES*workers
+    pixels = max(1, memory_budget // workers // surrogate_bytes_per_pixel(
+        n_t, offset, len(draws), method))
+    # At least one chunk for each thread
+    pixels = min(pixels, -(-n_pixels // workers))
+
+    def test(start):
+        chunk = slice(start, start + pixels)
+        x = stats1['image'][:, chunk] - stats1['mean'][chunk]
+        y = stats2['image'][:, chunk] - stats2['mean'][chunk]
+        spectrum1 = stats1['spectrum'][:, chunk]
+        spectrum2 = stats2['spectrum'][:, chunk]
+        if method == 'shift':
+            nulls = shift_null(x, y, spectrum1*np.conj(spectrum2), draws,
+                               offset)
+        else:
+            nulls = phase_null(x, y, spectrum1, spectrum2, draws, offset)
+        # Surrogates of each pixel next to each other
+        magnitude = np.empty((x.shape[1], len(draws)))
+        for i, null in enumerate(nulls):
+            np.abs(null.T, out=magnitude)
+            pvalue[i, chunk] = np.count_nonzero(
+                magnitude >= observed[i, chunk, None], axis=1)
+            threshold[i, chunk] = upper_quantile(magnitude,
+                                                 1 - SIGNIFICANCE_LEVEL)
+
+    with np.errstate(invalid='ignore'), ThreadPoolExecutor(workers) as pool:
+        list(pool.map(test, range(0, n_pixels, pixels)))
+    pvalue = (pvalue + 1)/(len(draws) + 1)
+    # Lags with too few overlapping frames have no correlation to test
+    pvalue[np.isnan(observed)] = np.nan
+    threshold[n_t - np.arange(offset) < 2] = np.nan
+    return (pvalue.reshape(corr.shape).astype(stats1['dtype'], copy=False),
+            threshold.reshape(corr.shape),
+            {'method': method, 'surrogates': len(draws)})
@@ -0,0 +1,279 @@
+import os
+import json
+import zipfile
+import numpy as np
+import tifffile as tif
+import CorrProfile
+
+# Lags of a correlation stack stored together, so a few lags can be read
+# without decompressing the whole stack
+LAG_CHUNK = 8
+# zlib level of the store. Most of the saving over CSV files comes from
+# storing binary instead of text, higher levels are much slower for little
+# gain on noisy floating point data.
+COMPRESSION_LEVEL = 1
+
+
+def store_name(im):
+    '''
+    Returns:
+        name (str): filename of the results store of image im
+    '''
+    return 'results_'+im+'.npz'
+
+
+def chunk_name(pair, start):
+    '''
+    Returns:
+        name (str): member of the lags from start of the correlation of pair
+    '''
+    return 'corr/'+pair[0]+'/'+pair[1]+'/'+str(start)
+
+
+def add_array(store, name, array):
+    '''
+    Add an array to an open zip file as name.npy, as numpy.savez does
+    '''
+    with store.open(name+'.npy', 'w', force_zip64=True) as f:
+        np.lib.format.write_array(f, np.asarray(array),
+                                  allow_pickle=False)
+
+
+def write(path, covs, corrs, params, lag_chunk=LAG_CHUNK, profiler=None):
+    '''
+    Save the results of an image at coarse-grained size in one compressed
+    .npz file: the CoV map of each channel, the correlations of each channel
+    pair in chunks of lag_chunk lags, and the parameters of the run. The file
+    can be read with ResultsStore or numpy.load.
+
+    Parameters:
+        path (str): location of the store
+        covs (dict): coefficient of variation of each channel
+        corrs (dict): correlations of each channel pair [lag,x,y]
+        params (dict): parameters of the run, e.g. scalefactor, offset,
+            coarse_method, dtype
+        lag_chunk (int): lags per chunk
+        profiler (CorrProfile.Profiler): records the write_store stage
+
+    Returns:
+        files (list of str): filename of the store
+    '''
+    params = dict(params, channels=list(covs),
+                  pairs=[list(pair) for pair in corrs],
+                  lags=max([corr.shape[0] for corr in corrs.values()],
+                           default=0),
+                  lag_chunk=lag_chunk)
+    with CorrProfile.stage(profiler, 'write_store'):
+        # Written under another name first, so an interrupted write does not
+        # leave a store that looks complete
+        with zipfile.ZipFile(path+'.tmp', 'w', zipfile.ZIP_DEFLATED,
+                             compresslevel=COMPRESSION_LEVEL) as store:
+            add_array(store, 'params', np.array(json.dumps(params)))
+            for ch, cov in covs.items():
+                add_array(store, 'cov/'+ch, cov)
+            for pair, corr in corrs.items():
+                for start in range(0, corr.shape[0], lag_chunk):
+                    add_array(store, chunk_name(pair, start),
+                              corr[start:start+lag_chunk])
+        os.replace(path+'.tmp', path)
+        CorrProfile.add_bytes_written(profiler, [path])
+    return [os.path.basename(path)]
+
+
+class ResultsStore:
+    '''
+    Reads a results store saved by write. Only the chunks holding the
+    requested channel pair and lags are read and decompressed.
+
+    Parameters:
+        path (str): location of the store, corr_<image>/results_<image>.npz
+
+    Attributes:
+        params (dict): parameters of the run
+        channels (list of str): channels with a CoV map
+        pairs (list of tuple): channel pairs with correlations
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.npz = np.load(path, allow_pickle=False)
+        self.params = json.loads(self.npz['params'].item())
+        self.channels = self.params['channels']
+        self.pairs = [tuple(pair) for pair in self.params['pairs']]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, kind, error, trace):
+        self.close()
+
+    def close(self):
+        self.npz.close()
+
+    def upsample(self, array, stack, region=None):
+        import CorrFunctions
+        if region is not None:
+            return CorrFunctions.upsample_region(
+                array, self.params['scalefactor'],
+                self.params['coarse_method'], region)
+        return CorrFunctions.upsample(array, self.params['scalefactor'],
+                                      self.params['coarse_method'],
+                                      stack=stack)
+
+    def cov(self, channel, upsampled=False, region=None):
+        '''
+        Parameters:
+            channel (str): channel name
+            upsampled (bool): rescale to the original image size as the
+                cov_<image>_<channel>.tif files are
+            region (tuple of slices): rows and columns to read, of the
+                upsampled image if upsampled. Only this region is upsampled.
+
+        Returns:
+            cov (numpy array): coefficient of variation of channel
+        '''
+        cov = self.npz['cov/'+channel]
+        if upsampled:
+            return self.upsample(cov, stack=False, region=region)
+        if region is not None:
+            return cov[tuple(region)]
+        return cov
+
+    def corr(self, pair, lags=None, upsampled=False, region=None):
+        '''
+        Parameters:
+            pair (tuple of str): channel names, in either order
+            lags (int, slice or list of ints): lags to read, None for all
+            upsampled (bool): rescale to the original image size as the
+                corr_<image>_<pair>.tif files are
+            region (tuple of slices): rows and columns to read, of the
+                upsampled image if upsampled. Only this region is upsampled.
+
+        Returns:
+            corr (numpy array): correlations of pair [lag,x,y], or [x,y] for
+            a single lag
+        '''
+        pair = tuple(pair)
+        if pair not in self.pairs:
+            pair = pair[::-1]
+        if pair not in self.pairs:
+            raise KeyError('no correlations of '+'-'.join(pair)+' in '
+                           + self.path)
+        chunk = self.params['lag_chunk']
+        if lags is None:
+            lags = slice(None)
+        indices = np.arange(self.params['lags'])[lags]
+        chunks = {start: self.npz[chunk_name(pair, start)]
+                  for start in sorted(set(np.ravel(indices)//chunk*chunk))}
+        corr = np.stack([chunks[i//chunk*chunk][i % chunk]
+                         for i in np.ravel(indices)])
+        if np.ndim(indices) == 0:
+            corr = corr[0]
+        if upsampled:
+            return self.upsample(corr, stack=corr.ndim == 3, region=region)
+        if region is not None:
+            return corr[(Ellipsis,) + tuple(region)]
+        return corr
+
+
+def write_coarse_tiff(path, array, scalefactor, coarse_method,
+                      profiler=None):
+    '''
+    Save a CoV map or correlation stack at coarse-grained size, with the
+    scale factor and coarse_method needed to upsample it in the image
+    description (see CoarseTiff). Each lag is a page of the TIFF.
+
+    Parameters:
+        path (str): location of the TIFF
+        array (numpy array): results at coarse-grained size [x,y] or
+            [lag,x,y]
+        scalefactor (float): scale factor the images were downscaled by
+        coarse_method (str): method the images were coarse-grained with
+        profiler (CorrProfile.Profiler): records the write_tiff stage
+
+    Returns:
+        files (list of str): filename of the TIFF
+    '''
+    shape = list(array.shape[:-2]) + [int(np.ceil((1/scalefactor) * length))
+                                      for length in array.shape[-2:]]
+    # Saved with the shape tifffile records in its JSON image description
+    metadata = {'CorrAndCov': {'scalefactor': scalefactor,
+                               'coarse_method': coarse_method,
+                               'shape': shape}}
+    with CorrProfile.stage(profiler, 'write_tiff'):
+        # One page per lag, also for 3 or 4 lags, which tifffile would
+        # otherwise save as the planes of an RGB image
+        tif.imwrite(path, array, photometric='minisblack', metadata=metadata)
+        CorrProfile.add_bytes_written(profiler, [path])
+    return [os.path.basename(path)]
+
+
+class CoarseTiff:
+    '''
+    Reads a CoV map or correlation stack saved at coarse-grained size by
+    write_coarse_tiff. Only the pages of the requested lags are read, and
+    only the requested region is upsampled, so looking at a few lags or a
+    part of a large field of view costs a fraction of upsampling all of it.
+
+    Parameters:
+        path (str): location of the TIFF, e.g.
+            corr_<image>/corr_<image>_<pair>.tif
+
+    Attributes:
+        params (dict): scale factor and coarse_method of the results, and
+        shape of the upsampled results
+        shape (tuple of int): shape of the upsampled results, [x,y] or
+        [lag,x,y]
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.tiff = tif.TiffFile(path)
+        try:
+            self.params = json.loads(
+                self.tiff.pages[0].description)['CorrAndCov']
+        except (ValueError, KeyError, TypeError):
+            self.tiff.close()
+            raise ValueError(path+' was not saved at coarse-grained size')
+        self.shape = tuple(self.params['shape'])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, kind, error, trace):
+        self.close()
+
+    def close(self):
+        self.tiff.close()
+
+    def read(self, lags=None, region=None, upsampled=True):
+        '''
+        Parameters:
+            lags (int, slice or list of ints): lags to read, None for all.
+                Not used for CoV maps.
+            region (tuple of slices): rows and columns to read, of the
+                upsampled image if upsampled. Only this region is upsampled.
+            upsampled (bool): rescale to the original image size, as the
+                TIFFs of output_format 'files' are
+
+        Returns:
+            array (numpy array): results [x,y], or [lag,x,y] for several lags
+        '''
+        if len(self.shape) == 3:
+            if lags is None:
+                lags = slice(None)
+            indices = np.arange(self.shape[0])[lags]
+            pages = [int(i) for i in np.ravel(indices)]
+            array = np.stack([self.tiff.pages[i].asarray() for i in pages])
+            if np.ndim(indices) == 0:
+                array = array[0]
+        else:
+            array = self.tiff.pages[0].asarray()
+        if upsampled:
+            import CorrFunctions
+            return CorrFunctions.upsample_region(
+                array, self.params['scalefactor'],
+                self.params['coarse_method'], region)
+        if region is not None:
+            return array[(Ellipsis,) + tuple(region)]
+        return array
@@ -0,0 +1,156 @@
+import numpy as np
+import CorrFunctions
+
+
+class CoVAccumulator:
+    '''
+    Coefficient of variation of a 2D+t image fed one frame at a time. The
+    mean and variance of each pixel are updated with Welford's algorithm, so
+    the time series never has to be held in memory.
+    '''
+
+    def __init__(self):
+        self.n = 0
+        self.mean = None
+        self.m2 = None
+
+    def update(self, frame):
+        '''
+        Add the next frame
+
+        Parameters:
+            frame (numpy array): 2D frame [x,y], the running sums are float64
+                for float32 frames too
+        '''
+        frame = np.asarray(frame)
+        if self.mean is None:
+            self.dtype = CorrFunctions.float_dtype(frame)
+            self.mean = np.zeros(frame.shape)
+            self.m2 = np.zeros(frame.shape)
+        self.n += 1
+        delta = frame - self.mean
+        self.mean += delta/self.n
+        self.m2 += delta*(frame - self.mean)
+
+    def result(self):
+        '''
+        Returns:
+            CoV_map (numpy array): same as coefficient_of_variation of the
+            frames added so far
+        '''
+        std_t_image = np.sqrt(self.m2/(self.n-1))
+        CoV_map = std_t_image/np.mean(self.mean)
+        return CoV_map.astype(self.dtype, copy=False)
+
+
+class CorrelationAccumulator:
+    '''
+    Auto- or cross-correlation of two 2D+t images fed one pair of frames at a
+    time. Lag i pairs frame t of the first image with frame t-i of the second,
+    which is kept in a ring buffer of the last offset frames. Each lag keeps
+    Welford-style running means, sums of squares and co-moment, so the result
+    matches cross_correlation without holding the time series.
+    '''
+
+    def __init__(self, offset):
+        self.offset = offset
+        self.n = np.zeros(offset, dtype=np.int64)
+        self.frames = 0
+        self.buffer = None
+
+    def update(self, frame1, frame2):
+        '''
+        Add the next frame of both images
+
+        Parameters:
+            frame1, frame2 (numpy arrays): 2D frames [x,y]. The ring buffer
+                keeps the dtype of float32 frames, the running sums are
+                float64.
+        '''
+        frame1 = np.asarray(frame1)
+        frame2 = np.asarray(frame2)
+        if self.buffer is None:
+            shape = (self.offset,) + frame1.shape
+            self.dtype = CorrFunctions.float_dtype(frame1)
+            self.buffer = np.zeros(shape, dtype=self.dtype)
+            self.mean1 = np.zeros(shape)
+            self.mean2 = np.zeros(shape)
+            self.m2_1 = np.zeros(shape)
+            self.m2_2 = np.zeros(shape)
+            self.comoment = np.zeros(shape)
+        t = self.frames
+        self.buffer[t % self.offset] = frame2
+        self.frames += 1
+        # Lags up to t have a partner frame in the buffer
+        active = min(t+1, self.offset)
+        lagged = self.buffer[(t - np.arange(active)) % self.offset]
+        self.n[:active] += 1
+        n = self.n[:active].reshape(-1, 1, 1)
+        delta1 = frame1 - self.mean1[:active]
+        self.mean1[:active] += delta1/n
+        delta2 = lagged - self.mean2[:active]
+        self.mean2[:active] += delta2/n
+        self.m2_1[:active] += delta1*(frame1 - self.mean1[:active])
+        self.m2_2[:active] += delta2*(lagged - self.mean2[:active])
+        self.comoment[:active] += delta1*(lagged - self.mean2[:active])
+
+    def result(self):
+        '''
+        Returns:
+            corr (numpy array): same as cross_correlation of the frames added
+            so far [lag,x,y]
+        '''
+        offset = CorrFunctions.lags_to_calculate(self.offset, self.frames)
+        corr = (self.comoment[:offset]
+                / np.sqrt(self.m2_1[:offset]*self.m2_2[:offset]))
+        corr = corr.astype(self.dtype, copy=False)
+        # A single overlapping frame has no sample std
+        corr[self.n[:offset] < 2] = np.nan
+        return corr
+
+
+def stream_image(image_paths, scalefactor, offset, chunk_size=16,
+                 coarse_method='bicubic', dtype=np.float64):
+    '''
+    Coarse-grain every channel of one image while it is read and accumulate
+    the CoV of every channel and the correlation of every channel pair. Memory
+    use depends on the coarse-grained frame size and offset, not on the number
+    of frames.
+
+    Parameters:
+        image_paths (dict): channel names and locations of the images
+        scalefactor (float): scale factor to downscale image by
+        offset (int): shift in pixels relative to the reference image
+        chunk_size (int): number of frames to read at once
+        coarse_method (str): see CorrFunctions.coarse_grain_stack
+        dtype (numpy dtype): float64 or float32
+
+    Returns:
+        covs (dict): CoV map of each channel
+        corrs (dict): correlation of each pair in channel_pairs [lag,x,y]
+    '''
+    channels = list(image_paths.keys())
+    # The readers are zipped, so a shorter channel would cut the others
+    frames = {ch: CorrFunctions.count_frames(image_paths[ch])
+              for ch in channels}
+    if len(set(frames.values())) > 1:
+        raise ValueError('every channel needs the same number of frames, '
+                         + ', '.join(ch+' has '+str(n)
+                                     for ch, n in frames.items()))
+    pairs = CorrFunctions.channel_pairs(channels)
+    cov_accumulators = {ch: CoVAccumulator() for ch in channels}
+    corr_accumulators = {c: CorrelationAccumulator(offset) for c in pairs}
+    readers = [CorrFunctions.iter_frames(image_paths[ch], chunk_size)
+               for ch in channels]
+    for blocks in zip(*readers):
+        coarse = {ch: CorrFunctions.coarse_grain_stack(block, scalefactor,
+                                                       coarse_method, dtype)
+                  for ch, block in zip(channels, blocks)}
+        for i in range(blocks[0].shape[0]):
+            for ch in channels:
+                cov_accumulators[ch].update(coarse[ch][i])
+            for c in pairs:
+                corr_accumulators[c].update(coarse[c[0]][i], coarse[c[1]][i])
+    covs = {ch: acc.result() for ch, acc in cov_accumulators.items()}
+    corrs = {c: acc.result() for c, acc in corr_accumulators.items()}
+    return covs, corrs
@@ -0,0 +1,224 @@
+import os
+import json
+import time
+import traceback
+import CorrCache
+import CorrFunctions
+
+# Files in the channel folders that are treated as images
+IMAGE_EXTENSIONS = ('.tif', '.tiff')
+# File in the output folder recording the image sets already processed
+STATE_NAME = 'CorrAndCov_watch.json'
+# Options that change the results, an image set is processed again when they
+# change
+RESULT_OPTIONS = ('coarse_method', 'dtype', 'output_format',
+                  'figure_style', 'window', 'stride', 'surrogates',
+                  'surrogate_method')
+# Seconds before an image set that failed is tried again, doubled after each
+# further failure
+RETRY_DELAY = 60
+# Attempts after which an image set is only tried again once its files change
+MAX_ATTEMPTS = 5
+
+
+def index_images(data_path):
+    '''
+    Find the image sets in data_path that have a file in every channel folder
+
+    Parameters:
+        data_path (str): path to folder where data is stored
+
+    Returns:
+        index (dict): for each complete image filename, the file signature
+        (see CorrCache.file_signature) of each channel
+        newest (dict): for each complete image filename, the latest
+        modification time of its files in seconds
+    '''
+    folders = [entry.name for entry in os.scandir(data_path)
+               if entry.is_dir()]
+    found = {}
+    for folder in folders:
+        for entry in os.scandir(os.path.join(data_path, folder)):
+            if (entry.is_file() and not entry.name.startswith('.')
+                    and entry.name.lower().endswith(IMAGE_EXTENSIONS)):
+                found.setdefault(entry.name, {})[folder] = entry.stat()
+    index = {}
+    newest = {}
+    for image, stats in found.items():
+        if len(stats) < len(folders):
+            # Still waiting for the other channels
+            continue
+        index[image] = {folder: [os.path.abspath(os.path.join(
+            data_path, folder, image)), stat.st_mtime_ns, stat.st_size]
+            for folder, stat in stats.items()}
+        newest[image] = max(stat.st_mtime for stat in stats.values())
+    return index, newest
+
+
+class Watcher:
+    '''
+    Watches a data folder while images are acquired, and processes each new
+    or changed image set once a file exists for it in every channel folder
+    and none of its files has changed for settle_time seconds. Image sets
+    already processed are recorded in CorrAndCov_watch.json in the output
+    folder, so a restarted watcher only processes what is new. Image sets
+    that fail are not recorded, and are tried again after RETRY_DELAY
+    seconds, doubling up to MAX_ATTEMPTS attempts.
+
+    Parameters:
+        data_path (str): path to folder where data is stored
+        actin_folder (str): name of folder containing actin images
+        scalefactor (float): scale factor to downscale images by
+        offset (int): shift in pixels relative to the reference image
+        settle_time (float): seconds the files of an image set must be
+            unchanged before it is processed, so files still being written
+            are not read
+        output_path (str): folder to save results in, None for the folder
+            above the data folder
+        options: passed on to CorrFunctions.calculate_and_create_figures
+    '''
+
+    def __init__(self, data_path, actin_folder, scalefactor, offset,
+                 settle_time=30, output_path=None, **options):
+        self.data_path = data_path
+        self.actin_folder = actin_folder
+        self.scalefactor = scalefactor
+        self.offset = offset
+        self.settle_time = settle_time
+        if output_path is None:
+            output_path = os.path.dirname(data_path)
+        self.output_path = output_path
+        self.options = options
+        self.state_path = os.path.join(output_path, STATE_NAME)
+        self.processed = self.read_state()
+        # Signature, attempts and time of the next attempt of each image set
+        # that failed, kept until the watcher stops
+        self.failures = {}
+
+    def read_state(self):
+        '''
+        Returns:
+            processed (dict): signature of each image set already processed
+        '''
+        try:
+            with open(self.state_path) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def write_state(self):
+        if not os.path.exists(self.output_path):
+            os.makedirs(self.output_path, exist_ok=True)
+        with open(self.state_path+'.tmp', 'w') as f:
+            json.dump(self.processed, f, indent=1, sort_keys=True)
+        os.replace(self.state_path+'.tmp', self.state_path)
+
+    def signature(self, files):
+        '''
+        Parameters:
+            files (dict): file signature of each channel of an image set
+
+        Returns:
+            signature (str): signature of the image set and the parameters
+        '''
+        options = {name: str(self.options[name]) for name in RESULT_OPTIONS
+                   if self.options.get(name) is not None}
+        return CorrCache.hash_key(files, self.actin_folder, self.scalefactor,
+                                  self.offset, options)
+
+    def scan(self):
+        '''
+        Returns:
+            ready (dict): signature of each image set to process now
+        '''
+        index, newest = index_images(self.data_path)
+        now = time.time()
+        ready = {}
+        for image, files in index.items():
+            if now - newest[image] < self.settle_time:
+                continue
+            signature = self.signature(files)
+            if (self.processed.get(image) != signature
+                    and not self.waiting(image, signature, now)):
+                ready[image] = signature
+        return ready
+
+    def waiting(self, image, signature, now):
+        '''
+        Returns:
+            waiting (bool): True if the image set failed with the same
+            signature and is not to be tried again yet
+        '''
+        failure = self.failures.get(image)
+        if failure is None or failure['signature'] != signature:
+            return False
+        return (failure['attempts'] >= MAX_ATTEMPTS
+                or now < failure['retry_at'])
+
+    def record_failure(self, image, signature):
+        '''
+        Count a failed attempt of an image set and schedule the next one
+        '''
+        failure = self.failures.get(image)
+        attempts = 1
+        if failure is not None and failure['signature'] == signature:
+            attempts = failure['attempts'] + 1
+        delay = RETRY_DELAY*2**(attempts-1)
+        self.failures[image] = {'signature': signature, 'attempts': attempts,
+                                'retry_at': time.time() + delay}
+        if attempts >= MAX_ATTEMPTS:
+            print(image+' failed '+str(attempts)+' times, it is tried again '
+                  'once its files change')
+        else:
+            print(image+' failed, trying again in '+str(delay)+' s')
+
+    def process(self, ready):
+        '''
+        Process image sets and record the ones that succeed as processed.
+        An image set that fails is tried again later, see Watcher.
+
+        Parameters:
+            ready (dict): signature of each image set, from scan
+
+        Returns:
+            failed (list of str): filenames of the image sets that failed
+        '''
+        failed = []
+        for image, signature in sorted(ready.items()):
+            print('Processing '+image)
+            try:
+                CorrFunctions.calculate_and_create_figures(
+                    self.data_path, self.actin_folder, self.scalefactor,
+                    self.offset, output_path=self.output_path,
+                    images=[image], **self.options)
+            except Exception:
+                traceback.print_exc()
+                failed.append(image)
+                self.record_failure(image, signature)
+                continue
+            self.failures.pop(image, None)
+            self.processed[image] = signature
+            self.write_state()
+        return failed
+
+    def run(self, interval=10, stop=None):
+        '''
+        Scan and process until stopped, see watch
+        '''
+        watch([self], interval, stop)
+
+
+def watch(watchers, interval=10, stop=None):
+    '''
+    Scan and process the data folders of several watchers until stopped
+
+    Parameters:
+        watchers (list of Watcher): watchers of each data folder
+        interval (float): seconds between scans
+        stop (callable): returns True to stop, e.g. the is_set method of a
+            threading.Event; None runs until interrupted
+    '''
+    while stop is None or not stop():
+        for watcher in watchers:
+            watcher.process(watcher.scan())
+        time.sleep(interval)
@@ -0,0 +1,118 @@
+import numpy as np
+import CorrFunctions
+
+
+def window_starts(n_t, window, stride):
+    '''
+    First frame of each sliding window
+
+    Parameters:
+        n_t (int): number of frames
+        window (int): frames in each window
+        stride (int): frames between the starts of consecutive windows
+
+    Returns:
+        starts (numpy array): window k covers frames starts[k] to
+        starts[k]+window-1
+    '''
+    if window < 2 or window > n_t:
+        raise ValueError('window should be between 2 and the number of '
+                         'frames ('+str(n_t)+')')
+    if stride < 1:
+        raise ValueError('stride should be at least 1')
+    return np.arange(0, n_t - window + 1, stride)
+
+
+def window_statistics(image):
+    '''
+    Running sums over time of one channel, shared by sliding_cov and every
+    sliding_correlation it is part of. The sum of frames a to b-1 is then
+    sums[b] - sums[a], so the sums of each window cost the same whatever the
+    window length. The image is centred on its mean over time first, so the
+    differences of running sums keep their precision.
+
+    Parameters:
+        image (numpy array): 2D+t image [t,x,y]
+
+    Returns:
+        stats (dict): the centred image [t,pixel] in float64, running sums
+        of it and of its square [t+1,pixel], the mean over time of each
+        pixel, and the shape and float type of image
+    '''
+    n_t = image.shape[0]
+    mean = np.mean(image.reshape(n_t, -1), axis=0, dtype=np.float64)
+    centred = image.reshape(n_t, -1) - mean
+    sums = np.zeros((n_t + 1, centred.shape[1]))
+    squares = np.zeros((n_t + 1, centred.shape[1]))
+    np.cumsum(centred, axis=0, out=sums[1:])
+    np.cumsum(centred**2, axis=0, out=squares[1:])
+    return {'centred': centred, 'sums': sums, 'squares': squares,
+            'mean': mean, 'shape': image.shape,
+            'dtype': CorrFunctions.float_dtype(image)}
+
+
+def sliding_cov(stats, window, stride):
+    '''
+    coefficient_of_variation of each sliding window
+
+    Parameters:
+        stats (dict): window_statistics of the image
+        window (int): frames in each window
+        stride (int): frames between the starts of consecutive windows
+
+    Returns:
+        CoV_maps (numpy array): CoV of each window [window,x,y]
+    '''
+    starts = window_starts(stats['shape'][0], window, stride)
+    total = stats['sums'][starts + window] - stats['sums'][starts]
+    squares = stats['squares'][starts + window] - stats['squares'][starts]
+    variance = np.maximum(squares - total**2/window, 0)/(window - 1)
+    window_mean = total/window + stats['mean']
+    CoV_maps = np.sqrt(variance)/np.mean(window_mean, axis=1, keepdims=True)
+    return CoV_maps.reshape((len(starts),) + stats['shape'][1:]).astype(
+        stats['dtype'], copy=False)
+
+
+def sliding_correlation(stats1, stats2, offset, window, stride):
+    '''
+    cross_correlation of each sliding window: lag i of a window correlates
+    frames i to window-1 of the first image with frames 0 to window-1-i of
+    the second, as cross_correlation of the frames of the window does. The
+    lagged products are summed once over the whole movie for each lag, so
+    the cost grows with the movie length, not with windows x window length.
+
+    Parameters:
+        stats1, stats2 (dicts): window_statistics of the images to compare
+        offset (int): number of time lags to calculate, cut to the window
+            as in CorrFunctions.lags_to_calculate
+        window (int): frames in each window
+        stride (int): frames between the starts of consecutive windows
+
+    Returns:
+        corr (numpy array): correlation values [window,lag,x,y]
+    '''
+    n_t, n_pixels = stats1['centred'].shape
+    starts = window_starts(n_t, window, stride)
+    offset = CorrFunctions.lags_to_calculate(offset, window)
+    corr = np.zeros((len(starts), offset, n_pixels), dtype=stats1['dtype'])
+    products = np.zeros((n_t + 1, n_pixels))
+    for i in range(offset):
+        n = window - i
+        np.cumsum(stats1['centred'][i:]*stats2['centred'][:n_t - i], axis=0,
+                  out=products[1:n_t - i + 1])
+        product = products[starts + n] - products[starts]
+        total1 = stats1['sums'][starts + window] - stats1['sums'][starts + i]
+        squares1 = (stats1['squares'][starts + window]
+                    - stats1['squares'][starts + i])
+        total2 = stats2['sums'][starts + n] - stats2['sums'][starts]
+        squares2 = stats2['squares'][starts + n] - stats2['squares'][starts]
+        if n < 2:
+            # A single overlapping frame has no sample std, as in
+            # cross_correlation
+            corr[:, i] = np.nan
+            continue
+        covariance = product - total1*total2/n
+        variances = ((squares1 - total1**2/n)*(squares2 - total2**2/n))
+        corr[:, i] = covariance/np.sqrt(np.maximum(variances, 0))
+    return corr.reshape((len(starts), offset) + stats1['shape'][1:])
+
@@ -0,0 +1,194 @@
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+import numpy as np
+import CorrProfile
+
+# Default bytes of results waiting to be written
+BUFFER_BYTES = 256*1024**2
+
+
+class WriteError(Exception):
+    '''
+    Raised at the end of a run when outputs could not be written
+    '''
+
+
+class Writer:
+    '''
+    Writes outputs (upsampling, TIFF and PNG encoding and CSV files) in a
+    background thread while the next results are calculated. Calculation
+    waits when the arrays of the outputs still to be written would take more
+    than max_bytes, so pending outputs cannot fill the memory. An output that
+    fails does not stop the run; the failures are raised together as
+    WriteError by close.
+
+    Parameters:
+        max_bytes (int): bytes of arrays waiting to be written. 0 writes each
+            output in the calling thread before returning.
+        threads (int): number of writing threads
+        profiler (CorrProfile.Profiler): records each write as a stage
+            named when it is submitted, with the CPU time of the writing
+            thread, and the time calculation waits for pending outputs as
+            'queue_save'
+    '''
+
+    def __init__(self, max_bytes=BUFFER_BYTES, threads=1, profiler=None):
+        self.max_bytes = max_bytes
+        self.profiler = profiler
+        self.pending = 0
+        self.condition = threading.Condition()
+        self.jobs = []
+        self.errors = []
+        self.records = []
+        self.pool = None
+        if max_bytes > 0:
+            self.pool = ThreadPoolExecutor(threads,
+                                           thread_name_prefix='CorrWriter')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, kind, error, trace):
+        if kind is None:
+            self.close()
+            return
+        # Keep the outputs already calculated, and the original error
+        try:
+            self.close()
+        except WriteError as write_error:
+            print(write_error)
+
+    def submit(self, function, *args, labels=None, stage='write', **kwargs):
+        '''
+        Write an output
+
+        Parameters:
+            function (callable): called as function(*args, profiler=...,
+                **kwargs), e.g. save_cross_correlation
+            args: arguments of function. Arrays, also in dicts, count
+                towards max_bytes; views of larger arrays are copied, so the
+                larger arrays are not kept in memory until the output is
+                written.
+            labels (dict): image, channel, pair etc. the output belongs to
+            stage (str): name of the profiler stage of the write, e.g.
+                'save_correlation'
+            kwargs: keyword arguments of function, counted and copied as
+                args are
+
+        Returns:
+            job (concurrent.futures.Future): return value of function
+        '''
+        labels = labels or {}
+        if self.pool is None:
+            job = Future()
+            try:
+                with CorrProfile.stage(self.profiler, stage, **labels):
+                    job.set_result(function(*args, profiler=self.profiler,
+                                            **kwargs))
+            except Exception as error:
+                self.errors.append(describe(labels, error))
+                job.set_exception(error)
+            self.jobs.append(job)
+            return job
+        args = [own(arg) for arg in args]
+        kwargs = {key: own(value) for key, value in kwargs.items()}
+        nbytes = (sum(array_bytes(arg) for arg in args)
+                  + sum(array_bytes(value) for value in kwargs.values()))
+        with self.condition:
+            # An output larger than max_bytes is written on its own
+            if self.pending and self.pending + nbytes > self.max_bytes:
+                with CorrProfile.stage(self.profiler, 'queue_save',
+                                       **labels):
+                    while (self.pending
+                           and self.pending + nbytes > self.max_bytes):
+                        self.condition.wait()
+            self.pending += nbytes
+        job = self.pool.submit(self.write, nbytes, labels, stage, function,
+                               args, kwargs)
+        self.jobs.append(job)
+        self.add_records()
+        return job
+
+    def write(self, nbytes, labels, stage, function, args, kwargs):
+        '''
+        Writing thread: call function and release its bytes
+        '''
+        profiler = None
+        if self.profiler is not None:
+            # Profilers are not shared between threads
+            profiler = CorrProfile.Profiler(trace_memory=False, thread=True)
+        try:
+            with CorrProfile.stage(profiler, stage, **labels):
+                return function(*args, profiler=profiler, **kwargs)
+        except Exception as error:
+            with self.condition:
+                self.errors.append(describe(labels, error))
+            raise
+        finally:
+            with self.condition:
+                if profiler is not None:
+                    self.records += profiler.records
+                self.pending -= nbytes
+                self.condition.notify_all()
+
+    def add_records(self):
+        '''
+        Add the records of completed writes to the profiler
+        '''
+        with self.condition:
+            records, self.records = self.records, []
+        for record in records:
+            self.profiler.add(record)
+
+    def close(self):
+        '''
+        Wait for every output to be written
+
+        Raises:
+            WriteError: if any output could not be written
+        '''
+        if self.pool is not None:
+            self.pool.shutdown(wait=True)
+        self.add_records()
+        first = next((job.exception() for job in self.jobs
+                      if job.exception() is not None), None)
+        errors, self.errors, self.jobs = self.errors, [], []
+        if errors:
+            raise WriteError(str(len(errors))+' outputs could not be '
+                             'written:\n'+'\n'.join(errors)) from first
+
+
+def own(arg):
+    '''
+    Returns:
+        arg: copy of arg if it is a view of a larger array, or a dict of
+        them; arg otherwise
+    '''
+    if isinstance(arg, dict):
+        return {key: own(value) for key, value in arg.items()}
+    if isinstance(arg, np.ndarray) and arg.base is not None:
+        return arg.copy()
+    return arg
+
+
+def array_bytes(arg):
+    '''
+    Returns:
+        nbytes (int): bytes of arg if it is an array, or of the arrays in a
+        dict
+    '''
+    if isinstance(arg, dict):
+        return sum(array_bytes(value) for value in arg.values())
+    if isinstance(arg, np.ndarray):
+        return arg.nbytes
+    return 0
+
+
+def describe(labels, error):
+    '''
+    Returns:
+        text (str): the labels of an output that failed and its error
+    '''
+    names = ', '.join(str(value) for value in labels.values())
+    return '{}: {}: {}'.format(names or 'output', type(error).__name__,
+                               error)
@@ -0,0 +1,335 @@
+'''
+Benchmarks of the CorrAndCov hot paths on synthetic 2D+t stacks.
+
+Times and memory-profiles each step and checks that the faster code paths
+agree with the reference implementations. Results are saved as JSON, so runs
+on different versions can be compared.
+
+Usage:
+    python benchmark.py --frames 200 --size 256 --channels 3 \
+        --output benchmark.json --compare previous.json
+'''
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import tracemalloc
+import numpy as np
+import tifffile as tif
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import CorrFunctions  # noqa: E402
+import CorrStreaming  # noqa: E402
+from matlab_imresize.imresize import imresize  # noqa: E402
+from matlab_imresize.imresize import (  # noqa: E402
+    contributions, cubic, deriveSizeFromScale, imresizevec)
+
+
+def make_dataset(data_path, frames, size, channels, seed=0):
+    '''
+    Write a synthetic dataset: one folder per channel, each holding the same
+    image names. Channels share a slowly varying signal plus noise, so they are
+    correlated at short lags.
+
+    Parameters:
+        data_path (str): folder to write the channel folders in
+        frames (int): number of time points
+        size (int): width and height of the field of view
+        channels (int): number of channels, the first is called actin
+        seed (int): random seed
+
+    Returns:
+        folders (list of str): channel folder names
+    '''
+    rng = np.random.default_rng(seed)
+    signal = np.cumsum(rng.standard_normal((frames, size, size)), axis=0)
+    signal -= signal.min()
+    folders = ['actin'] + ['binder'+str(i) for i in range(1, channels)]
+    for i, folder in enumerate(folders):
+        os.makedirs(os.path.join(data_path, folder), exist_ok=True)
+        image = (1000 + 10*np.roll(signal, i, axis=0)
+                 + 50*rng.standard_normal((frames, size, size)))
+        tif.imwrite(os.path.join(data_path, folder, 'synthetic.tif'),
+                   np.clip(image, 0, 65535).astype(np.uint16))
+    return folders
+
+
+def per_frame_imresize(image, scalefactor):
+    '''
+    Bicubic resizing as CorrAndCov first did it: one imresize call per frame,
+    working out the weights again for every frame
+
+    Parameters:
+        image (numpy array): image stack [t,x,y]
+        scalefactor (float): amount to resize the frames by
+
+    Returns:
+        resized (numpy array): resized image stack [t,x,y]
+    '''
+    size = deriveSizeFromScale(image.shape[1:], [scalefactor, scalefactor])
+    resized = []
+    for frame in image:
+        frame = frame[..., np.newaxis]
+        for dim in range(2):
+            weights, indices = contributions(frame.shape[dim], size[dim],
+                                             scalefactor, cubic, 4.0)
+            frame = imresizevec(frame, weights, indices, dim)
+        resized.append(frame[..., 0])
+    return np.stack(resized)
+
+
+def measure(function, repeat):
+    '''
+    Time function over repeat runs, then run it once more under tracemalloc to
+    record the peak memory it allocates
+
+    Parameters:
+        function (callable): function without arguments
+        repeat (int): number of timed runs
+
+    Returns:
+        result (dict): best and mean wall time, CPU time and peak memory
+        output: return value of the last call
+    '''
+    wall = []
+    cpu = []
+    for i in range(repeat):
+        start_wall = time.perf_counter()
+        start_cpu = time.process_time()
+        output = function()
+        cpu.append(time.process_time() - start_cpu)
+        wall.append(time.perf_counter() - start_wall)
+    tracemalloc.start()
+    function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    result = {'wall_best': min(wall), 'wall_mean': float(np.mean(wall)),
+              'cpu_best': min(cpu), 'peak_memory': peak}
+    return result, output
+
+
+def max_difference(a, b):
+    '''
+    Returns:
+        difference (float): largest absolute difference, ignoring NaNs that
+        occur in both, inf if the shapes or NaNs differ
+    '''
+    a = np.asarray(a, dtype=np.float64)
+    b = np.asarray(b, dtype=np.float64)
+    if a.shape != b.shape or np.any(np.isnan(a) != np.isnan(b)):
+        return float('inf')
+    if a.size == 0 or np.all(np.isnan(a)):
+        return 0.0
+    return float(np.nanmax(np.abs(a - b)))
+
+
+def run(args):
+    '''
+    Run every benchmark and agreement check
+
+    Parameters:
+        args (argparse.Namespace): command line options
+
+    Returns:
+        report (dict): parameters, timings and agreement results
+    '''
+    work_path = tempfile.mkdtemp(prefix='CorrAndCov_benchmark_')
+    data_path = os.path.join(work_path, 'data')
+    timings = {}
+    agreement = {}
+    # float32 results are compared with float64 at the documented tolerance
+    tolerances = {'float32_correlation': CorrFunctions.FLOAT32_TOLERANCE}
+    try:
+        folders = make_dataset(data_path, args.frames, args.size,
+                               args.channels, args.seed)
+        paths = [os.path.join(data_path, folder, 'synthetic.tif')
+                 for folder in folders]
+        raw = CorrFunctions.load_image(paths[0])
+        # Resizing, against the original per-frame resizing
+        timings['imresize_down_per_frame'], reference = measure(
+            lambda: per_frame_imresize(raw, args.scalefactor), args.repeat)
+        timings['imresize_up_per_frame'] = measure(
+            lambda: per_frame_imresize(reference, 1/args.scalefactor),
+            args.repeat)[0]
+        for mode in args.imresize_modes:
+            timings['imresize_down_'+mode], resized = measure(
+                lambda: imresize(raw, scalar_scale=args.scalefactor,
+                                 stack=True, mode=mode), args.repeat)
+            timings['imresize_up_'+mode] = measure(
+                lambda: imresize(resized, scalar_scale=1/args.scalefactor,
+                                 stack=True, mode=mode), args.repeat)[0]
+            agreement['imresize_'+mode] = max_difference(resized, reference)
+        # Coarse-graining
+        timings['coarse_grain_and_normalise'], image = measure(
+            lambda: CorrFunctions.coarse_grain_and_normalise(
+                paths[0], args.scalefactor), args.repeat)
+        timings['coarse_grain_and_normalise_stream'], streamed = measure(
+            lambda: CorrFunctions.coarse_grain_and_normalise(
+                paths[0], args.scalefactor, stream=True), args.repeat)
+        agreement['coarse_grain_stream'] = max_difference(streamed, image)
+        timings['coarse_grain_block'], blocks = measure(
+            lambda: CorrFunctions.coarse_grain_stack(
+                raw, args.scalefactor, 'block'), args.repeat)
+        timings['upsample_block'] = measure(
+            lambda: CorrFunctions.upsample(
+                blocks, args.scalefactor, 'block', stack=True),
+            args.repeat)[0]
+        images = [CorrFunctions.coarse_grain_and_normalise(
+            path, args.scalefactor) for path in paths]
+        # Statistics
+        timings['coefficient_of_variation'], cov = measure(
+            lambda: CorrFunctions.coefficient_of_variation(
+                image, args.scalefactor), args.repeat)
+        corr = {}
+        for method in ['fft', 'direct']:
+            timings['cross_correlation_'+method], corr[method] = measure(
+                lambda: CorrFunctions.cross_correlation(
+                    images[0], images[-1], args.scalefactor, args.offset,
+                    method=method), args.repeat)
+        agreement['cross_correlation_fft'] = max_difference(
+            corr['fft'], corr['direct'])
+        timings['pairwise_correlation'], pairwise = measure(
+            lambda: CorrFunctions.pairwise_correlation(
+                images, args.scalefactor, args.offset), args.repeat)
+        # A quarter of the memory the whole field of view would need
+        budget = CorrFunctions.correlation_bytes_per_pixel(
+            images[0].shape[0], args.offset, len(images)) * (
+                images[0].shape[1]*images[0].shape[2]//4)
+        timings['pairwise_correlation_tiled'], tiled = measure(
+            lambda: CorrFunctions.pairwise_correlation(
+                images, args.scalefactor, args.offset,
+                memory_budget=budget), args.repeat)
+        agreement['pairwise_correlation_tiled'] = max_difference(tiled,
+                                                                 pairwise)
+        images32 = [image.astype(np.float32) for image in images]
+        timings['pairwise_correlation_float32'], pairwise32 = measure(
+            lambda: CorrFunctions.pairwise_correlation(
+                images32, args.scalefactor, args.offset), args.repeat)
+        agreement['float32_correlation'] = max_difference(pairwise32,
+                                                          pairwise)
+        agreement['pairwise_correlation'] = max(
+            max_difference(pairwise[a, b], CorrFunctions.cross_correlation(
+                images[a], images[b], args.scalefactor, args.offset,
+                method='direct'))
+            for a in range(len(images)) for b in range(len(images)))
+        covs, corrs = CorrStreaming.stream_image(
+            {'first': paths[0], 'last': paths[-1]}, args.scalefactor,
+            args.offset)
+        agreement['streaming_cov'] = max_difference(covs['first'], cov)
+        agreement['streaming_correlation'] = max_difference(
+            corrs['last', 'first'], CorrFunctions.cross_correlation(
+                images[-1], images[0], args.scalefactor, args.offset,
+                method='direct'))
+        # Outputs
+        figure_path = os.path.join(work_path, 'figure')
+        os.makedirs(figure_path)
+        timings['create_scatter_figure'] = measure(
+            lambda: CorrFunctions.create_scatter_figure(
+                cov, corr['fft'][0], 'benchmark', figure_path),
+            args.repeat)[0]
+        timings['create_density_figures'] = measure(
+            lambda: CorrFunctions.create_density_figures(
+                cov, corr['fft'], 'benchmark', figure_path),
+            args.repeat)[0]
+        timings['calculate_and_create_figures'] = measure(
+            lambda: CorrFunctions.calculate_and_create_figures(
+                data_path, folders[0], args.scalefactor, args.offset,
+                workers=args.workers), 1)[0]
+    finally:
+        shutil.rmtree(work_path, ignore_errors=True)
+    report = {
+        'parameters': vars(args),
+        'environment': {'python': platform.python_version(),
+                        'numpy': np.__version__,
+                        'platform': platform.platform(),
+                        'cpus': os.cpu_count()},
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'timings': timings,
+        # Downscaling of each mode relative to the per-frame resizing
+        'imresize_speedup': {
+            mode: timings['imresize_down_per_frame']['wall_best']
+            / max(timings['imresize_down_'+mode]['wall_best'], 1e-12)
+            for mode in args.imresize_modes},
+        'agreement': agreement,
+        'agreement_passed': all(
+            value <= tolerances.get(name, args.tolerance)
+            for name, value in agreement.items())}
+    return report
+
+
+def compare(report, previous):
+    '''
+    Print the change in time and memory of each benchmark relative to an
+    earlier report
+
+    Parameters:
+        report (dict): report of this run
+        previous (dict): report of an earlier run
+    '''
+    for name, result in report['timings'].items():
+        if name not in previous['timings']:
+            continue
+        before = previous['timings'][name]
+        print('{:40s} time x{:6.2f}  memory x{:6.2f}'.format(
+            name, result['wall_best']/max(before['wall_best'], 1e-12),
+            result['peak_memory']/max(before['peak_memory'], 1)))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark CorrAndCov on synthetic 2D+t stacks')
+    parser.add_argument('--frames', type=int, default=200,
+                        help='number of time points')
+    parser.add_argument('--size', type=int, default=256,
+                        help='width and height of the field of view')
+    parser.add_argument('--channels', type=int, default=3,
+                        help='number of channels')
+    parser.add_argument('--scalefactor', type=float, default=0.25,
+                        help='scale factor to downscale images by')
+    parser.add_argument('--offset', type=int, default=60,
+                        help='number of time lags')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='processes for calculate_and_create_figures')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='timed runs of each benchmark')
+    parser.add_argument('--imresize-modes', nargs='+',
+                        default=['vec', 'matrix', 'org'],
+                        help='imresize modes to benchmark')
+    parser.add_argument('--tolerance', type=float, default=1e-8,
+                        help='largest accepted difference to the reference')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='random seed of the synthetic data')
+    parser.add_argument('--output', default='benchmark.json',
+                        help='JSON file to save results to')
+    parser.add_argument('--compare',
+                        help='JSON file of an earlier run to compare to')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    report = run(args)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=1)
+    for name, result in report['timings'].items():
+        print('{:40s} {:10.4f} s {:12.1f} MB'.format(
+            name, result['wall_best'], result['peak_memory']/1e6))
+    for mode, speedup in report['imresize_speedup'].items():
+        print('{:40s} x{:.2f} the speed of per frame'.format(
+            'imresize_down_'+mode, speedup))
+    for name, difference in report['agreement'].items():
+        print('{:40s} {:.3g}'.format(name, difference))
+    if args.compare:
+        with open(args.compare) as f:
+            compare(report, json.load(f))
+    if not report['agreement_passed']:
+        print('Agreement check failed')
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,8 @@
+import os
+import sys
+
+# The tests import the modules at the top of the repository
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# Python 2 script that writes its output next to it, run it from its folder
+collect_ignore = [os.path.join('matlab_imresize', 'test', 'test_imresize.py')]
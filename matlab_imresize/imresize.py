@@ -1,6 +1,10 @@
 from __future__ import print_function
 import numpy as np
 from math import ceil, floor
+from functools import lru_cache
+
+# Number of (in_length, out_length, scale, kernel) weight sets kept in memory
+CONTRIBUTIONS_CACHE_SIZE = 64
 
 def deriveSizeFromScale(img_shape, scale):
     output_shape = []
@@ -51,12 +55,20 @@ def contributions(in_length, out_length, scale, kernel, k_width):
     indices = indices[:, ind2store]
     return weights, indices
 
-def imresizemex(inimg, weights, indices, dim):
+@lru_cache(maxsize=CONTRIBUTIONS_CACHE_SIZE)
+def cachedContributions(in_length, out_length, scale, kernel, k_width):
+    weights, indices = contributions(in_length, out_length, scale, kernel, k_width)
+    # Shared between calls, so guard against in-place changes
+    weights.flags.writeable = False
+    indices.flags.writeable = False
+    return weights, indices
+
+def imresizemex(inimg, weights, indices, dim, dtype=np.float64):
     in_shape = inimg.shape
     w_shape = weights.shape
     out_shape = list(in_shape)
     out_shape[dim] = w_shape[0]
-    outimg = np.zeros(out_shape)
+    outimg = np.zeros(out_shape, dtype=dtype)
     if dim == 0:
         for i_img in range(in_shape[1]):
             for i_w in range(w_shape[0]):
@@ -77,28 +89,67 @@ def imresizemex(inimg, weights, indices, dim):
     else:
         return outimg
 
-def imresizevec(inimg, weights, indices, dim):
+def imresizevec(inimg, weights, indices, dim, dtype=np.float64):
     wshape = weights.shape
+    weights = weights.astype(dtype, copy=False)
     if dim == 0:
         weights = weights.reshape((wshape[0], wshape[2], 1, 1))
-        outimg =  np.sum(weights*((inimg[indices].squeeze(axis=1)).astype(np.float64)), axis=1)
+        outimg =  np.sum(weights*((inimg[indices].squeeze(axis=1)).astype(dtype)), axis=1)
     elif dim == 1:
         weights = weights.reshape((1, wshape[0], wshape[2], 1))
-        outimg =  np.sum(weights*((inimg[:, indices].squeeze(axis=2)).astype(np.float64)), axis=2)
+        outimg =  np.sum(weights*((inimg[:, indices].squeeze(axis=2)).astype(dtype)), axis=2)
+    if inimg.dtype == np.uint8:
+        outimg = np.clip(outimg, 0, 255)
+        return np.around(outimg).astype(np.uint8)
+    else:
+        return outimg
+
+def resampleMatrix(weights, indices, in_length):
+    # Dense [out_length, in_length] matrix; mirrored border indices repeat
+    # within a row, so their weights are summed
+    w_shape = weights.shape
+    matrix = np.zeros((w_shape[0], in_length))
+    rows = np.repeat(np.arange(w_shape[0]), w_shape[-1])
+    np.add.at(matrix, (rows, indices.ravel()), weights.ravel())
+    return matrix
+
+@lru_cache(maxsize=CONTRIBUTIONS_CACHE_SIZE)
+def cachedResampleMatrix(in_length, out_length, scale, kernel, k_width):
+    # Same key as cachedContributions, so the matrix of each axis is built
+    # once rather than on every call
+    weights, indices = cachedContributions(in_length, out_length, scale, kernel, k_width)
+    matrix = resampleMatrix(weights, indices, in_length)
+    matrix.flags.writeable = False
+    return matrix
+
+def imresizemat(inimg, matrix, dim, dtype=np.float64):
+    # Matrix product along dim, so the work goes to BLAS and no gathered
+    # copy of the input is made. float32 uses single precision BLAS.
+    matrix = matrix.astype(dtype, copy=False)
+    if inimg.dtype != np.uint8:
+        inimg = inimg.astype(dtype, copy=False)
+    if dim == 0:
+        outimg = np.tensordot(matrix, inimg, axes=(1, 0))
+    elif dim == 1:
+        outimg = np.moveaxis(np.tensordot(inimg, matrix, axes=(1, 1)), -1, 1)
     if inimg.dtype == np.uint8:
         outimg = np.clip(outimg, 0, 255)
         return np.around(outimg).astype(np.uint8)
     else:
         return outimg
 
-def resizeAlongDim(A, dim, weights, indices, mode="vec"):
+def resizeAlongDim(A, dim, weights, indices, mode="vec", dtype=np.float64, matrix=None):
     if mode == "org":
-        out = imresizemex(A, weights, indices, dim)
+        out = imresizemex(A, weights, indices, dim, dtype)
+    elif mode == "matrix":
+        if matrix is None:
+            matrix = resampleMatrix(weights, indices, A.shape[dim])
+        out = imresizemat(A, matrix, dim, dtype)
     else:
-        out = imresizevec(A, weights, indices, dim)
+        out = imresizevec(A, weights, indices, dim, dtype)
     return out
 
-def imresize(I, scalar_scale=None, method='bicubic', output_shape=None, mode="vec"):
+def imresize(I, scalar_scale=None, method='bicubic', output_shape=None, mode="vec", stack=False, dtype=np.float64):
     if method == 'bicubic':
         kernel = cubic
     elif method == 'bilinear':
@@ -107,6 +158,10 @@ def imresize(I, scalar_scale=None, method='bicubic', output_shape=None, mode="ve
         raise ValueError('unidentified kernel method supplied')
         
     kernel_width = 4.0
+    # A stack is [t,x,y]: resize x and y of every frame in one pass by
+    # treating time like the channel dimension of a colour image
+    if stack:
+        I = np.moveaxis(I, 0, -1)
     # Fill scale and output_size
     if scalar_scale is not None and output_shape is not None:
         raise ValueError('either scalar_scale OR output_shape should be defined')
@@ -123,20 +178,27 @@ def imresize(I, scalar_scale=None, method='bicubic', output_shape=None, mode="ve
     order = np.argsort(scale_np)
     weights = []
     indices = []
+    matrices = []
     for k in range(2):
-        w, ind = contributions(I.shape[k], output_size[k], scale[k], kernel, kernel_width)
+        w, ind = cachedContributions(I.shape[k], output_size[k], scale[k], kernel, kernel_width)
         weights.append(w)
         indices.append(ind)
-    B = np.copy(I) 
+        if mode == "matrix":
+            matrices.append(cachedResampleMatrix(I.shape[k], output_size[k], scale[k], kernel, kernel_width))
+        else:
+            matrices.append(None)
+    B = I
     flag2D = False
     if B.ndim == 2:
         B = np.expand_dims(B, axis=2)
         flag2D = True
     for k in range(2):
         dim = order[k]
-        B = resizeAlongDim(B, dim, weights[dim], indices[dim], mode)
+        B = resizeAlongDim(B, dim, weights[dim], indices[dim], mode, dtype, matrices[dim])
     if flag2D:
         B = np.squeeze(B, axis=2)
+    if stack:
+        B = np.ascontiguousarray(np.moveaxis(B, -1, 0))
     return B
 
 def convertDouble2Byte(I):
@@ -0,0 +1,93 @@
+import os
+import numpy as np
+import pytest
+from matlab_imresize.imresize import (imresize, cachedContributions, cubic,
+                                      cachedResampleMatrix, resampleMatrix,
+                                      convertDouble2Byte)
+
+MODES = ('org', 'vec', 'matrix')
+FOLDER = os.path.dirname(os.path.abspath(__file__))
+
+
+def read_png(name):
+    from matplotlib.image import imread
+    return np.around(imread(os.path.join(FOLDER, name))*255).astype(np.uint8)
+
+
+def random_stack(shape=(4, 23, 17), seed=0):
+    return np.random.default_rng(seed).uniform(0, 100, shape)
+
+
+@pytest.mark.parametrize('mode', MODES)
+@pytest.mark.parametrize('scale', [0.25, 0.5, 2.0])
+def test_stack_matches_each_frame(mode, scale):
+    stack = random_stack()
+    resized = imresize(stack, scalar_scale=scale, stack=True, mode=mode)
+    frames = np.stack([imresize(frame, scalar_scale=scale, mode=mode)
+                       for frame in stack])
+    assert resized.shape == frames.shape
+    assert resized.flags['C_CONTIGUOUS']
+    np.testing.assert_allclose(resized, frames, rtol=0, atol=1e-12)
+
+
+def test_stack_of_one_frame():
+    stack = random_stack((1, 16, 12))
+    np.testing.assert_allclose(
+        imresize(stack, output_shape=(4, 3), stack=True)[0],
+        imresize(stack[0], output_shape=(4, 3)), rtol=0, atol=1e-12)
+
+
+def test_contributions_are_cached_and_read_only():
+    first = cachedContributions(40, 10, 0.25, cubic, 4.0)
+    assert cachedContributions(40, 10, 0.25, cubic, 4.0) is first
+    weights, indices = first
+    with pytest.raises(ValueError):
+        weights[0] = 0
+    with pytest.raises(ValueError):
+        indices[0] = 0
+    # Resizing does not change the shared weights
+    imresize(random_stack((3, 40, 40)), scalar_scale=0.25, stack=True)
+    assert cachedContributions(40, 10, 0.25, cubic, 4.0)[0] is weights
+
+
+@pytest.mark.parametrize('mode', MODES)
+def test_matches_matlab(mode):
+    # Resized by MATLAB, see README.md
+    image = read_png('lena_512x512.png')
+    resized = imresize(image, output_shape=(123, 234), mode=mode)
+    assert resized.dtype == np.uint8
+    np.testing.assert_array_equal(resized,
+                                  read_png('lena_123x234_uint8.png'))
+    resized = imresize(image/255.0, output_shape=(123, 234), mode=mode)
+    np.testing.assert_array_equal(convertDouble2Byte(resized),
+                                  read_png('lena_123x234_double.png'))
+
+
+@pytest.mark.parametrize('shape', [(9, 5), (40, 10), (10, 40)])
+def test_matrix_mode_matches_vec(shape):
+    stack = random_stack((3, 37, 29))
+    np.testing.assert_allclose(
+        imresize(stack, output_shape=shape, stack=True, mode='matrix'),
+        imresize(stack, output_shape=shape, stack=True, mode='vec'),
+        rtol=0, atol=1e-12)
+
+
+def test_matrix_is_cached_and_read_only():
+    matrix = cachedResampleMatrix(40, 10, 0.25, cubic, 4.0)
+    assert cachedResampleMatrix(40, 10, 0.25, cubic, 4.0) is matrix
+    weights, indices = cachedContributions(40, 10, 0.25, cubic, 4.0)
+    np.testing.assert_array_equal(matrix,
+                                  resampleMatrix(weights, indices, 40))
+    with pytest.raises(ValueError):
+        matrix[0, 0] = 1
+    # Each row sums the weights of its output pixel
+    np.testing.assert_allclose(matrix.sum(axis=1), 1, rtol=0, atol=1e-12)
+
+
+def test_matrix_mode_float32():
+    stack = random_stack()
+    resized = imresize(stack, scalar_scale=0.5, stack=True, mode='matrix',
+                       dtype=np.float32)
+    assert resized.dtype == np.float32
+    np.testing.assert_allclose(
+        resized, imresize(stack, scalar_scale=0.5, stack=True), rtol=1e-5)
@@ -0,0 +1,7 @@
+import pytest
+from synthetic import write_dataset
+
+
+@pytest.fixture
+def dataset(tmp_path):
+    return write_dataset(tmp_path / 'data')
@@ -0,0 +1,68 @@
+import os
+import numpy as np
+import tifffile as tif
+
+
+def write_dataset(data_path, channels=('actin', 'binder'),
+                  images=('cell1.tif', 'cell2.tif'), n_t=12, shape=(32, 24),
+                  seed=0):
+    '''
+    Write a dataset of small synthetic 2D+t images: one folder per channel,
+    holding the same image filenames. The binder channel follows the actin
+    channel with a delay of 2 frames.
+
+    Returns:
+        data_path (str): folder of the dataset
+    '''
+    rng = np.random.default_rng(seed)
+    for image in images:
+        base = rng.uniform(500, 1500, (n_t + 2,) + shape)
+        for i, channel in enumerate(channels):
+            folder = os.path.join(data_path, channel)
+            os.makedirs(folder, exist_ok=True)
+            frames = base[2:] if i == 0 else base[:-2]
+            frames = frames + rng.uniform(0, 200, frames.shape)
+            tif.imwrite(os.path.join(folder, image),
+                        frames.astype(np.uint16))
+    return str(data_path)
+
+
+def read_results(output_path):
+    '''
+    Returns:
+        results (dict): contents of every TIFF and CSV file under
+        output_path, by path relative to it
+    '''
+    results = {}
+    for folder, _, files in os.walk(output_path):
+        for name in files:
+            path = os.path.join(folder, name)
+            key = os.path.relpath(path, output_path)
+            if name.endswith('.tif'):
+                results[key] = tif.imread(path)
+            elif name.endswith('.csv'):
+                with open(path) as f:
+                    results[key] = f.read()
+    return results
+
+
+def csv_values(text):
+    return np.loadtxt(text.splitlines(), delimiter=',', ndmin=2)
+
+
+def assert_same_results(results, expected, atol=0):
+    '''
+    Compare read_results of two runs: the same files, and the same values up
+    to atol. CSV files must be identical when atol is 0.
+    '''
+    assert sorted(results) == sorted(expected)
+    for key, value in expected.items():
+        if isinstance(value, str) and atol == 0:
+            assert results[key] == value, key
+        elif isinstance(value, str):
+            np.testing.assert_allclose(csv_values(results[key]),
+                                       csv_values(value), rtol=0, atol=atol,
+                                       err_msg=key)
+        else:
+            np.testing.assert_allclose(results[key], value, rtol=0,
+                                       atol=atol, err_msg=key)
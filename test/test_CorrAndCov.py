@@ -0,0 +1,123 @@
+import os
+import sys
+import json
+import subprocess
+import pytest
+import CorrAndCov
+from synthetic import read_results, assert_same_results
+
+
+def test_parse_lists_before_the_data_path():
+    args = CorrAndCov.parse_args(['--scalefactor', '0.5,0.25', '--offset',
+                                  '30,60', '/data/one', '/data/two'])
+    assert args.scalefactor == [0.5, 0.25]
+    assert args.offset == [30, 60]
+    assert args.data_path == ['/data/one', '/data/two']
+    args = CorrAndCov.parse_args(['--offset', '30', '/data'])
+    assert (args.scalefactor, args.offset) == ([0.25], [30])
+    assert args.data_path == ['/data']
+
+
+
+def test_flags_do_not_take_the_data_path():
+    args = CorrAndCov.parse_args(['--queue', '--cache', '/data/one',
+                                  '/data/two'])
+    assert args.cache and args.queue
+    assert args.data_path == ['/data/one', '/data/two']
+    args = CorrAndCov.parse_args(['--cache-dir', '/cache', '--queue-dir',
+                                  '/queue', '/data'])
+    assert (args.cache_dir, args.queue_dir) == ('/cache', '/queue')
+    assert args.data_path == ['/data']
+
+@pytest.mark.parametrize('argv', [['--scalefactor', '0.5,x', '/data'],
+                                  ['--offset', '30.5', '/data'],
+                                  ['--coarse-method', 'nearest', '/data']])
+def test_parse_rejects_bad_values(argv, capsys):
+    with pytest.raises(SystemExit):
+        CorrAndCov.parse_args(argv)
+    assert 'error' in capsys.readouterr().err
+
+
+def test_datasets_to_run(tmp_path):
+    manifest = tmp_path / 'datasets.csv'
+    manifest.write_text('data_path,offset,output,scalefactor\n'
+                        'a,30,results,\n'
+                        'b,,,0.5\n')
+    args = CorrAndCov.parse_args(['--offset', '60,90', '--manifest',
+                                  str(manifest), 'c'])
+    datasets = CorrAndCov.datasets_to_run(args)
+    assert [os.path.basename(d['data_path']) for d in datasets] == [
+        'c', 'a', 'b']
+    # A single value keeps the layout of a single run
+    assert datasets[0]['scalefactor'] == 0.25
+    assert datasets[0]['offset'] == [60, 90]
+    # Manifest cells override the command line, empty cells do not
+    assert datasets[1]['offset'] == 30
+    assert datasets[1]['output'] == str(tmp_path / 'results')
+    assert datasets[1]['data_path'] == str(tmp_path / 'a')
+    assert datasets[2]['offset'] == [60, 90]
+    assert datasets[2]['scalefactor'] == 0.5
+    assert datasets[2]['output'] is None
+
+
+def test_json_manifest_needs_a_data_path(tmp_path):
+    manifest = tmp_path / 'datasets.json'
+    manifest.write_text('[{"data_path": "a", "coarse_method": "block"}]')
+    assert CorrAndCov.read_manifest(str(manifest)) == [
+        {'data_path': str(tmp_path / 'a'), 'coarse_method': 'block'}]
+    manifest.write_text('[{"offset": 30}]')
+    with pytest.raises(ValueError):
+        CorrAndCov.read_manifest(str(manifest))
+
+
+def test_run_batch_reports_failed_datasets(dataset, tmp_path, capsys):
+    output = str(tmp_path / 'results')
+    status = CorrAndCov.run_batch([dataset, str(tmp_path / 'missing'),
+                                   '--offset', '4', '--output', output])
+    assert status == 1
+    assert 'Failed: '+str(tmp_path / 'missing') in capsys.readouterr().out
+    assert 'corr_cell1/corr_cell1_binderactin.tif' in read_results(output)
+    assert CorrAndCov.run_batch([]) == 1
+
+
+
+@pytest.mark.parametrize('flag', ['--profile', '--profile-memory'])
+def test_profile_traces_memory_only_when_asked(flag, dataset, tmp_path):
+    output = str(tmp_path / 'results')
+    assert CorrAndCov.run_batch([dataset, '--offset', '4', '--output',
+                                 output, flag]) == 0
+    with open(os.path.join(output, 'CorrAndCov_profile.json')) as f:
+        records = json.load(f)
+    # Results written in the background thread are never traced
+    traced = [record['peak_memory'] is not None for record in records
+              if record['stage'] == 'load']
+    assert traced and all(traced) == (flag == '--profile-memory')
+    assert any(traced) == (flag == '--profile-memory')
+
+def test_sweep_matches_single_runs(dataset, tmp_path):
+    sweep = str(tmp_path / 'sweep')
+    assert CorrAndCov.run_batch([dataset, '--scalefactor', '0.5,0.25',
+                                 '--offset', '3,4', '--output', sweep]) == 0
+    results = read_results(sweep)
+    for scalefactor in ('0.5', '0.25'):
+        for offset in ('3', '4'):
+            single = str(tmp_path / (scalefactor+'_'+offset))
+            assert CorrAndCov.run_batch([
+                dataset, '--scalefactor', scalefactor, '--offset', offset,
+                '--output', single]) == 0
+            folder = 'scale'+scalefactor+'_offset'+offset+os.sep
+            assert_same_results(
+                {key[len(folder):]: value for key, value in results.items()
+                 if key.startswith(folder)},
+                read_results(single), atol=1e-12)
+
+
+def test_importing_does_not_import_the_interface():
+    # Batch runs start without Qt or matplotlib
+    code = ('import sys, CorrAndCov; '
+            'print(sorted(m for m in ("PyQt5", "matplotlib", "CC_App") '
+            'if m in sys.modules))')
+    output = subprocess.check_output(
+        [sys.executable, '-c', code],
+        cwd=os.path.dirname(os.path.abspath(CorrAndCov.__file__)))
+    assert output.decode().strip() == '[]'
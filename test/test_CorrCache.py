@@ -0,0 +1,113 @@
+import os
+import numpy as np
+import tifffile as tif
+import CorrCache
+import CorrFunctions
+
+
+def test_store_and_load(tmp_path):
+    cache_path = str(tmp_path / 'cache')
+    assert CorrCache.load(cache_path, 'missing') is None
+    array = np.arange(12.0).reshape(3, 4)
+    CorrCache.store(cache_path, 'key', array)
+    np.testing.assert_array_equal(CorrCache.load(cache_path, 'key'), array)
+    assert os.listdir(cache_path) == ['key.npy']
+
+
+def test_evicts_least_recently_used(tmp_path):
+    cache_path = str(tmp_path / 'cache')
+    array = np.zeros(100)
+    CorrCache.store(cache_path, 'old', array)
+    CorrCache.store(cache_path, 'used', array)
+    os.utime(os.path.join(cache_path, 'old.npy'), (1, 1))
+    os.utime(os.path.join(cache_path, 'used.npy'), (2, 2))
+    # Loading marks an array as recently used
+    CorrCache.load(cache_path, 'used')
+    size = os.path.getsize(os.path.join(cache_path, 'used.npy'))
+    CorrCache.store(cache_path, 'new', array, max_bytes=2*size)
+    assert sorted(os.listdir(cache_path)) == ['new.npy', 'used.npy']
+
+
+def test_image_key_changes_with_file_and_parameters(tmp_path):
+    path = str(tmp_path / 'image.tif')
+    tif.imwrite(path, np.zeros((3, 8, 8), dtype=np.uint16))
+    key = CorrCache.image_key(path, 0.25)
+    assert CorrCache.image_key(path, 0.25) == key
+    assert CorrCache.image_key(path, 0.5) != key
+    assert CorrCache.image_key(path, 0.25, 'block') != key
+    assert CorrCache.image_key(path, 0.25, dtype='float32') != key
+    tif.imwrite(path, np.ones((4, 8, 8), dtype=np.uint16))
+    assert CorrCache.image_key(path, 0.25) != key
+
+
+def test_manifest(tmp_path):
+    results_path = str(tmp_path)
+    assert CorrCache.read_manifest(results_path) == {}
+    manifest = {}
+    CorrCache.record_output(manifest, 'cov', 'abc', ['cov.tif'])
+    CorrCache.write_manifest(results_path, manifest)
+    manifest = CorrCache.read_manifest(results_path)
+    # The files of an output must still exist
+    assert not CorrCache.is_up_to_date(results_path, manifest, 'cov', 'abc')
+    open(os.path.join(results_path, 'cov.tif'), 'w').close()
+    assert CorrCache.is_up_to_date(results_path, manifest, 'cov', 'abc')
+    assert not CorrCache.is_up_to_date(results_path, manifest, 'cov', 'xyz')
+    assert not CorrCache.is_up_to_date(results_path, manifest, 'corr', 'abc')
+
+
+def modification_times(output_path):
+    # The manifest itself is written by every run
+    times = {}
+    for folder, _, files in os.walk(output_path):
+        for name in files:
+            if name == CorrCache.MANIFEST_NAME:
+                continue
+            path = os.path.join(folder, name)
+            times[os.path.relpath(path, output_path)] = os.stat(
+                path).st_mtime_ns
+    return times
+
+
+def test_cached_run_skips_outputs_that_are_up_to_date(dataset, tmp_path):
+    cache_path = str(tmp_path / 'cache')
+    output_path = str(tmp_path / 'results')
+
+    def run(offset=4):
+        CorrFunctions.calculate_and_create_figures(
+            dataset, 'actin', 0.25, offset, output_path=output_path,
+            cache_path=cache_path)
+        return modification_times(output_path)
+
+    first = run()
+    # Two images of two channels are cached
+    assert len(os.listdir(cache_path)) == 4
+    assert CorrCache.read_manifest(os.path.join(output_path, 'corr_cell1'))
+    # Nothing is saved again
+    assert run() == first
+    # A changed image remakes its own outputs only
+    image_path = os.path.join(dataset, 'binder', 'cell1.tif')
+    tif.imwrite(image_path, tif.imread(image_path)[::-1])
+    second = run()
+    changed = {name for name in first if second[name] != first[name]}
+    assert 'corr_cell1/corr_cell1_binderactin.tif' in changed
+    assert 'corr_cell1/cov_cell1_binder.tif' in changed
+    assert 'corr_cell1/cov_cell1_actin.tif' not in changed
+    assert not any(name.startswith('corr_cell2/') for name in changed)
+    # Another offset remakes the correlations but not the CoV maps
+    third = run(offset=5)
+    changed = {name for name in second if third[name] != second[name]}
+    assert 'corr_cell2/corr_cell2_binderactin.tif' in changed
+    assert 'corr_cell2/cov_cell2_actin.tif' not in changed
+    assert len(os.listdir(cache_path)) == 5
+
+
+def test_run_without_cache_saves_everything_again(dataset, tmp_path):
+    output_path = str(tmp_path / 'results')
+    times = []
+    for _ in range(2):
+        CorrFunctions.calculate_and_create_figures(
+            dataset, 'actin', 0.25, 4, output_path=output_path)
+        times.append(modification_times(output_path))
+    assert all(times[1][name] != time for name, time in times[0].items())
+    assert CorrCache.MANIFEST_NAME not in os.listdir(
+        os.path.join(output_path, 'corr_cell1'))
@@ -0,0 +1,397 @@
+import os
+import warnings
+import numpy as np
+import pytest
+import tifffile as tif
+import CorrFunctions
+from matlab_imresize.imresize import imresize
+from synthetic import read_results, assert_same_results
+
+
+def correlated_movies(n_t=60, shape=(5, 6), seed=0):
+    '''
+    Returns:
+        image1, image2 (numpy arrays): positive movies [t,x,y], image1 is
+        image2 delayed by 3 frames, each with its own noise
+    '''
+    rng = np.random.default_rng(seed)
+    base = rng.normal(size=(n_t + 3,) + shape)
+    image1 = 50 + base[:-3] + 0.5*rng.normal(size=(n_t,) + shape)
+    image2 = 50 + base[3:] + 0.5*rng.normal(size=(n_t,) + shape)
+    return image1, image2
+
+
+def quiet(function, *args, **kwargs):
+    # The direct estimator warns for a single overlapping frame, which has
+    # no sample std
+    with warnings.catch_warnings(), np.errstate(all='ignore'):
+        warnings.simplefilter('ignore', RuntimeWarning)
+        return function(*args, **kwargs)
+
+
+def direct(image1, image2, offset):
+    return quiet(CorrFunctions.cross_correlation_direct, image1, image2,
+                 offset)
+
+
+def test_fft_matches_direct():
+    image1, image2 = correlated_movies()
+    for pair in ((image1, image2), (image2, image1), (image1, image1)):
+        np.testing.assert_allclose(
+            CorrFunctions.cross_correlation_fft(*pair, 20),
+            direct(*pair, 20), rtol=0, atol=1e-12)
+
+
+def test_cross_correlation_methods_match():
+    image1, image2 = correlated_movies()
+    fft = CorrFunctions.cross_correlation(image1, image2, 0.25, 15)
+    reference = CorrFunctions.cross_correlation(image1, image2, 0.25, 15,
+                                                method='direct')
+    assert fft.shape == (15, 5, 6)
+    np.testing.assert_allclose(fft, reference, rtol=0, atol=1e-12)
+    # Delayed by 3 frames, so the cross-correlation peaks at lag 3
+    assert np.all(np.argmax(fft, axis=0) == 3)
+    with pytest.raises(ValueError):
+        CorrFunctions.cross_correlation(image1, image2, 0.25, 15,
+                                        method='other')
+
+
+def test_nan_pattern_matches_direct():
+    image1, image2 = correlated_movies(n_t=12)
+    # Constant pixels have no std
+    image1[:, 0, 0] = 7
+    image2[:, 1, 2] = 3
+    fft = quiet(CorrFunctions.cross_correlation_fft, image1, image2, 12)
+    reference = direct(image1, image2, 12)
+    np.testing.assert_array_equal(np.isnan(fft), np.isnan(reference))
+    assert np.all(np.isnan(fft[:, 0, 0]))
+    assert np.all(np.isnan(fft[:, 1, 2]))
+    # The last lag overlaps by a single frame
+    assert np.all(np.isnan(fft[-1]))
+    assert np.count_nonzero(np.isnan(fft[:-1])) == 2*11
+    np.testing.assert_allclose(fft, reference, rtol=0, atol=1e-12)
+
+
+@pytest.mark.parametrize('method', ['fft', 'direct'])
+def test_offset_of_at_least_the_frames(method):
+    image1, image2 = correlated_movies(n_t=10)
+    # An offset of the number of frames keeps every lag
+    corr = quiet(CorrFunctions.cross_correlation, image1, image2, 0.25, 10,
+                 method=method)
+    assert corr.shape == (10, 5, 6)
+    assert np.all(np.isnan(corr[-1]))
+    assert not np.any(np.isnan(corr[:-1]))
+    # A larger offset keeps all but the last lag
+    corr = quiet(CorrFunctions.cross_correlation, image1, image2, 0.25, 25,
+                 method=method)
+    assert corr.shape == (9, 5, 6)
+    assert not np.any(np.isnan(corr))
+
+
+def test_next_fast_len():
+    for target in range(1, 400):
+        length = CorrFunctions.next_fast_len(target)
+        assert length >= target
+        remainder = length
+        for factor in (2, 3, 5):
+            while remainder % factor == 0:
+                remainder //= factor
+        assert remainder == 1
+        # No smaller 5-smooth length fits
+        for smaller in range(target, length):
+            for factor in (2, 3, 5):
+                while smaller % factor == 0:
+                    smaller //= factor
+            assert smaller != 1
+
+
+def test_coarse_grain_stack_matches_each_frame():
+    image = np.random.default_rng(1).uniform(0, 1000, (5, 32, 24))
+    coarse = CorrFunctions.coarse_grain_stack(image, 0.25)
+    assert coarse.shape == (5, 8, 6)
+    for frame, expected in zip(image, coarse):
+        small = imresize(frame, scalar_scale=0.25)
+        np.testing.assert_allclose(expected, small/np.mean(small), rtol=0,
+                                   atol=1e-12)
+
+
+
+def block_reference(image, edges_x, edges_y):
+    # Mean of every block, one at a time
+    return np.array([[[frame[x0:x1, y0:y1].mean()
+                       for y0, y1 in zip(edges_y[:-1], edges_y[1:])]
+                      for x0, x1 in zip(edges_x[:-1], edges_x[1:])]
+                     for frame in image])
+
+
+@pytest.mark.parametrize('coarse_method', CorrFunctions.COARSE_METHODS)
+def test_pyramid_levels_match_each_scale_factor(tmp_path, coarse_method):
+    image = np.random.default_rng(5).integers(0, 4096, (4, 48, 40),
+                                              dtype=np.uint16)
+    path = str(tmp_path / 'image.tif')
+    tif.imwrite(path, image)
+    scalefactors = [0.5, 0.25, 0.125, 0.3]
+    levels = CorrFunctions.pyramid_levels(image, scalefactors, coarse_method)
+    assert sorted(levels) == sorted(scalefactors)
+    for scalefactor in scalefactors:
+        expected = CorrFunctions.coarse_grain_and_normalise(
+            path, scalefactor, coarse_method=coarse_method)
+        np.testing.assert_allclose(
+            CorrFunctions.normalise_frames(levels[scalefactor]), expected,
+            rtol=1e-13, atol=0, err_msg=str(scalefactor))
+
+
+@pytest.mark.parametrize('scalefactor', [0.5, 0.25, 0.125])
+def test_block_mean_of_equal_blocks(scalefactor):
+    image = np.random.default_rng(2).integers(0, 4096, (5, 32, 24),
+                                              dtype=np.uint16)
+    block = int(1/scalefactor)
+    expected = image.reshape(5, 32//block, block, 24//block, block).mean(
+        axis=(2, 4))
+    coarse = CorrFunctions.block_mean(image, scalefactor)
+    assert coarse.dtype == np.float64
+    np.testing.assert_allclose(coarse, expected, rtol=1e-15, atol=0)
+    coarse = CorrFunctions.block_mean(image, scalefactor, np.float32)
+    assert coarse.dtype == np.float32
+    np.testing.assert_allclose(coarse, expected, rtol=1e-7, atol=0)
+
+
+@pytest.mark.parametrize('scalefactor, shape', [
+    # 1/scalefactor is not an integer
+    (0.3, (10, 7)),
+    # 4 pixel blocks do not divide the image, the remainder at the edge is
+    # spread over the blocks
+    (0.25, (34, 26))])
+def test_block_mean_of_unequal_blocks(scalefactor, shape):
+    image = np.random.default_rng(3).uniform(0, 1000, (3,) + shape)
+    coarse = CorrFunctions.block_mean(image, scalefactor)
+    assert coarse.shape == imresize(image, scalar_scale=scalefactor,
+                                    stack=True).shape
+    edges_x = CorrFunctions.block_edges(shape[0], coarse.shape[1])
+    edges_y = CorrFunctions.block_edges(shape[1], coarse.shape[2])
+    # Blocks cover the image, and differ in width by at most one pixel
+    for edges, length in ((edges_x, shape[0]), (edges_y, shape[1])):
+        assert edges[0] == 0 and edges[-1] == length
+        assert np.ptp(np.diff(edges)) <= 1
+    np.testing.assert_allclose(
+        coarse, block_reference(image, edges_x, edges_y), rtol=1e-13,
+        atol=0)
+
+
+@pytest.mark.parametrize('scalefactor, shape', [
+    (0.25, (32, 24)), (0.3, (10, 7)), (0.25, (34, 26))])
+def test_block_upsample_repeats_each_block(scalefactor, shape):
+    image = np.random.default_rng(4).uniform(0, 1000, (3,) + shape)
+    coarse = CorrFunctions.block_mean(image, scalefactor)
+    large = CorrFunctions.block_upsample(coarse, scalefactor, stack=True)
+    # The same size as bicubic upsampling
+    assert large.shape == imresize(coarse, scalar_scale=1/scalefactor,
+                                   stack=True).shape
+    edges_x = CorrFunctions.block_edges(large.shape[1], coarse.shape[1])
+    edges_y = CorrFunctions.block_edges(large.shape[2], coarse.shape[2])
+    np.testing.assert_allclose(block_reference(large, edges_x, edges_y),
+                               coarse, rtol=1e-13, atol=0)
+    if shape == (32, 24):
+        np.testing.assert_array_equal(
+            large, np.repeat(np.repeat(coarse, 4, axis=1), 4, axis=2))
+    # Frames on their own
+    np.testing.assert_array_equal(
+        CorrFunctions.block_upsample(coarse[1], scalefactor), large[1])
+
+@pytest.mark.parametrize('compression', [None, 'zlib'])
+def test_iter_frames(tmp_path, compression):
+    # Compressed stacks cannot be memory-mapped and are read page by page
+    image = np.random.default_rng(2).integers(0, 4000, (11, 16, 12),
+                                              dtype=np.uint16)
+    path = str(tmp_path / 'image.tif')
+    tif.imwrite(path, image, compression=compression)
+    blocks = list(CorrFunctions.iter_frames(path, chunk_size=4))
+    assert [len(block) for block in blocks] == [4, 4, 3]
+    np.testing.assert_array_equal(np.concatenate(blocks), image)
+    assert CorrFunctions.count_frames(path) == 11
+
+
+def test_iter_frames_of_a_single_frame(tmp_path):
+    path = str(tmp_path / 'image.tif')
+    tif.imwrite(path, np.ones((8, 6), dtype=np.uint16))
+    blocks = list(CorrFunctions.iter_frames(path))
+    assert [block.shape for block in blocks] == [(1, 8, 6)]
+    assert CorrFunctions.count_frames(path) == 1
+
+
+@pytest.mark.parametrize('coarse_method', CorrFunctions.COARSE_METHODS)
+@pytest.mark.parametrize('compression', [None, 'zlib'])
+def test_streamed_loading_matches_loading_in_memory(tmp_path, coarse_method,
+                                                    compression):
+    image = np.random.default_rng(3).integers(100, 4000, (13, 32, 24),
+                                              dtype=np.uint16)
+    path = str(tmp_path / 'image.tif')
+    tif.imwrite(path, image, compression=compression)
+    in_memory = CorrFunctions.coarse_grain_and_normalise(
+        path, 0.25, coarse_method=coarse_method)
+    streamed = CorrFunctions.coarse_grain_and_normalise(
+        path, 0.25, stream=True, chunk_size=5, coarse_method=coarse_method)
+    assert streamed.shape == (13, 8, 6)
+    np.testing.assert_allclose(streamed, in_memory, rtol=0, atol=1e-12)
+
+
+def run(data_path, output_path, offset=4, **options):
+    CorrFunctions.calculate_and_create_figures(
+        data_path, 'actin', 0.25, offset, output_path=str(output_path),
+        **options)
+    return read_results(str(output_path))
+
+
+def test_pool_matches_serial(dataset, tmp_path):
+    serial = run(dataset, tmp_path / 'serial')
+    assert 'corr_cell1/corr_cell1_binderactin.tif' in serial
+    assert 'corr_cell2/data_CoVA_CC_cell2_binderactin_3.csv' in serial
+    assert_same_results(run(dataset, tmp_path / 'pool', workers=2), serial)
+
+
+def test_pool_matches_serial_at_an_offset_of_every_frame(dataset, tmp_path):
+    # 12 frames: a memory budget writes the correlations tile by tile
+    serial = run(dataset, tmp_path / 'serial', offset=12,
+                 memory_budget=20000)
+    corr = serial['corr_cell1/corr_cell1_binderactin.tif']
+    assert corr.shape[0] == 12
+    assert np.all(np.isnan(corr[-1]))
+    assert_same_results(run(dataset, tmp_path / 'pool', offset=12,
+                            memory_budget=20000, workers=2), serial)
+
+
+def test_unsupported_combinations_raise(dataset, tmp_path):
+    with pytest.raises(ValueError):
+        run(dataset, tmp_path, online=True, surrogates=20)
+    with pytest.raises(ValueError):
+        run(dataset, tmp_path, online=True, window=6)
+    for options in ({'stream': True}, {'cache_path': str(tmp_path)}):
+        with pytest.raises(ValueError):
+            CorrFunctions.calculate_and_create_figures(
+                dataset, 'actin', [0.5, 0.25], 4,
+                output_path=str(tmp_path), **options)
+    assert not os.path.exists(str(tmp_path / 'corr_cell1'))
+
+
+def test_lags_to_calculate():
+    assert CorrFunctions.lags_to_calculate(5, 12) == 5
+    assert CorrFunctions.lags_to_calculate(12, 12) == 12
+    assert CorrFunctions.lags_to_calculate(13, 12) == 11
+
+
+@pytest.mark.parametrize('method', ['fft', 'direct'])
+@pytest.mark.parametrize('memory_budget', [None, 4000])
+def test_pairwise_matches_each_pair(method, memory_budget):
+    image1, image2 = correlated_movies(n_t=20)
+    images = [image1, image2, image1[::-1].copy()]
+    corr = CorrFunctions.pairwise_correlation(images, 0.25, 8, method,
+                                              memory_budget=memory_budget)
+    assert corr.shape == (3, 3, 8, 5, 6)
+    for a in range(3):
+        for b in range(3):
+            np.testing.assert_allclose(
+                corr[a, b], CorrFunctions.cross_correlation(
+                    images[a], images[b], 0.25, 8, method),
+                rtol=0, atol=1e-12)
+
+
+@pytest.mark.parametrize('pixels', [1, 5, 6, 7, 13, 29, 30, 31, 1000])
+def test_spatial_tiles_cover_the_field_once(pixels):
+    covered = np.zeros((5, 6), dtype=int)
+    for tile in CorrFunctions.spatial_tiles((5, 6), pixels):
+        assert covered[tile].size <= pixels
+        covered[tile] += 1
+    assert np.all(covered == 1)
+
+
+@pytest.mark.parametrize('method', ['fft', 'direct'])
+@pytest.mark.parametrize('memory_budget', [1, 2000, 5000, None])
+def test_tiled_correlation_into_out(method, memory_budget):
+    image1, image2 = correlated_movies(n_t=20)
+    expected = quiet(CorrFunctions.cross_correlation, image1, image2, 0.25,
+                     8, method)
+    out = np.full((8, 5, 6), -2.0)
+    corr = quiet(CorrFunctions.cross_correlation, image1, image2, 0.25, 8,
+                 method, memory_budget=memory_budget, out=out)
+    assert corr is out
+    np.testing.assert_allclose(out, expected, rtol=0, atol=1e-12)
+
+def test_pairwise_writes_into_out():
+    images = list(correlated_movies(n_t=20))
+    out = np.full((2, 2, 8, 5, 6), -2.0)
+    corr = CorrFunctions.pairwise_correlation(images, 0.25, 8, out=out)
+    assert corr is out
+    np.testing.assert_allclose(
+        out, CorrFunctions.pairwise_correlation(images, 0.25, 8),
+        rtol=0, atol=0)
+
+
+@pytest.mark.parametrize('options', [{}, {'coarse_method': 'block'},
+                                     {'online': True}])
+def test_float32_run_matches_float64(dataset, tmp_path, options):
+    single = run(dataset, tmp_path / 'float32', dtype='float32', **options)
+    double = run(dataset, tmp_path / 'float64', **options)
+    assert {value.dtype for value in single.values()
+            if not isinstance(value, str)} == {np.dtype(np.float32)}
+    assert_same_results(single, double,
+                        atol=CorrFunctions.FLOAT32_TOLERANCE)
+
+def test_profiled_run_times_the_writes(dataset, tmp_path):
+    import CorrProfile
+    profiler = CorrProfile.Profiler(trace_memory=False)
+    run(dataset, tmp_path, profiler=profiler)
+    stages = [record['stage'] for record in profiler.records]
+    # Two images with two channels and three channel pairs
+    assert stages.count('save_cov') == 4
+    assert stages.count('save_correlation') == 6
+    assert stages.count('write_tiff') == 10
+    saves = [record for record in profiler.records
+             if record['stage'] == 'save_correlation']
+    assert all('parent' not in record for record in saves)
+    assert {record['pair'] for record in saves} == {
+        'actinactin', 'binderactin', 'binderbinder'}
+
+
+def test_density_histograms_match_histogram2d():
+    rng = np.random.default_rng(4)
+    cov = rng.uniform(-0.2, 1.7, (9, 7))
+    corr = rng.uniform(-1.1, 1.1, (3, 9, 7))
+    # Edges of the ranges, and a pixel without correlation
+    cov[0, :4] = [0, 1.5, 0.75, 1.5]
+    corr[:, 0, :4] = [-1, 1, 0, 1]
+    corr[1, 2, 3] = np.nan
+    counts = CorrFunctions.density_histograms(cov, corr, bins=(15, 20))
+    assert counts.shape == (3, 20, 15)
+    for lag in range(3):
+        expected, _, _ = np.histogram2d(
+            corr[lag].ravel(), cov.ravel(), bins=(20, 15),
+            range=CorrFunctions.DENSITY_RANGE[::-1])
+        np.testing.assert_array_equal(counts[lag], expected)
+    # Zero correlation is the first positive bin
+    assert counts[0, 10, 7] >= 1
+
+
+def test_density_images():
+    counts = np.zeros((2, 4, 3), dtype=np.intp)
+    counts[0, 0, 0] = 9
+    counts[0, 3, 2] = 2
+    images = CorrFunctions.density_images(counts)
+    assert images.shape == (2, 4, 3, 3)
+    # Empty bins are white, the largest count of a lag is saturated
+    np.testing.assert_array_equal(images[1], 1)
+    np.testing.assert_array_equal(images[0, 1], 1)
+    np.testing.assert_allclose(images[0, 0, 0], [0, 0, 1])
+    level = np.log1p(2)/np.log1p(9)
+    np.testing.assert_allclose(images[0, 3, 2], [1, 1 - level, 1 - level])
+
+
+@pytest.mark.parametrize('montage', [False, True])
+def test_density_figures(tmp_path, montage):
+    rng = np.random.default_rng(5)
+    files = CorrFunctions.create_density_figures(
+        rng.uniform(0, 1.5, (8, 8)), rng.uniform(-1, 1, (3, 8, 8)), 'CC',
+        str(tmp_path), montage=montage)
+    expected = ['CC_montage.png'] if montage else ['CC_0.png', 'CC_1.png',
+                                                   'CC_2.png']
+    assert files == expected
+    assert sorted(os.listdir(str(tmp_path))) == expected
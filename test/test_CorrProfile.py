@@ -0,0 +1,86 @@
+import csv
+import json
+import threading
+import time
+import CorrProfile
+
+
+def busy(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+
+def test_nested_stages_inherit_labels(tmp_path):
+    profiler = CorrProfile.Profiler(trace_memory=True)
+    path = tmp_path / 'image.tif'
+    path.write_bytes(b'x'*100)
+    with CorrProfile.stage(profiler, 'load', image='cell1'):
+        with CorrProfile.stage(profiler, 'read', channel='actin'):
+            CorrProfile.add_bytes_read(profiler, [str(path)])
+            data = [0]*100000
+        CorrProfile.add_bytes_written(profiler, [str(path)])
+    del data
+    read, load = profiler.records
+    assert read['stage'] == 'read' and read['parent'] == 'load'
+    assert read['image'] == 'cell1' and read['channel'] == 'actin'
+    assert 'channel' not in load and 'parent' not in load
+    assert (read['bytes_read'], read['bytes_written']) == (100, 0)
+    assert (load['bytes_read'], load['bytes_written']) == (100, 100)
+    assert read['peak_memory'] >= 800000
+    assert load['peak_memory'] >= read['peak_memory']
+    assert load['wall_time'] >= read['wall_time'] >= 0
+
+
+def test_disabled_profiling():
+    assert CorrProfile.stage(None, 'load') is CorrProfile.NULL_STAGE
+    CorrProfile.add_bytes_read(None, ['missing'])
+    output, records = CorrProfile.call_with_profiler(
+        lambda x, profiler: (x, profiler), None, 1)
+    assert output == (1, None) and records == []
+
+
+def test_call_with_profiler():
+    def function(x, profiler):
+        with CorrProfile.stage(profiler, 'square', value=x):
+            return x*x
+    output, records = CorrProfile.call_with_profiler(function, True, 3)
+    assert output == 9
+    assert [(r['stage'], r['value']) for r in records] == [('square', 3)]
+    assert records[0]['peak_memory'] is not None
+    # Memory is only traced when asked for
+    _, records = CorrProfile.call_with_profiler(function, False, 3)
+    assert records[0]['peak_memory'] is None
+
+
+def test_thread_cpu_time():
+    # Another thread keeps the process busy while the stage sleeps
+    records = {}
+    for thread in (False, True):
+        profiler = CorrProfile.Profiler(trace_memory=False, thread=thread)
+        worker = threading.Thread(target=busy, args=(0.3,))
+        worker.start()
+        with profiler.stage('sleep'):
+            time.sleep(0.2)
+        worker.join()
+        records[thread] = profiler.records[0]
+    assert records[False]['cpu_time'] > 0.1
+    assert records[True]['cpu_time'] < 0.05
+    assert records[True]['peak_memory'] is None
+
+
+def test_callback_and_write(tmp_path):
+    received = []
+    profiler = CorrProfile.Profiler(callback=received.append,
+                                    trace_memory=False)
+    with profiler.stage('run'):
+        with profiler.stage('cov', image='cell1'):
+            pass
+    assert received == profiler.records
+    profiler.write(str(tmp_path / 'profile'))
+    with open(str(tmp_path / 'profile.json')) as f:
+        assert json.load(f) == profiler.records
+    with open(str(tmp_path / 'profile.csv'), newline='') as f:
+        rows = list(csv.DictReader(f))
+    assert [row['stage'] for row in rows] == ['cov', 'run']
+    assert rows[0]['image'] == 'cell1' and rows[1]['image'] == ''
@@ -0,0 +1,74 @@
+import os
+import glob
+import pytest
+import tifffile as tif
+import CorrCache
+import CorrFunctions
+import CorrProgress
+import CorrRun
+from synthetic import read_results, assert_same_results
+
+
+def run(data_path, output_path, progress=None, **options):
+    CorrFunctions.calculate_and_create_figures(
+        data_path, 'actin', 0.25, 4, output_path=str(output_path),
+        progress=progress, **options)
+    return read_results(str(output_path))
+
+
+@pytest.mark.parametrize('options', [
+    {}, {'workers': 2}, {'online': True}, {'online': True, 'workers': 2},
+    {'surrogates': 20, 'surrogate_method': 'phase'},
+    {'surrogates': 20, 'surrogate_method': 'phase', 'workers': 2}])
+def test_steps_add_up_to_the_total(dataset, tmp_path, options):
+    calls = []
+    run(dataset, tmp_path / 'results', CorrProgress.Progress(
+        lambda *call: calls.append(call)), **options)
+    steps = CorrRun.count_steps(
+        ['actin', 'binder'], ['cell1.tif', 'cell2.tif'],
+        online=options.get('online', False),
+        surrogates=options.get('surrogates', 0))
+    assert calls[0] == (0, steps, 'Starting', None)
+    # One call per step, each counting one more
+    assert [done for done, _, _, _ in calls] == list(range(steps + 1))
+    assert {total for _, total, _, _ in calls} == {steps}
+    assert all(remaining is not None and remaining >= 0
+               for _, _, _, remaining in calls[1:])
+    assert calls[-1][3] == 0
+
+
+def test_format_time():
+    assert CorrProgress.format_time(None) == ''
+    assert CorrProgress.format_time(3725.4) == '1:02:05'
+
+
+def test_cancel_leaves_no_partial_outputs(dataset, tmp_path):
+    cache_path = str(tmp_path / 'cache')
+    output_path = tmp_path / 'results'
+    messages = []
+
+    # Cancelled from the callback once cell2 is correlated
+    progress = CorrProgress.Progress(
+        lambda done, total, message, remaining: messages.append(message),
+        lambda: 'Correlations of cell2' in messages)
+    with pytest.raises(CorrProgress.Cancelled):
+        run(dataset, output_path, progress, cache_path=cache_path)
+    # Stopped right after the step that cancelled
+    assert messages[-1] == 'Correlations of cell2'
+    # The outputs of cell1 are complete and recorded; cell2 has CoV maps
+    # but none of them are recorded, so they are made again
+    for im, recorded in (('cell1', True), ('cell2', False)):
+        folder = str(output_path / ('corr_'+im))
+        manifest = CorrCache.read_manifest(folder)
+        assert bool(manifest) == recorded
+        for entry in manifest.values():
+            for path in entry['files']:
+                assert os.path.exists(os.path.join(folder, path))
+        for path in glob.glob(os.path.join(folder, '*.tif')):
+            tif.imread(path)
+    assert not glob.glob(str(output_path / '*' / '*.tmp'))
+    assert not os.path.exists(str(output_path / 'corr_cell2' /
+                                  'corr_cell2_binderactin.tif'))
+    # Running again completes the results as an uninterrupted run
+    assert_same_results(run(dataset, output_path, cache_path=cache_path),
+                        run(dataset, tmp_path / 'serial'))
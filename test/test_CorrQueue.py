@@ -0,0 +1,167 @@
+import os
+import json
+import subprocess
+import sys
+import time
+import pytest
+import CorrFunctions
+import CorrQueue
+import CorrRun
+from synthetic import read_results, assert_same_results
+
+UNITS = [{'id': 'a', 'after': []}, {'id': 'b', 'after': ['a']},
+         {'id': 'c', 'after': []}]
+
+
+def queue(tmp_path, **options):
+    return CorrQueue.Queue(str(tmp_path / 'queue'), UNITS, {'offset': 4},
+                           **options)
+
+
+def test_a_unit_is_claimed_once(tmp_path):
+    first, second = queue(tmp_path), queue(tmp_path)
+    assert first.claim('a')
+    assert not second.claim('a')
+    assert first.states() == {'a': 'claimed', 'b': 'pending', 'c': 'pending'}
+    # b runs after a
+    assert second.next_unit()['id'] == 'c'
+    second.complete('c', None)
+    assert second.next_unit() is None
+    first.complete('a', {'corr': ['corr.tif']})
+    assert second.next_unit()['id'] == 'b'
+    assert second.result('a') == {'corr': ['corr.tif']}
+    # Done units are not claimed again
+    assert not first.claim('a')
+
+
+def test_other_parameters_are_refused(tmp_path):
+    queue(tmp_path)
+    with pytest.raises(ValueError):
+        CorrQueue.Queue(str(tmp_path / 'queue'), UNITS, {'offset': 5})
+    # Workers joining without units read them from the queue
+    joined = CorrQueue.Queue(str(tmp_path / 'queue'))
+    assert joined.units == UNITS and joined.params == {'offset': 4}
+
+
+def test_stale_claims_are_taken_over(tmp_path):
+    first, second = queue(tmp_path, stale_time=60), queue(tmp_path,
+                                                          stale_time=60)
+    claim = str(tmp_path / 'queue' / 'claims' / 'a')
+    assert first.claim('a')
+    # Heartbeats of a running unit keep its claim
+    assert not second.claim('a')
+    # A claim not touched for stale_time
+    old = time.time() - 61
+    os.utime(claim, (old, old))
+    assert second.claim('a')
+    assert second.owns('a') and not first.owns('a')
+    # The first worker cannot release it any more
+    first.release('a')
+    assert os.path.exists(claim)
+    # A claim of a process of this machine that has stopped
+    finished = subprocess.run([sys.executable, '-c', 'import os; '
+                               'print(os.getpid())'], capture_output=True)
+    with open(claim) as f:
+        contents = json.load(f)
+    contents['pid'] = int(finished.stdout)
+    with open(claim, 'w') as f:
+        json.dump(contents, f)
+    assert first.next_unit()['id'] == 'a'
+
+
+def test_heartbeat_touches_the_claim(tmp_path):
+    worker = queue(tmp_path, stale_time=0.2)
+    seen = []
+
+    def execute(unit):
+        claim = str(tmp_path / 'queue' / 'claims' / unit['id'])
+        start = os.path.getmtime(claim)
+        time.sleep(0.3)
+        seen.append(os.path.getmtime(claim) > start)
+        return unit['id']
+
+    worker.work(execute, stop=lambda: bool(seen))
+    assert seen == [True]
+    assert worker.result('a') == 'a'
+
+
+def test_failed_units_are_retried_then_given_up(tmp_path):
+    runs = []
+
+    def execute(unit):
+        runs.append(unit['id'])
+        if unit['id'] == 'a':
+            raise RuntimeError('cannot read a')
+
+    worker = queue(tmp_path, retries=1)
+    assert worker.work(execute, poll_interval=0) == {'done': 1, 'failed': 2}
+    assert runs == ['a', 'a', 'c']
+    assert worker.states() == {'a': 'given up', 'b': 'blocked', 'c': 'done'}
+    with pytest.raises(CorrQueue.QueueError) as error:
+        worker.check()
+    assert '1 units failed 2 times and 1 units' in str(error.value)
+    assert 'a: RuntimeError: cannot read a' in str(error.value)
+
+
+def test_restarted_queues_run_what_is_not_done(tmp_path):
+    runs = []
+    queue(tmp_path).work(lambda unit: runs.append(unit['id']),
+                         stop=lambda: len(runs) == 1)
+    assert runs == ['a']
+    # Restarted, after a crash during c
+    crashed = queue(tmp_path)
+    assert crashed.claim('c')
+    claim = str(tmp_path / 'queue' / 'claims' / 'c')
+    old = time.time() - CorrQueue.STALE_TIME
+    os.utime(claim, (old, old))
+    queue(tmp_path).work(lambda unit: runs.append(unit['id']))
+    assert runs == ['a', 'b', 'c']
+
+
+def run(data_path, output_path, **options):
+    CorrFunctions.calculate_and_create_figures(
+        data_path, 'actin', 0.25, 4, output_path=str(output_path), **options)
+    return read_results(str(output_path))
+
+
+def test_queue_run_matches_serial_run(dataset, tmp_path):
+    serial = run(dataset, tmp_path / 'serial')
+    assert_same_results(run(dataset, tmp_path / 'queue', queue_path=''),
+                        serial)
+    queue_path = tmp_path / 'queue' / CorrQueue.QUEUE_NAME
+    # Intermediate arrays are removed once every unit is done
+    assert not os.path.exists(str(queue_path / 'arrays'))
+    assert set(CorrQueue.Queue(str(queue_path)).states().values()) == {
+        'done'}
+    # A run of other images is refused
+    with pytest.raises(ValueError, match='other parameters'):
+        run(dataset, tmp_path / 'queue', queue_path='', images=['cell1.tif'])
+
+
+def test_interrupted_queue_run_resumes(dataset, tmp_path, monkeypatch):
+    serial = run(dataset, tmp_path / 'serial')
+    run_unit = CorrRun.run_unit
+    runs = []
+
+    def interrupt(unit, *args, **kwargs):
+        if unit['id'] == 'correlation.cell2.binder-actin':
+            raise KeyboardInterrupt
+        runs.append(unit['id'])
+        return run_unit(unit, *args, **kwargs)
+
+    monkeypatch.setattr(CorrRun, 'run_unit', interrupt)
+    queue_path = str(tmp_path / 'queue')
+    with pytest.raises(KeyboardInterrupt):
+        run(dataset, tmp_path / 'results', queue_path=queue_path)
+    # The interrupted unit is still claimed by this process
+    os.remove(os.path.join(queue_path, 'claims',
+                           'correlation.cell2.binder-actin'))
+    done = list(runs)
+    monkeypatch.setattr(CorrRun, 'run_unit',
+                        lambda unit, *args, **kwargs: runs.append(unit['id'])
+                        or run_unit(unit, *args, **kwargs))
+    assert_same_results(run(dataset, tmp_path / 'results',
+                            queue_path=queue_path), serial)
+    # Units done before the interruption are not run again
+    assert not set(runs[len(done):]) & set(done)
+    assert 'correlation.cell2.binder-actin' in runs[len(done):]
@@ -0,0 +1,168 @@
+import os
+import warnings
+import numpy as np
+import pytest
+import tifffile as tif
+import CorrFunctions
+import CorrSignificance
+from synthetic import read_results, assert_same_results
+
+
+def movies(n_t=200, shape=(20, 20), delay=None, seed=0):
+    '''
+    Two autocorrelated movies, independent unless the first follows the
+    second with a delay, as the lags of the correlations do
+    '''
+    rng = np.random.default_rng(seed)
+    noise = rng.normal(size=(2, n_t + 2) + shape)
+    # Moving averages over 3 frames
+    image1, image2 = (noise[:, 2:] + noise[:, 1:-1] + noise[:, :-2])/3
+    if delay is not None:
+        image1[delay:] += image2[:-delay]
+    return 100 + image1, 100 + image2
+
+
+def correlation(image1, image2, offset):
+    with warnings.catch_warnings(), np.errstate(all='ignore'):
+        warnings.simplefilter('ignore', RuntimeWarning)
+        return CorrFunctions.cross_correlation(image1, image2, 1, offset,
+                                               method='direct')
+
+
+def significance(image1, image2, offset, **options):
+    return CorrSignificance.significance(
+        CorrSignificance.circular_statistics(image1),
+        CorrSignificance.circular_statistics(image2),
+        correlation(image1, image2, offset), **options)
+
+
+def test_shift_null_is_each_lag_of_the_shifted_image():
+    image1, image2 = movies(n_t=30, shape=(3, 2))
+    stats1 = CorrSignificance.circular_statistics(image1)
+    stats2 = CorrSignificance.circular_statistics(image2)
+    x = stats1['image'] - stats1['mean']
+    y = stats2['image'] - stats2['mean']
+    shifts = np.array([0, 3, 7, 12, 29])
+    nulls = list(CorrSignificance.shift_null(
+        x, y, stats1['spectrum']*np.conj(stats2['spectrum']), shifts, 30))
+    for k, shift in enumerate(shifts):
+        expected = correlation(image1, np.roll(image2, shift, axis=0), 30)
+        for i, null in enumerate(nulls):
+            np.testing.assert_allclose(null[k], expected[i].ravel(),
+                                       rtol=0, atol=1e-10)
+
+
+def test_phase_null_is_each_lag_of_the_phase_randomised_image():
+    image1, image2 = movies(n_t=31, shape=(3, 2))
+    stats1 = CorrSignificance.circular_statistics(image1)
+    stats2 = CorrSignificance.circular_statistics(image2)
+    x = stats1['image'] - stats1['mean']
+    y = stats2['image'] - stats2['mean']
+    phases = CorrSignificance.surrogate_phases(31, 4,
+                                               np.random.default_rng(1))
+    nulls = list(CorrSignificance.phase_null(
+        x, y, stats1['spectrum'], stats2['spectrum'], phases, 31))
+    for k, phase in enumerate(phases):
+        surrogate = np.fft.irfft(stats2['spectrum']*np.exp(1j*phase)[:, None],
+                                 31, axis=0)
+        expected = correlation(image1, surrogate.reshape(image2.shape), 31)
+        for i, null in enumerate(nulls[:-1]):
+            np.testing.assert_allclose(null[k], expected[i].ravel(),
+                                       rtol=0, atol=1e-10)
+        assert np.all(np.isnan(nulls[-1]))
+
+
+@pytest.mark.parametrize('method', CorrSignificance.SURROGATE_METHODS)
+def test_independent_movies_are_rarely_significant(method):
+    pvalue, threshold, used = significance(*movies(), 10, surrogates=99,
+                                           method=method)
+    assert used == {'method': method, 'surrogates': 99}
+    assert pvalue.shape == threshold.shape == (10, 20, 20)
+    assert 0.02 < np.mean(pvalue < CorrSignificance.SIGNIFICANCE_LEVEL) < 0.09
+    assert 0.45 < np.mean(pvalue) < 0.55
+
+
+@pytest.mark.parametrize('method', CorrSignificance.SURROGATE_METHODS)
+def test_coupled_movies_are_significant_at_their_delay(method):
+    image1, image2 = movies(delay=3)
+    corr = correlation(image1, image2, 10)
+    pvalue, threshold, _ = significance(image1, image2, 10, surrogates=99,
+                                        method=method)
+    assert np.all(pvalue[3] == 0.01)
+    assert np.all(np.abs(corr[3]) > threshold[3])
+    # The moving average spreads the coupling over 2 frames either side
+    assert np.mean(pvalue[8:] < CorrSignificance.SIGNIFICANCE_LEVEL) < 0.1
+
+
+@pytest.mark.parametrize('method', CorrSignificance.SURROGATE_METHODS)
+def test_thresholds_grow_with_the_lag(method):
+    image1, image2 = movies(n_t=200)
+    # 200 - 3*60 + 1 shifts
+    _, threshold, used = significance(image1, image2, 60, surrogates=1000,
+                                      method=method)
+    assert used == {'method': method,
+                    'surrogates': 21 if method == 'shift' else 1000}
+    # Fewer overlapping frames spread the null distribution more:
+    # sqrt(199/140) for independent frames
+    assert np.mean(threshold[59]) > 1.1*np.mean(threshold[0])
+
+
+def test_short_movies_need_phase_surrogates(capsys):
+    image1, image2 = movies(n_t=40, shape=(4, 4))
+    # 40 - 3*3 + 1 shifts
+    pvalue, _, used = significance(image1, image2, 3, surrogates=1000)
+    assert used == {'method': 'shift', 'surrogates': 32}
+    assert 'Only 32 distinct circular shifts' in capsys.readouterr().out
+    assert np.min(pvalue) >= 1/33
+    # Fewer than MIN_SURROGATES shifts
+    with pytest.raises(ValueError, match='at least 43 frames are needed'):
+        significance(image1, image2, 8, surrogates=1000)
+    _, _, used = significance(image1, image2, 8, surrogates=1000,
+                              method='phase')
+    assert used == {'method': 'phase', 'surrogates': 1000}
+    # Two overlapping frames are always perfectly correlated
+    _, threshold, _ = significance(image1, image2, 39, surrogates=50,
+                                   method='phase')
+    np.testing.assert_allclose(threshold[-1], 1, rtol=0, atol=1e-9)
+
+
+@pytest.mark.parametrize('method', CorrSignificance.SURROGATE_METHODS)
+def test_chunks_and_threads_give_the_same_tests(method):
+    image1, image2 = movies(n_t=60, shape=(7, 5))
+    expected = significance(image1, image2, 8, surrogates=30, method=method)
+    for result in (significance(image1, image2, 8, surrogates=30,
+                                method=method, memory_budget=1, workers=3),
+                   significance(image1.astype(np.float32),
+                                image2.astype(np.float32), 8, surrogates=30,
+                                method=method)):
+        np.testing.assert_allclose(result[0], expected[0], rtol=0, atol=1e-6)
+        assert result[2] == expected[2]
+
+
+def test_surrogates_run(dataset, tmp_path):
+    output_path = str(tmp_path / 'results')
+    # 12 frames are too few for circular shifts
+    with pytest.raises(ValueError, match='phase-randomised'):
+        CorrFunctions.calculate_and_create_figures(
+            dataset, 'actin', 0.25, 3, output_path=output_path, surrogates=50)
+    CorrFunctions.calculate_and_create_figures(
+        dataset, 'actin', 0.25, 3, output_path=output_path, surrogates=50,
+        surrogate_method='phase')
+    folder = os.path.join(output_path, 'corr_cell1')
+    for kind in ('pvalue', 'threshold'):
+        path = os.path.join(folder, kind+'_cell1_binderactin.tif')
+        with tif.TiffFile(path) as tiff:
+            assert tiff.asarray().shape == (3, 32, 24)
+            assert tiff.shaped_metadata[0]['CorrAndCov'] == {
+                'method': 'phase', 'surrogates': 50}
+
+
+def test_pool_run_with_surrogates_matches_serial_run(dataset, tmp_path):
+    options = {'surrogates': 20, 'surrogate_method': 'phase'}
+    for name, workers in (('serial', 1), ('pool', 2)):
+        CorrFunctions.calculate_and_create_figures(
+            dataset, 'actin', 0.25, 3, output_path=str(tmp_path / name),
+            workers=workers, **options)
+    serial = read_results(str(tmp_path / 'serial'))
+    assert 'corr_cell2/pvalue_cell2_binderactin.tif' in serial
+    assert_same_results(read_results(str(tmp_path / 'pool')), serial)
@@ -0,0 +1,178 @@
+import os
+import zipfile
+import numpy as np
+import pytest
+import tifffile as tif
+import CorrFunctions
+import CorrStore
+from synthetic import read_results
+
+
+def results(seed=0, lags=11, shape=(6, 5)):
+    rng = np.random.default_rng(seed)
+    covs = {'actin': rng.uniform(0, 1, shape),
+            'binder': rng.uniform(0, 1, shape)}
+    corrs = {('actin', 'actin'): rng.uniform(-1, 1, (lags,) + shape),
+             ('binder', 'actin'): rng.uniform(-1, 1, (lags,) + shape)}
+    return covs, corrs
+
+
+def write_store(tmp_path, covs, corrs, coarse_method='bicubic'):
+    path = str(tmp_path / CorrStore.store_name('cell1'))
+    files = CorrStore.write(path, covs, corrs,
+                            {'scalefactor': 0.25, 'offset': 11,
+                             'coarse_method': coarse_method}, lag_chunk=4)
+    assert files == ['results_cell1.npz']
+    return path
+
+
+def test_round_trip(tmp_path):
+    covs, corrs = results()
+    path = write_store(tmp_path, covs, corrs)
+    assert not os.path.exists(path+'.tmp')
+    with CorrStore.ResultsStore(path) as store:
+        assert store.channels == ['actin', 'binder']
+        assert store.pairs == [('actin', 'actin'), ('binder', 'actin')]
+        assert store.params['offset'] == 11 and store.params['lags'] == 11
+        for ch, cov in covs.items():
+            np.testing.assert_array_equal(store.cov(ch), cov)
+        corr = corrs[('binder', 'actin')]
+        np.testing.assert_array_equal(store.corr(('binder', 'actin')), corr)
+        # Either order of the channels
+        np.testing.assert_array_equal(store.corr(('actin', 'binder')), corr)
+        np.testing.assert_array_equal(
+            store.corr(('binder', 'actin'), lags=slice(3, 9)), corr[3:9])
+        np.testing.assert_array_equal(
+            store.corr(('binder', 'actin'), lags=[10, 0, 5]),
+            corr[[10, 0, 5]])
+        np.testing.assert_array_equal(
+            store.corr(('binder', 'actin'), lags=7), corr[7])
+        np.testing.assert_array_equal(
+            store.corr(('actin', 'actin'), region=(slice(1, 3), slice(2, 5))),
+            corrs[('actin', 'actin')][:, 1:3, 2:5])
+        with pytest.raises(KeyError):
+            store.corr(('binder', 'binder'))
+    # Readable without CorrStore
+    with np.load(path) as npz:
+        np.testing.assert_array_equal(npz['cov/actin'], covs['actin'])
+
+
+def test_only_the_chunks_of_the_lags_are_read(tmp_path, monkeypatch):
+    covs, corrs = results()
+    path = write_store(tmp_path, covs, corrs)
+    with zipfile.ZipFile(path) as store:
+        assert sorted(name for name in store.namelist()
+                      if name.startswith('corr/binder')) == [
+            'corr/binder/actin/0.npy', 'corr/binder/actin/4.npy',
+            'corr/binder/actin/8.npy']
+    with CorrStore.ResultsStore(path) as store:
+        read = []
+        npz = store.npz
+        getitem = type(npz).__getitem__
+        monkeypatch.setattr(type(npz), '__getitem__',
+                            lambda self, key: read.append(key)
+                            or getitem(self, key))
+        store.corr(('binder', 'actin'), lags=[5, 6])
+    assert read == ['corr/binder/actin/4']
+
+
+@pytest.mark.parametrize('coarse_method', CorrFunctions.COARSE_METHODS)
+def test_upsampled_reads(tmp_path, coarse_method):
+    covs, corrs = results()
+    path = write_store(tmp_path, covs, corrs, coarse_method)
+    corr = corrs[('binder', 'actin')]
+    full = CorrFunctions.upsample(corr, 0.25, coarse_method, stack=True)
+    region = (slice(3, 17), slice(8, 20))
+    with CorrStore.ResultsStore(path) as store:
+        np.testing.assert_allclose(
+            store.corr(('binder', 'actin'), upsampled=True), full,
+            rtol=0, atol=1e-12)
+        np.testing.assert_allclose(
+            store.corr(('binder', 'actin'), lags=[2, 3], upsampled=True,
+                       region=region),
+            full[[2, 3]][(Ellipsis,) + region], rtol=0, atol=1e-12)
+        np.testing.assert_allclose(
+            store.cov('actin', upsampled=True, region=region),
+            CorrFunctions.upsample(covs['actin'], 0.25,
+                                   coarse_method)[region],
+            rtol=0, atol=1e-12)
+
+
+def test_store_run_matches_files_run(dataset, tmp_path):
+    for output_format in ('files', 'store'):
+        CorrFunctions.calculate_and_create_figures(
+            dataset, 'actin', 0.25, 4, output_path=str(tmp_path/output_format),
+            output_format=output_format)
+    files = read_results(str(tmp_path / 'files'))
+    # No TIFF or CSV files, but the same figures
+    assert read_results(str(tmp_path / 'store')) == {}
+    assert sorted(os.listdir(str(tmp_path / 'store' / 'corr_cell1'))) == [
+        name for name in sorted(os.listdir(str(tmp_path / 'files'
+                                               / 'corr_cell1')))
+        if name.endswith('.png')] + ['results_cell1.npz']
+    path = str(tmp_path / 'store' / 'corr_cell1' / 'results_cell1.npz')
+    with CorrStore.ResultsStore(path) as store:
+        assert store.params['scalefactor'] == 0.25
+        np.testing.assert_allclose(
+            store.corr(('binder', 'actin'), upsampled=True),
+            files['corr_cell1/corr_cell1_binderactin.tif'], rtol=0,
+            atol=1e-12)
+        np.testing.assert_allclose(
+            store.cov('binder', upsampled=True),
+            files['corr_cell1/cov_cell1_binder.tif'], rtol=0, atol=1e-12)
+
+
+@pytest.mark.parametrize('coarse_method', CorrFunctions.COARSE_METHODS)
+def test_coarse_tiff_reads(tmp_path, coarse_method):
+    covs, corrs = results()
+    corr = corrs[('binder', 'actin')]
+    for name, array in (('corr.tif', corr), ('cov.tif', covs['actin'])):
+        assert CorrStore.write_coarse_tiff(
+            str(tmp_path / name), array, 0.25, coarse_method) == [name]
+    full = CorrFunctions.upsample(corr, 0.25, coarse_method, stack=True)
+    region = (slice(3, 17), slice(8, 20))
+    with CorrStore.CoarseTiff(str(tmp_path / 'corr.tif')) as tiff:
+        assert tiff.shape == full.shape == (11, 24, 20)
+        assert tiff.params['coarse_method'] == coarse_method
+        np.testing.assert_allclose(tiff.read(), full, rtol=0, atol=1e-12)
+        np.testing.assert_allclose(tiff.read(lags=[7, 2], region=region),
+                                   full[[7, 2]][(Ellipsis,) + region],
+                                   rtol=0, atol=1e-12)
+        np.testing.assert_allclose(tiff.read(lags=5, region=region),
+                                   full[5][region], rtol=0, atol=1e-12)
+        np.testing.assert_array_equal(
+            tiff.read(lags=slice(0, 3), upsampled=False,
+                      region=(slice(1, 4), slice(0, 2))), corr[:3, 1:4, :2])
+    with CorrStore.CoarseTiff(str(tmp_path / 'cov.tif')) as tiff:
+        assert tiff.shape == (24, 20)
+        np.testing.assert_allclose(
+            tiff.read(region=region),
+            CorrFunctions.upsample(covs['actin'], 0.25,
+                                   coarse_method)[region],
+            rtol=0, atol=1e-12)
+
+
+def test_coarse_tiff_refuses_other_tiffs(tmp_path):
+    path = str(tmp_path / 'corr.tif')
+    tif.imwrite(path, np.zeros((3, 8, 8)))
+    with pytest.raises(ValueError):
+        CorrStore.CoarseTiff(path)
+
+
+def test_coarse_run_matches_files_run(dataset, tmp_path):
+    for output_format in ('files', 'coarse'):
+        CorrFunctions.calculate_and_create_figures(
+            dataset, 'actin', 0.25, 4, output_path=str(tmp_path/output_format),
+            output_format=output_format)
+    files = read_results(str(tmp_path / 'files'))
+    coarse = read_results(str(tmp_path / 'coarse'))
+    # The same outputs, with the TIFFs at coarse-grained size
+    assert sorted(coarse) == sorted(files)
+    for name, array in files.items():
+        if not name.endswith('.tif'):
+            assert coarse[name] == array
+            continue
+        assert coarse[name].shape[-2:] == (8, 6)
+        with CorrStore.CoarseTiff(str(tmp_path / 'coarse' / name)) as tiff:
+            np.testing.assert_allclose(tiff.read(), array, rtol=0,
+                                       atol=1e-12)
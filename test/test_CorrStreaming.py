@@ -0,0 +1,116 @@
+import os
+import numpy as np
+import pytest
+import tifffile as tif
+import CorrFunctions
+import CorrStreaming
+from synthetic import write_dataset, read_results, assert_same_results
+
+
+def movie(n_t=15, shape=(4, 5), seed=0):
+    return 100 + np.random.default_rng(seed).normal(size=(n_t,) + shape)
+
+
+def test_cov_accumulator_matches_batch():
+    image = movie()
+    accumulator = CorrStreaming.CoVAccumulator()
+    for frame in image:
+        accumulator.update(frame)
+    np.testing.assert_allclose(
+        accumulator.result(),
+        CorrFunctions.coefficient_of_variation(image, 0.25),
+        rtol=1e-12, atol=0)
+
+
+@pytest.mark.parametrize('offset', [1, 6, 15, 20])
+def test_correlation_accumulator_matches_batch(offset):
+    image1, image2 = movie(seed=1), movie(seed=2)
+    image2[1:] += image1[:-1]
+    accumulator = CorrStreaming.CorrelationAccumulator(offset)
+    for frame1, frame2 in zip(image1, image2):
+        accumulator.update(frame1, frame2)
+    with np.errstate(all='ignore'):
+        corr = accumulator.result()
+        expected = CorrFunctions.cross_correlation(image1, image2, 0.25,
+                                                   offset)
+    assert corr.shape == expected.shape
+    np.testing.assert_array_equal(np.isnan(corr), np.isnan(expected))
+    np.testing.assert_allclose(corr, expected, rtol=0, atol=1e-12)
+
+
+def test_accumulators_keep_float32():
+    image = movie().astype(np.float32)
+    cov = CorrStreaming.CoVAccumulator()
+    corr = CorrStreaming.CorrelationAccumulator(4)
+    for frame in image:
+        cov.update(frame)
+        corr.update(frame, frame)
+    assert cov.result().dtype == np.float32
+    assert corr.result().dtype == np.float32
+    np.testing.assert_allclose(corr.result()[0], 1, rtol=1e-6)
+
+
+def test_stream_image_matches_batch(tmp_path):
+    data_path = write_dataset(str(tmp_path / 'data'), n_t=20)
+    image_paths = {ch: os.path.join(data_path, ch, 'cell1.tif')
+                   for ch in ('actin', 'binder')}
+    covs, corrs = CorrStreaming.stream_image(image_paths, 0.25, 5,
+                                             chunk_size=6)
+    images = {ch: CorrFunctions.coarse_grain_and_normalise(path, 0.25)
+              for ch, path in image_paths.items()}
+    for ch, image in images.items():
+        np.testing.assert_allclose(
+            covs[ch], CorrFunctions.coefficient_of_variation(image, 0.25),
+            rtol=1e-12, atol=0)
+    assert sorted(corrs) == sorted(CorrFunctions.channel_pairs(
+        list(image_paths)))
+    for (a, b), corr in corrs.items():
+        np.testing.assert_allclose(
+            corr, CorrFunctions.cross_correlation(images[a], images[b], 0.25,
+                                                  5),
+            rtol=0, atol=1e-12)
+
+
+def test_stream_image_needs_the_same_number_of_frames(tmp_path):
+    data_path = write_dataset(str(tmp_path / 'data'), n_t=12)
+    short = os.path.join(data_path, 'binder', 'cell1.tif')
+    tif.imwrite(short, tif.imread(short)[:9])
+    image_paths = {ch: os.path.join(data_path, ch, 'cell1.tif')
+                   for ch in ('actin', 'binder')}
+    with pytest.raises(ValueError, match='binder has 9'):
+        CorrStreaming.stream_image(image_paths, 0.25, 4)
+
+
+def test_online_run_matches_in_memory_run(dataset, tmp_path):
+    options = {'output_path': str(tmp_path / 'online'), 'online': True}
+    CorrFunctions.calculate_and_create_figures(dataset, 'actin', 0.25, 4,
+                                               **options)
+    CorrFunctions.calculate_and_create_figures(
+        dataset, 'actin', 0.25, 4, output_path=str(tmp_path / 'serial'))
+    assert_same_results(read_results(str(tmp_path / 'online')),
+                        read_results(str(tmp_path / 'serial')), atol=1e-9)
+
+
+@pytest.mark.parametrize('options', [{'workers': 2}, {'queue_path': ''}])
+def test_online_runs_in_a_pool_or_queue(dataset, tmp_path, options):
+    for name, extra in (('serial', {}), ('other', options)):
+        CorrFunctions.calculate_and_create_figures(
+            dataset, 'actin', 0.25, 4, output_path=str(tmp_path / name),
+            online=True, **extra)
+    assert_same_results(read_results(str(tmp_path / 'other')),
+                        read_results(str(tmp_path / 'serial')))
+
+
+def test_online_run_skips_cached_outputs(dataset, tmp_path):
+    output_path = tmp_path / 'results'
+
+    def run():
+        CorrFunctions.calculate_and_create_figures(
+            dataset, 'actin', 0.25, 4, output_path=str(output_path),
+            online=True, cache_path=str(tmp_path / 'cache'))
+        return {path: os.stat(str(output_path / path)).st_mtime_ns
+                for path in read_results(str(output_path))}
+
+    first = run()
+    assert 'corr_cell1/corr_cell1_binderactin.tif' in first
+    assert run() == first
@@ -0,0 +1,105 @@
+import os
+import time
+import numpy as np
+import tifffile as tif
+import CorrFunctions
+import CorrWatch
+from synthetic import write_dataset
+
+
+def watcher(data_path, output_path, **options):
+    return CorrWatch.Watcher(data_path, 'actin', 0.25, 4, settle_time=0,
+                             output_path=str(output_path), **options)
+
+
+def test_index_waits_for_every_channel(tmp_path):
+    data_path = write_dataset(str(tmp_path / 'data'))
+    tif.imwrite(os.path.join(data_path, 'actin', 'cell3.tif'),
+                np.ones((3, 8, 8), dtype=np.uint16))
+    open(os.path.join(data_path, 'binder', 'notes.txt'), 'w').close()
+    index, newest = CorrWatch.index_images(data_path)
+    assert sorted(index) == ['cell1.tif', 'cell2.tif']
+    assert sorted(index['cell1.tif']) == ['actin', 'binder']
+    assert sorted(newest) == sorted(index)
+
+
+def test_settle_time(dataset, tmp_path):
+    assert sorted(watcher(dataset, tmp_path).scan()) == ['cell1.tif',
+                                                         'cell2.tif']
+    settling = CorrWatch.Watcher(dataset, 'actin', 0.25, 4, settle_time=3600,
+                                 output_path=str(tmp_path))
+    assert settling.scan() == {}
+
+
+def test_processes_new_and_changed_images_once(dataset, tmp_path):
+    first = watcher(dataset, tmp_path / 'results')
+    assert first.process(first.scan()) == []
+    assert os.path.exists(str(tmp_path / 'results' / 'corr_cell2'))
+    # A restarted watcher reads what was processed
+    second = watcher(dataset, tmp_path / 'results')
+    assert second.scan() == {}
+    image_path = os.path.join(dataset, 'binder', 'cell1.tif')
+    tif.imwrite(image_path, tif.imread(image_path)[::-1])
+    assert list(second.scan()) == ['cell1.tif']
+    # Options that change the results process everything again
+    other = watcher(dataset, tmp_path / 'results', figure_style='density')
+    assert sorted(other.scan()) == ['cell1.tif', 'cell2.tif']
+
+
+def test_failures_are_retried_with_backoff(dataset, tmp_path, monkeypatch):
+    calls = []
+    calculate = CorrFunctions.calculate_and_create_figures
+
+    def fail(*args, images=None, **kwargs):
+        calls.append(images[0])
+        raise RuntimeError('cannot read '+images[0])
+
+    monkeypatch.setattr(CorrFunctions, 'calculate_and_create_figures', fail)
+    now = [time.time()]
+    monkeypatch.setattr(CorrWatch.time, 'time', lambda: now[0])
+    watch = watcher(dataset, tmp_path)
+    ready = watch.scan()
+    assert sorted(watch.process(ready)) == ['cell1.tif', 'cell2.tif']
+    # Failures are not recorded as processed
+    assert watch.processed == {} and watch.read_state() == {}
+    assert watch.failures['cell1.tif']['attempts'] == 1
+    assert watch.scan() == {}
+    now[0] += CorrWatch.RETRY_DELAY
+    assert sorted(watch.scan()) == ['cell1.tif', 'cell2.tif']
+    watch.process({'cell1.tif': ready['cell1.tif']})
+    # The delay doubles after each failure
+    now[0] += CorrWatch.RETRY_DELAY
+    assert list(watch.scan()) == ['cell2.tif']
+    now[0] += CorrWatch.RETRY_DELAY
+    assert sorted(watch.scan()) == ['cell1.tif', 'cell2.tif']
+    # Until it has failed too often
+    while 'cell1.tif' in watch.scan():
+        watch.process({'cell1.tif': ready['cell1.tif']})
+        now[0] += 10**6
+    assert calls.count('cell1.tif') == CorrWatch.MAX_ATTEMPTS
+    assert list(watch.scan()) == ['cell2.tif']
+    # A changed image is tried again at once
+    image_path = os.path.join(dataset, 'binder', 'cell1.tif')
+    tif.imwrite(image_path, tif.imread(image_path)[::-1])
+    assert sorted(watch.scan()) == ['cell1.tif', 'cell2.tif']
+    # Once it succeeds the failure is forgotten
+    monkeypatch.setattr(CorrFunctions, 'calculate_and_create_figures',
+                        calculate)
+    watch.process(watch.scan())
+    assert watch.failures == {}
+    assert sorted(watch.read_state()) == ['cell1.tif', 'cell2.tif']
+
+
+def test_watch_loop(dataset, tmp_path, monkeypatch):
+    watchers = [watcher(dataset, tmp_path / 'one'),
+                watcher(dataset, tmp_path / 'two')]
+    scans = []
+    for watch in watchers:
+        scan = watch.scan
+        monkeypatch.setattr(watch, 'scan',
+                            lambda scan=scan: scans.append(1) or scan())
+    # Stops after two rounds of scans
+    CorrWatch.watch(watchers, interval=0, stop=lambda: len(scans) >= 4)
+    assert len(scans) == 4
+    for watch in watchers:
+        assert sorted(watch.read_state()) == ['cell1.tif', 'cell2.tif']
@@ -0,0 +1,122 @@
+import os
+import warnings
+import numpy as np
+import pytest
+import tifffile as tif
+import CorrFunctions
+import CorrWindows
+
+
+def movies(n_t=40, shape=(4, 3), seed=0):
+    rng = np.random.default_rng(seed)
+    image1 = 100 + rng.normal(size=(n_t,) + shape)
+    image2 = 100 + rng.normal(size=(n_t,) + shape)
+    image2[2:] += image1[:-2]
+    return image1, image2
+
+
+def direct(image1, image2, offset):
+    with warnings.catch_warnings(), np.errstate(all='ignore'):
+        warnings.simplefilter('ignore', RuntimeWarning)
+        return CorrFunctions.cross_correlation(image1, image2, 0.25, offset,
+                                               method='direct')
+
+
+def test_window_starts():
+    np.testing.assert_array_equal(CorrWindows.window_starts(10, 4, 3),
+                                  [0, 3, 6])
+    np.testing.assert_array_equal(CorrWindows.window_starts(10, 10, 1), [0])
+    for window, stride in ((1, 1), (11, 1), (4, 0)):
+        with pytest.raises(ValueError):
+            CorrWindows.window_starts(10, window, stride)
+
+
+@pytest.mark.parametrize('window, stride', [(10, 10), (12, 5), (40, 1)])
+def test_sliding_cov_matches_each_window(window, stride):
+    image, _ = movies()
+    cov = CorrWindows.sliding_cov(CorrWindows.window_statistics(image),
+                                  window, stride)
+    starts = CorrWindows.window_starts(40, window, stride)
+    assert cov.shape == (len(starts), 4, 3)
+    for k, start in enumerate(starts):
+        np.testing.assert_allclose(
+            cov[k], CorrFunctions.coefficient_of_variation(
+                image[start:start+window], 0.25), rtol=1e-10, atol=0)
+
+
+@pytest.mark.parametrize('offset', [1, 5, 12, 30])
+def test_sliding_correlation_matches_each_window(offset):
+    image1, image2 = movies()
+    stats1 = CorrWindows.window_statistics(image1)
+    stats2 = CorrWindows.window_statistics(image2)
+    for first, second in ((stats1, stats2), (stats2, stats1),
+                          (stats1, stats1)):
+        corr = CorrWindows.sliding_correlation(first, second, offset, 12, 7)
+        starts = CorrWindows.window_starts(40, 12, 7)
+        # Offsets are cut to the window as for whole movies
+        lags = CorrFunctions.lags_to_calculate(offset, 12)
+        assert corr.shape == (len(starts), lags, 4, 3)
+        for k, start in enumerate(starts):
+            frames = slice(start, start+12)
+            expected = direct(
+                first['centred'].reshape(first['shape'])[frames],
+                second['centred'].reshape(second['shape'])[frames], offset)
+            np.testing.assert_array_equal(np.isnan(corr[k]),
+                                          np.isnan(expected))
+            # Two overlapping frames can have next to no variance, which
+            # differences of running sums resolve less finely
+            np.testing.assert_allclose(corr[k], expected, rtol=0,
+                                       atol=1e-8)
+
+
+def test_float32_windows():
+    image1, image2 = [image.astype(np.float32) for image in movies()]
+    stats1 = CorrWindows.window_statistics(image1)
+    stats2 = CorrWindows.window_statistics(image2)
+    corr = CorrWindows.sliding_correlation(stats1, stats2, 5, 10, 10)
+    cov = CorrWindows.sliding_cov(stats1, 10, 10)
+    assert corr.dtype == cov.dtype == np.float32
+    np.testing.assert_allclose(corr[1], direct(image1[10:20], image2[10:20],
+                                               5), rtol=0, atol=1e-5)
+
+
+def test_windows_run(dataset, tmp_path):
+    output_path = str(tmp_path / 'results')
+    CorrFunctions.calculate_and_create_figures(
+        dataset, 'actin', 0.25, 3, output_path=output_path, window=6,
+        stride=3)
+    folder = os.path.join(output_path, 'corr_cell1')
+    corr = tif.imread(os.path.join(folder,
+                                   'corr_cell1_binderactin_windows.tif'))
+    cov = tif.imread(os.path.join(folder, 'cov_cell1_actin_windows.tif'))
+    # 12 frames: windows start at frames 0, 3 and 6
+    assert corr.shape == (3, 3, 32, 24)
+    assert cov.shape == (3, 32, 24)
+    # One greyscale page per window and lag, not RGB planes
+    for name, pages in (('corr_cell1_binderactin_windows.tif', 9),
+                        ('cov_cell1_actin_windows.tif', 3)):
+        with tif.TiffFile(os.path.join(folder, name)) as tiff:
+            assert len(tiff.pages) == pages
+            assert tiff.pages[0].photometric == tif.PHOTOMETRIC.MINISBLACK
+    images = {ch: CorrFunctions.coarse_grain_and_normalise(
+        os.path.join(dataset, ch, 'cell1.tif'), 0.25)
+        for ch in ('actin', 'binder')}
+    np.testing.assert_allclose(
+        corr[1], CorrFunctions.upsample(
+            direct(images['binder'][3:9], images['actin'][3:9], 3), 0.25,
+            stack=True), rtol=0, atol=1e-10)
+    np.testing.assert_allclose(
+        cov[2], CorrFunctions.upsample(
+            CorrFunctions.coefficient_of_variation(images['actin'][6:12],
+                                                   0.25), 0.25),
+        rtol=1e-10, atol=0)
+
+
+@pytest.mark.parametrize('options', [{'output_format': 'store'},
+                                     {'figure_style': 'density'},
+                                     {'memory_budget': 10**6}])
+def test_windows_refuse_options_they_do_not_use(dataset, tmp_path, options):
+    with pytest.raises(ValueError):
+        CorrFunctions.calculate_and_create_figures(
+            dataset, 'actin', 0.25, 3, output_path=str(tmp_path), window=6,
+            **options)
@@ -0,0 +1,123 @@
+import threading
+import time
+import numpy as np
+import pytest
+import CorrProfile
+import CorrWriter
+
+
+def save(array, path=None, profiler=None):
+    if path == 'fail':
+        raise IOError('disk full')
+    return float(np.sum(array))
+
+
+@pytest.mark.parametrize('max_bytes', [0, 1024])
+def test_failures_are_raised_at_close(max_bytes):
+    writer = CorrWriter.Writer(max_bytes)
+    ok = writer.submit(save, np.ones(4), labels={'image': 'cell1'})
+    failed = writer.submit(save, np.ones(4), path='fail',
+                           labels={'image': 'cell2', 'pair': 'ab'})
+    later = writer.submit(save, np.ones(2), labels={'image': 'cell3'})
+    with pytest.raises(CorrWriter.WriteError) as error:
+        writer.close()
+    assert '1 outputs could not be written' in str(error.value)
+    assert 'cell2, ab: OSError: disk full' in str(error.value)
+    assert isinstance(error.value.__cause__, OSError)
+    # The other outputs are still written
+    assert ok.result() == 4 and later.result() == 2
+    assert isinstance(failed.exception(), OSError)
+    # Errors are only raised once
+    writer.close()
+
+
+def test_exit_keeps_the_original_error(capsys):
+    with pytest.raises(KeyError):
+        with CorrWriter.Writer() as writer:
+            writer.submit(save, np.ones(4), path='fail')
+            raise KeyError('calculation failed')
+    assert 'disk full' in capsys.readouterr().out
+
+
+def test_pending_bytes_are_bounded():
+    release = threading.Event()
+    started = threading.Event()
+
+    def slow(array, profiler=None):
+        started.set()
+        release.wait(5)
+
+    profiler = CorrProfile.Profiler(trace_memory=False)
+    writer = CorrWriter.Writer(max_bytes=100, profiler=profiler)
+    writer.submit(slow, np.zeros(10), labels={'image': 'cell1'})
+    started.wait(5)
+    submitted = threading.Event()
+
+    def submit():
+        writer.submit(save, np.zeros(10), labels={'image': 'cell2'})
+        submitted.set()
+
+    thread = threading.Thread(target=submit)
+    thread.start()
+    # 80 + 80 bytes would exceed max_bytes, so the second output waits
+    assert not submitted.wait(0.3)
+    release.set()
+    assert submitted.wait(5)
+    thread.join()
+    writer.close()
+    assert writer.pending == 0
+    waits = [r for r in profiler.records if r['stage'] == 'queue_save']
+    assert [r['image'] for r in waits] == ['cell2']
+    assert waits[0]['wall_time'] >= 0.2
+
+
+def test_keyword_arrays_are_counted_and_copied():
+    release = threading.Event()
+    received = []
+
+    def slow(profiler=None, array=None):
+        release.wait(5)
+        received.append(array)
+
+    writer = CorrWriter.Writer(max_bytes=1000)
+    stack = np.zeros((10, 10))
+    writer.submit(slow, array=stack[:5])
+    assert writer.pending == 400
+    release.set()
+    writer.close()
+    assert writer.pending == 0
+    assert received[0].base is None
+
+
+def test_large_outputs_are_written_on_their_own():
+    writer = CorrWriter.Writer(max_bytes=10)
+    jobs = [writer.submit(save, np.ones(100)) for _ in range(3)]
+    writer.close()
+    assert [job.result() for job in jobs] == [100, 100, 100]
+
+
+def test_views_are_copied():
+    stack = np.zeros((10, 4))
+    args = [CorrWriter.own(arg) for arg in (stack, stack[0], {'a': stack[1]},
+                                            'name')]
+    assert args[0] is stack
+    assert args[1].base is None and args[2]['a'].base is None
+    assert [CorrWriter.array_bytes(arg) for arg in args] == [320, 32, 32, 0]
+
+
+@pytest.mark.parametrize('max_bytes', [0, 1024])
+def test_writes_are_profiled_as_their_stage(max_bytes):
+    def busy(array, profiler=None):
+        end = time.perf_counter() + 0.1
+        while time.perf_counter() < end:
+            pass
+
+    profiler = CorrProfile.Profiler(trace_memory=False)
+    with profiler.stage('run'):
+        with CorrWriter.Writer(max_bytes, profiler=profiler) as writer:
+            writer.submit(busy, np.ones(4), labels={'image': 'cell1'},
+                          stage='save_cov')
+    saves = [r for r in profiler.records if r['stage'] == 'save_cov']
+    assert len(saves) == 1 and saves[0]['image'] == 'cell1'
+    assert saves[0]['wall_time'] >= 0.1
+    assert saves[0]['cpu_time'] >= 0.05
@@ -0,0 +1,22 @@
+import os
+import sys
+import json
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                             'benchmarks'))
+import benchmark  # noqa: E402
+
+
+def test_benchmark_runs(tmp_path):
+    output = str(tmp_path / 'benchmark.json')
+    assert benchmark.main(['--frames', '12', '--size', '32', '--channels',
+                           '2', '--offset', '3', '--repeat', '1',
+                           '--output', output]) == 0
+    with open(output) as f:
+        report = json.load(f)
+    assert report['agreement_passed']
+    assert {'imresize_down_per_frame', 'imresize_down_vec',
+            'calculate_and_create_figures'} <= set(report['timings'])
+    # Every mode is checked against the per-frame resizing, not itself
+    assert set(report['imresize_speedup']) == {'vec', 'matrix', 'org'}
+    assert {'imresize_vec', 'imresize_matrix',
+            'imresize_org'} <= set(report['agreement'])